@@ -28,7 +28,25 @@ def create_app( config=None ):
         os.getenv( 'COF_ITEMS_PER_PAGE' ) else 20
     app.config['THUMBNAIL_PATH'] = \
         os.getenv( 'COF_THUMBNAIL_PATH' ) if \
-        os.getenv( 'COF_THUMBNAIL_PATH' ) else '/tmp'
+        os.getenv( 'COF_THUMBNAIL_PATH' ) else '/tmp/cloud_on_film_thumbnails'
+    app.config['THUMBNAIL_MAX_BYTES'] = \
+        int( os.getenv( 'COF_THUMBNAIL_MAX_BYTES' ) ) if \
+        os.getenv( 'COF_THUMBNAIL_MAX_BYTES' ) else 2 * 1024 * 1024 * 1024
+    app.config['THUMBNAIL_WAIT'] = \
+        float( os.getenv( 'COF_THUMBNAIL_WAIT' ) ) if \
+        os.getenv( 'COF_THUMBNAIL_WAIT' ) else None
+    app.config['IMPORT_SPOOL_PATH'] = \
+        os.getenv( 'COF_IMPORT_SPOOL_PATH' ) if \
+        os.getenv( 'COF_IMPORT_SPOOL_PATH' ) else '/tmp/cloud_on_film_imports'
+    app.config['IMPORT_WORKER'] = \
+        os.getenv( 'COF_IMPORT_WORKER' ).lower() if \
+        os.getenv( 'COF_IMPORT_WORKER' ) else 'thread'
+    app.config['SENDFILE'] = \
+        os.getenv( 'COF_SENDFILE' ).lower() if \
+        os.getenv( 'COF_SENDFILE' ) else None
+    app.config['ACCEL_REDIRECT_PREFIX'] = \
+        os.getenv( 'COF_ACCEL_REDIRECT_PREFIX' ) if \
+        os.getenv( 'COF_ACCEL_REDIRECT_PREFIX' ) else '/_accel'
     app.config['SQLALCHEMY_QUERY_DEBUG'] = \
         os.getenv( 'SQLALCHEMY_QUERY_DEBUG' ) if \
         os.getenv( 'SQLALCHEMY_QUERY_DEBUG' ) else 'false'
@@ -49,17 +67,38 @@ def create_app( config=None ):
     if config:
         app.config.from_object( config )
 
+    # Let send_file() hand the file off to Apache/lighttpd.
+    if 'x-sendfile' == app.config['SENDFILE']:
+        app.config['USE_X_SENDFILE'] = True
+
     db.init_app( app )
 
     csrf.init_app( app )
 
+    from .thumbstore import ThumbnailStore
+    app.extensions['thumbnail_store'] = ThumbnailStore(
+        app.config['THUMBNAIL_PATH'], app.config['THUMBNAIL_MAX_BYTES'] )
+    app.extensions['thumbnail_store'].prepare()
+
     with app.app_context():
         from . import routes
+        from . import commands
         from cloud_on_film.blueprints.ajax import ajax
         from cloud_on_film.blueprints.contents import contents
 
+        # Plugin models may add columns, so import them before creating
+        # the tables. The full-text index is created along with items.
+        from .files import picture
+        from . import fulltext
+
         db.create_all()
 
+        picture.register_plugin()
+
+        # Resolve plugin models once, rather than on every item query.
+        from .models import plugin_registry
+        plugin_registry.load()
+
         app.register_blueprint( routes.libraries )
         app.register_blueprint( ajax )
         app.register_blueprint( contents )
@@ -0,0 +1,224 @@
+import os
+import time
+import shutil
+import resource
+import tempfile
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+from PIL import Image
+from sqlalchemy import func
+
+from . import db
+from .models import Item, ItemMeta
+from .thumbnails import render_thumbnails
+
+def _peak_rss():
+    # KiB on Linux (bytes on macOS).
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+def legacy_thumbnails( source_path, targets ):
+
+    ''' The original thumbnail path: a full decode and LANCZOS resample of
+    the source for every size. Kept for comparison only. '''
+
+    for size, thumb_path in targets:
+        with Image.open( source_path ) as im:
+            im.thumbnail( size, Image.LANCZOS )
+            thumb = Image.new( 'RGB', size, (0, 0, 0) )
+            thumb.paste( im,
+                (int( (size[0] - im.size[0]) / 2 ),
+                int( (size[1] - im.size[1]) / 2 )) )
+            thumb.save( thumb_path, quality=75 )
+
+def _run_thumbnails( renderer, source_paths, sizes, out_dir, repeat ):
+
+    start_rss = _peak_rss()
+    start = time.perf_counter()
+    for i in range( repeat ):
+        for idx, source_path in enumerate( source_paths ):
+            renderer( source_path, [(size, os.path.join( out_dir,
+                '{}_{}x{}.jpg'.format( idx, size[0], size[1] ) ))
+                for size in sizes] )
+    elapsed = time.perf_counter() - start
+
+    return elapsed, start_rss, _peak_rss()
+
+def synthetic_jpeg( path, size=(6000, 4000) ):
+
+    ''' Write a noisy JPEG of the given size (24 megapixels by default). '''
+
+    pixels = numpy.random.RandomState( 0 ).randint(
+        0, 256, (size[1] // 8, size[0] // 8, 3), dtype=numpy.uint8 )
+    Image.fromarray( pixels ).resize( size, Image.BILINEAR ) \
+        .save( path, 'JPEG', quality=90 )
+
+def bench_thumbnails( source_paths, sizes, repeat=1 ):
+
+    ''' Render every size of every source with the legacy and current
+    thumbnailers, each in a fresh process so their peak RSS can be told
+    apart. Return {name: {images_per_sec, seconds, peak_rss_kib}}. '''
+
+    results = {}
+    out_dir = tempfile.mkdtemp()
+    try:
+        for name, renderer in [
+            ('legacy', legacy_thumbnails), ('current', render_thumbnails)
+        ]:
+            with ProcessPoolExecutor( max_workers=1 ) as pool:
+                elapsed, start_rss, peak_rss = pool.submit( _run_thumbnails,
+                    renderer, source_paths, sizes, out_dir, repeat ).result()
+            results[name] = {
+                'seconds': elapsed,
+                'images_per_sec': len( source_paths ) * repeat / elapsed,
+                'peak_rss_kib': peak_rss,
+                'added_rss_kib': peak_rss - start_rss }
+    finally:
+        shutil.rmtree( out_dir )
+
+    return results
+
+def _legacy_meta( key, cast=None ):
+    value = ItemMeta.value if not cast else db.cast( ItemMeta.value, cast )
+    return db.select( [value], db.and_(
+        ItemMeta.key == key, ItemMeta.item_id == Item.id ) ).as_scalar()
+
+def legacy_picture_columns():
+
+    ''' The correlated item_meta subqueries Picture used to map its width,
+    height, rating, comment and aspect to. Kept for comparison only. '''
+
+    width = _legacy_meta( 'width', db.Integer )
+    height = _legacy_meta( 'height', db.Integer )
+    rating = db.case( [
+        (db.select( [func.count( ItemMeta.value )], db.and_(
+            ItemMeta.key == 'rating',
+            ItemMeta.item_id == Item.id ) ).as_scalar() == 1,
+            _legacy_meta( 'rating', db.Integer ))
+    ], else_=0 )
+    comment = db.case( [
+        (db.select( [func.count( ItemMeta.value )], db.and_(
+            ItemMeta.key == 'comment',
+            ItemMeta.item_id == Item.id ) ).as_scalar() != None,
+            _legacy_meta( 'comment' ))
+    ], else_=None )
+    aspect = db.case( [
+        (16.0 * height / width == 10.0, 10),
+        (16.0 * height / width == 9.0, 9),
+        (4.0 * height / width == 3.0, 4),
+        (height == width, 1),
+    ], else_=0 )
+    return width, height, rating, comment, aspect
+
+def synthetic_pictures( folder_id, count, batch_size=5000 ):
+
+    ''' Insert count fake pictures, with meta, into the given folder. '''
+
+    from .files.picture import Picture, MACHINE_NAME
+
+    rand = numpy.random.RandomState( 0 )
+    now = datetime.now()
+    sizes = [(1920, 1200), (1920, 1080), (1600, 1200), (1000, 1000),
+        (1234, 567)]
+    for start in range( 0, count, batch_size ):
+        items = [{
+            'name': 'synthetic{}.jpg'.format( i ),
+            'folder_id': folder_id,
+            'timestamp': now,
+            'added': now,
+            'size': int( rand.randint( 1, 1 << 24 ) ),
+            'hash': '{:032x}'.format( i ),
+            'hash_algo': 1,
+            'plugin': MACHINE_NAME
+        } for i in range( start, min( count, start + batch_size ) )]
+        db.session.bulk_insert_mappings( Item, items, return_defaults=True )
+
+        metas = []
+        for item in items:
+            size = sizes[rand.randint( len( sizes ) )]
+            metas += [
+                {'item_id': item['id'], 'key': 'width', 'value': str( size[0] )},
+                {'item_id': item['id'], 'key': 'height', 'value': str( size[1] )},
+                {'item_id': item['id'], 'key': 'rating',
+                    'value': str( rand.randint( 6 ) )}]
+            if 0 == item['id'] % 3:
+                metas.append( {'item_id': item['id'], 'key': 'comment',
+                    'value': 'comment {}'.format( item['id'] )} )
+        for meta in metas:
+            meta['number'] = ItemMeta.number_of( meta['value'] )
+        db.session.bulk_insert_mappings( ItemMeta, metas )
+
+        Picture.sync_meta_columns(
+            db.session.connection(), [i['id'] for i in items] )
+        db.session.commit()
+
+def bench_item_pages( pages=20, per_page=20, min_rating=3 ):
+
+    ''' Time fetching pages of pictures filtered and sorted on their meta
+    fields, through the legacy subqueries and the denormalized columns.
+    Return {name: {ms_per_page, rows}}. '''
+
+    from .files.picture import Picture, MACHINE_NAME
+
+    results = {}
+    for name, columns in [
+        ('legacy', legacy_picture_columns()),
+        ('current', (Picture.width, Picture.height, Picture.rating,
+            Picture.comment, Picture.aspect))
+    ]:
+        width, height, rating, comment, aspect = columns
+        rows = 0
+        start = time.perf_counter()
+        for page in range( pages ):
+            rows += len( db.session.query(
+                Item.id, width, height, rating, comment, aspect ) \
+                .filter( Item.plugin == MACHINE_NAME ) \
+                .filter( rating >= min_rating ) \
+                .filter( aspect == 10 ) \
+                .order_by( width.desc(), Item.id ) \
+                .limit( per_page ) \
+                .offset( page * per_page ) \
+                .all() )
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            'ms_per_page': 1000.0 * elapsed / pages,
+            'rows': rows }
+
+    return results
+
+# Typical searches, from single comparisons to saved searches with long tag
+# lists.
+SEARCH_QUERY_CORPUS = [
+    'rating>=3',
+    'aspect=10',
+    '&((rating>=4)(aspect=10))',
+    '|((width=1920)(width=2560)(width=3840))',
+    '!(nsfw=1)',
+    '&(("Landscape"@tags)("Sunset"@tags)(rating>=3))',
+    '&((name=%IMG_2019%)(width>1000)(height>800))',
+    'rating>=3 & !(aspect=1) | comment=%favourite%',
+    '&(' + ''.join( '("Tag {}"@tags)'.format( i ) for i in range( 20 ) ) + ')',
+    '|(' + ''.join( '("Album {}"@tags)'.format( i ) for i in range( 40 ) ) + ')',
+]
+
+def bench_search_parse( repeat=2000, corpus=None ):
+
+    ''' Lex and parse each query in corpus repeat times. Return a list of
+    (query, microseconds per parse), ending with ('(all)', mean). '''
+
+    from .search import SearchLexerParser
+
+    corpus = corpus if corpus else SEARCH_QUERY_CORPUS
+
+    results = []
+    for query_str in corpus:
+        start = time.perf_counter()
+        for i in range( repeat ):
+            SearchLexerParser( query_str ).lex()
+        results.append(
+            (query_str, 1e6 * (time.perf_counter() - start) / repeat) )
+
+    results.append(
+        ('(all)', sum( r[1] for r in results ) / len( results )) )
+    return results
@@ -1,7 +1,9 @@
 
-from flask import Blueprint, jsonify, abort, request
+from flask import Blueprint, jsonify, abort, request, current_app
 from cloud_on_film import db
 from cloud_on_film.forms import EditItemForm
+from cloud_on_film.duplicates import DuplicateFinder
+from cloud_on_film.similarity import SimilarityIndex, DEFAULT_MAX_DISTANCE
 from cloud_on_film.models import \
     Tag, Item, User, Folder, Library, LibraryRootException
 
@@ -118,6 +120,49 @@ def list_folders():
 
     return jsonify( json_out )
 
+@ajax.route( '/ajax/list/duplicates' )
+def list_duplicates():
+
+    ''' Return a page of groups of byte-identical ACCESSIBLE items, as last
+    found by the duplicates command. '''
+
+    page = int( request.args['page'] ) \
+        if 'page' in request.args and request.args['page'] else 0
+    offset = page * current_app.config['ITEMS_PER_PAGE']
+
+    total, groups = DuplicateFinder.stored_page(
+        User.current_uid(), offset, current_app.config['ITEMS_PER_PAGE'] )
+    updated, stale = DuplicateFinder.stored_status()
+
+    return jsonify( {
+        'total': total,
+        'groups': DuplicateFinder.describe( groups ),
+        'updated': updated,
+        'stale': stale
+    } )
+
+@ajax.route( '/ajax/list/similar/<int:item_id>' )
+def list_similar( item_id ):
+
+    ''' Return ACCESSIBLE pictures that look like the given item, nearest
+    first, within ?distance= differing hash bits. '''
+
+    distance = int( request.args['distance'] ) \
+        if 'distance' in request.args and request.args['distance'] else \
+        DEFAULT_MAX_DISTANCE
+
+    # Make sure the user can see the item being compared against.
+    Item.secure_query( User.current_uid() ) \
+        .filter( Item.id == item_id ) \
+        .first_or_404()
+
+    return jsonify( [{
+        'id': item.id,
+        'name': item.name,
+        'distance': item_distance
+    } for item, item_distance in SimilarityIndex.similar(
+        item_id, User.current_uid(), distance )] )
+
 # endregion
 
 # region get
@@ -190,7 +235,7 @@ def cloud_item_ajax_save():
 
     # Translate tags data.
     new_tags = request.form['tags'].split( ',' )
-    item.tags = [Tag.from_path( t ) for t in new_tags]
+    item.tags = Tag.from_paths( new_tags )
 
     # Translate location data.
     new_location = request.form['location'].split( '/' )
@@ -218,7 +263,13 @@ def cloud_item_ajax_save():
                     {'submit_status': 'error', 'errors':
                         ['Invalid save path specified.'] } )
 
-    #db.session.commit()
+    if save_form.comment.data:
+        item.meta['comment'] = save_form.comment.data
+    elif 'comment' in item.meta:
+        del item.meta['comment']
+
+    # Tags, comment and the full-text index are written together.
+    db.session.commit()
 
     # Return the modified item.
     item_dict = item.to_dict( ignore_keys=['parent', 'folder'] )
@@ -1,13 +1,97 @@
 
 import io
+import os
 import mimetypes
+from datetime import timezone
+from urllib.parse import quote
 from flask import Blueprint, abort, request, current_app, send_file
 from cloud_on_film import db
 from cloud_on_film.models import \
-    Tag, Item, User, Folder, Library, LibraryRootException
+    Tag, Item, User, Folder, Library, LibraryRootException, JobStatusEnum
+from cloud_on_film import thumbnails
 
 contents = Blueprint( 'contents', __name__ )
 
+# Hash-addressed URLs never change content, so they can be kept a year.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+def item_validators( file_id, user_id ):
+
+    ''' Return (hash, size, timestamp, owner_id) of the given item if the
+    user may see it, with a plain column query instead of loading the
+    polymorphic item and its meta subqueries. '''
+
+    query = db.session.query(
+        Item.hash, Item.size, Item.timestamp, Item.owner_id ) \
+        .filter( Item.id == file_id )
+    if 0 <= user_id:
+        query = query.filter( db.or_(
+            Item.owner_id == None,
+            user_id == Item.owner_id ) )
+
+    row = query.first()
+    if not row:
+        abort( 404 )
+
+    item_hash, size, timestamp, owner_id = row
+    if timestamp:
+        # Stored as naive local time; HTTP dates are whole UTC seconds.
+        timestamp = timestamp.replace( microsecond=0 ) \
+            .astimezone( timezone.utc )
+
+    return item_hash, size, timestamp, owner_id
+
+def not_modified( etag, last_modified ):
+
+    ''' Return True if the request's validators match, so it can be
+    answered with 304 before touching the file. '''
+
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since.
+        return request.if_none_match.contains_weak( etag )
+
+    since = request.if_modified_since
+    if since and last_modified:
+        if not since.tzinfo:
+            since = since.replace( tzinfo=timezone.utc )
+        return last_modified <= since
+
+    return False
+
+def cache_headers( response, etag, last_modified, owner_id, immutable ):
+
+    response.set_etag( etag )
+    if last_modified:
+        response.last_modified = last_modified
+
+    # Items in owned libraries must not be kept by shared caches.
+    response.headers['Cache-Control'] = '{}, {}'.format(
+        'private' if owner_id is not None else 'public',
+        'max-age={}, immutable'.format( IMMUTABLE_MAX_AGE ) if immutable \
+            else 'no-cache' )
+
+    return response
+
+def send_path( file_path, mime_type, etag=True, last_modified=None ):
+
+    ''' Respond with the file at file_path without reading it in here.
+
+    With SENDFILE set to x-accel-redirect, nginx is told to serve it from
+    ACCEL_REDIRECT_PREFIX + the absolute path (an internal location aliased
+    to /). With x-sendfile, send_file() adds the X-Sendfile header for
+    Apache/lighttpd. Otherwise the file is streamed in chunks, honouring
+    Range requests (and If-Range against the given validators). '''
+
+    if 'x-accel-redirect' == current_app.config['SENDFILE']:
+        response = current_app.response_class( mimetype=mime_type )
+        response.headers['X-Accel-Redirect'] = \
+            current_app.config['ACCEL_REDIRECT_PREFIX'] + \
+            quote( os.path.abspath( file_path ) )
+        return response
+
+    return send_file( file_path, mimetype=mime_type, conditional=True,
+        etag=etag, last_modified=last_modified )
+
 @contents.route( '/contents/preview/<int:file_id>' )
 def preview( file_id ):
 
@@ -18,28 +102,69 @@ def preview( file_id ):
 
     current_uid = User.current_uid()
 
-    allowed_resolutions = [
-        tuple( [int( i ) for i in r.split( ',' )] )
-            for r in current_app.config['ALLOWED_PREVIEWS']]
-
-    if not (width, height) in allowed_resolutions:
+    if not (width, height) in thumbnails.allowed_previews():
         abort( 404 )
 
+    item_hash, item_size, timestamp, owner_id = \
+        item_validators( file_id, current_uid )
+
+    # Thumbnails are keyed by content, so URLs carrying the hash as v are
+    # safe to cache forever.
+    etag = '{}-{}x{}'.format( item_hash, width, height )
+    immutable = item_hash == request.args.get( 'v' )
+
+    if not_modified( etag, timestamp ):
+        return cache_headers( current_app.response_class( status=304 ),
+            etag, timestamp, owner_id, immutable )
+
     item = Item.secure_query( current_uid ) \
         .filter( Item.id == file_id ) \
         .first_or_404()
 
-    file_path = item.thumbnail_path( (width, height) )
-
-    with open( file_path, 'rb' ) as pic_f:
-        return send_file( io.BytesIO( pic_f.read() ),
-            item.thumbnail_mime() )
+    wait = current_app.config['THUMBNAIL_WAIT']
+    if wait is None:
+        # No thumbnail workers, so render it here.
+        file_path = item.thumbnail_path( (width, height) )
+
+    else:
+        file_path = item.thumbnail_path( (width, height), generate=False )
+        if not os.path.exists( file_path ):
+            # Only queue items with no job, or whose thumbnail was evicted.
+            # Failed jobs are retried by flask thumbnails or a rescan, not
+            # on every view.
+            job = item.thumbnail_job
+            if not job or JobStatusEnum.done == job.status:
+                thumbnails.enqueue( [item.id] )
+                db.session.commit()
+            if (job and JobStatusEnum.failed == job.status) or \
+            not thumbnails.wait_for( file_path, wait ):
+                response = send_file(
+                    io.BytesIO( thumbnails.placeholder( (width, height) ) ),
+                    item.thumbnail_mime() )
+                # Make sure the real thumbnail is fetched next time.
+                response.headers['Cache-Control'] = 'no-store'
+                return response
+
+    thumbnails.store().touch( file_path )
+
+    return cache_headers( send_path( file_path, item.thumbnail_mime(),
+        etag, timestamp ), etag, timestamp, owner_id, immutable )
 
 @contents.route( '/contents/fullsize/<int:file_id>' )
 def fullsize( file_id ):
 
     current_uid = User.current_uid()
 
+    item_hash, item_size, timestamp, owner_id = \
+        item_validators( file_id, current_uid )
+
+    etag = '{}-{}'.format( item_hash, item_size )
+    immutable = item_hash == request.args.get( 'v' )
+
+    if not_modified( etag, timestamp ):
+        return cache_headers( current_app.response_class( status=304 ),
+            etag, timestamp, owner_id, immutable )
+
     item = Item.secure_query( current_uid ) \
         .filter( Item.id == file_id ) \
         .first_or_404()
@@ -51,11 +176,5 @@ def fullsize( file_id ):
     mime_type = item.mime_type if item.mime_type \
         else mimetypes.guess_type( file_path )[0]
 
-    print( 'zzz')
-    print( 'zzz')
-    print( mime_type )
-    print( 'zzz')
-    print( 'zzz')
-
-    with open( file_path, 'rb' ) as pic_f:
-        return send_file( io.BytesIO( pic_f.read() ), mime_type )
+    return cache_headers( send_path( file_path, mime_type, etag, timestamp ),
+        etag, timestamp, owner_id, immutable )
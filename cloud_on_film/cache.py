@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache( object ):
+
+    ''' A small, thread-safe, bounded mapping that discards the least
+    recently used entries first and counts hits and misses. '''
+
+    def __init__( self, maxsize=1024 ):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__( self ):
+        return len( self._entries )
+
+    def __contains__( self, key ):
+        return key in self._entries
+
+    def get( self, key, default=None ):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end( key )
+            self.hits += 1
+            return self._entries[key]
+
+    def set( self, key, value ):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end( key )
+            while len( self._entries ) > self.maxsize:
+                self._entries.popitem( last=False )
+
+    def pop( self, key, default=None ):
+        with self._lock:
+            return self._entries.pop( key, default )
+
+    def evict( self, predicate ):
+
+        ''' Remove every entry whose key satisfies predicate( key ). '''
+
+        with self._lock:
+            for key in [k for k in self._entries if predicate( k )]:
+                del self._entries[key]
+
+    def clear( self ):
+        with self._lock:
+            self._entries.clear()
+
+    def check_version( self, version ):
+
+        ''' Clear every entry if version (e.g. a DataVersion counter) differs
+        from the one last checked, as the entries may have gone stale. '''
+
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+
+    def stats( self ):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len( self._entries ),
+            'maxsize': self.maxsize }
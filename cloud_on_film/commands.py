@@ -1,23 +1,380 @@
+import os
+import time
+import click
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from .models import \
+    db, \
+    Library, \
+    Folder, \
+    Item, \
+    ItemMeta, \
+    Plugin, \
+    HashEnum, \
+    JobStatusEnum, \
+    StatusEnum, \
+    Tag, \
+    ThumbnailJob
+from .scanner import Scanner
+from .importing import \
+    ItemImporter, ImportWorker, JSONRecordReader, requeue_import_job
+from .thumbnails import ThumbnailWorker, enqueue, store
+from .duplicates import DuplicateFinder
+from .similarity import \
+    SimilarityIndex, \
+    DEFAULT_MAX_DISTANCE, \
+    PHASH_META_KEY
 
 @current_app.cli.command( "update" )
-def cloud_cli_update():
-    for library in db.session.query( Library ):
-        library_absolute_path = library.absolute_path
-        for dirpath, dirnames, filenames in os.walk( library_absolute_path ):
-            relative_path = re.sub( '^{}'.format( library_absolute_path ), '', dirpath )
-            try:
-                assert( None != library )
-                #print( 'lib_abs: ' + library.absolute_path )
-                folder = Folder.from_path( library, relative_path )
-                #print( folder )
-            except InvalidFolderException as e:
-                print( dirpath )
-                print( relative_path )
-                current_app.logger.error( e.absolute_path )
-            except LibraryRootException as e:
-                current_app.logger.error( 'root' )
-            #for dirname in dirnames:
-            #    current_app.logger.info( dirname )
+@click.option( '--workers', default=8, help='Number of scan/probe threads.' )
+@click.option( '--hash-workers', default=None, type=int,
+    help='Number of hashing processes (default: one per CPU).' )
+@click.option( '--hash-algo', default=HashEnum.md5.name,
+    type=click.Choice( [h.name for h in HashEnum] ),
+    help='Hash algorithm for newly added items.' )
+@click.option( '--batch-size', default=500,
+    help='Number of new items to insert per commit.' )
+@click.option( '--restart', is_flag=True,
+    help='Ignore any saved checkpoint and scan from the start.' )
+@click.option( '--full', is_flag=True,
+    help='Compare every file, even in directories that have not changed.' )
+@click.option( '--no-thumbnails', is_flag=True,
+    help='Leave queued thumbnails for the thumbnails command.' )
+@click.argument( 'machine_names', nargs=-1 )
+def cloud_cli_update(
+    workers, hash_workers, hash_algo, batch_size, restart, full,
+    no_thumbnails, machine_names
+):
+
+    ''' Scan libraries on disk and add new folders and items. '''
+
+    query = db.session.query( Library )
+    if machine_names:
+        query = query.filter( Library.machine_name.in_( machine_names ) )
+
+    for library in query.all():
+        scanner = Scanner( library, workers=workers, batch_size=batch_size,
+            resume=not restart, full=full, hash_algo=HashEnum[hash_algo],
+            hash_workers=hash_workers )
+        stats = scanner.run()
+        click.echo( '{}: {} files seen, {} folders and {} items added, ' \
+            '{} items updated, {} missing, {} directories unchanged ' \
+            'in {:.1f}s ({:.1f} files/sec)'.format(
+                library.machine_name, stats['files_seen'],
+                stats['folders_added'], stats['items_added'],
+                stats['items_updated'], stats['items_missing'],
+                stats['dirs_skipped'], stats['elapsed'],
+                stats['files_per_sec'] ) )
+
+    if not no_thumbnails:
+        done, failed = ThumbnailWorker( hash_workers ).process()
+        click.echo( '{} thumbnails rendered, {} failed'.format(
+            done, failed ) )
+
+@current_app.cli.command( "import" )
+@click.option( '--workers', default=None, type=int,
+    help='Number of reading/hashing processes (default: one per CPU).' )
+@click.option( '--batch-size', default=500,
+    help='Number of records to import per commit.' )
+@click.argument( 'json_path', type=click.Path( exists=True, dir_okay=False ) )
+def cloud_cli_import( workers, batch_size, json_path ):
+
+    ''' Import pictures, with their tags, ratings and comments, from a JSON
+    (or JSON Lines) export of the old gallery. '''
+
+    importer = ItemImporter( batch_size=batch_size, workers=workers )
+    stats = importer.run( JSONRecordReader( json_path ) )
+    click.echo( '{} records: {} items added, {} already present, ' \
+        '{} failed in {:.1f}s ({:.1f} records/sec)'.format(
+            stats['records_seen'], stats['items_added'],
+            stats['items_skipped'], stats['items_failed'], stats['elapsed'],
+            stats['records_per_sec'] ) )
+
+@current_app.cli.command( "import-worker" )
+@click.option( '--workers', default=None, type=int,
+    help='Number of reading/hashing processes (default: one per CPU).' )
+@click.option( '--batch-size', default=500,
+    help='Number of records to import per commit.' )
+@click.option( '--requeue', multiple=True, metavar='JOB_ID',
+    help='First put this failed job back in the queue (repeatable).' )
+@click.option( '--watch', is_flag=True,
+    help='Keep polling the queue for new jobs.' )
+@click.option( '--interval', default=5.0,
+    help='Seconds between polls with --watch.' )
+def cloud_cli_import_worker( workers, batch_size, requeue, watch, interval ):
+
+    ''' Run queued upload imports (set COF_IMPORT_WORKER=cli so the web
+    processes leave them to this). '''
+
+    for job_id in requeue:
+        if not requeue_import_job( job_id ):
+            click.echo( 'No failed import job {}'.format( job_id ) )
+
+    worker = ImportWorker( workers, batch_size )
+    with ProcessPoolExecutor( max_workers=workers ) as pool:
+        while True:
+            worker.run( pool )
+            if not watch:
+                break
+            time.sleep( interval )
+
+    click.echo( '{} imports done, {} failed'.format(
+        worker.done, worker.failed ) )
+
+@current_app.cli.command( "thumbnails" )
+@click.option( '--workers', default=None, type=int,
+    help='Number of rendering processes (default: one per CPU).' )
+@click.option( '--batch-size', default=100,
+    help='Number of jobs to claim at a time.' )
+@click.option( '--backfill', is_flag=True,
+    help='First queue every picture that has never been queued.' )
+@click.option( '--retry-failed', is_flag=True,
+    help='First queue failed jobs again.' )
+@click.option( '--reindex', is_flag=True,
+    help='First rebuild the thumbnail store index from disk.' )
+@click.option( '--watch', is_flag=True,
+    help='Keep polling the queue for new jobs.' )
+@click.option( '--interval', default=5.0,
+    help='Seconds between polls with --watch.' )
+def cloud_cli_thumbnails(
+    workers, batch_size, backfill, retry_failed, reindex, watch, interval
+):
+
+    ''' Render queued thumbnails in the background. '''
+
+    from .files.picture import MACHINE_NAME
+
+    if reindex:
+        count = store().reindex()
+        click.echo( '{} thumbnails indexed'.format( count ) )
+
+    if backfill:
+        queued = db.session.query( ThumbnailJob.item_id )
+        item_ids = [r[0] for r in db.session.query( Item.id ) \
+            .filter( Item.plugin == MACHINE_NAME ) \
+            .filter( ~Item.id.in_( queued ) )]
+        for idx in range( 0, len( item_ids ), batch_size ):
+            enqueue( item_ids[idx:idx + batch_size] )
+        db.session.commit()
+        click.echo( '{} pictures queued'.format( len( item_ids ) ) )
+
+    if retry_failed:
+        retried = db.session.query( ThumbnailJob ) \
+            .filter( ThumbnailJob.status == JobStatusEnum.failed ) \
+            .update( {ThumbnailJob.status: JobStatusEnum.pending,
+                ThumbnailJob.timestamp: int( time.time() ),
+                ThumbnailJob.note: None}, synchronize_session=False )
+        db.session.commit()
+        click.echo( '{} failed jobs queued'.format( retried ) )
+
+    worker = ThumbnailWorker( workers, batch_size )
+    with ProcessPoolExecutor( max_workers=workers ) as pool:
+        while True:
+            worker.run( pool )
+            if not watch:
+                break
+            time.sleep( interval )
+
+    click.echo( '{} thumbnails rendered, {} failed'.format(
+        worker.done, worker.failed ) )
+
+@current_app.cli.command( "bench-thumbnails" )
+@click.option( '--repeat', default=1, help='Number of passes over the files.' )
+@click.argument( 'paths', nargs=-1 )
+def cloud_cli_bench_thumbnails( repeat, paths ):
+
+    ''' Compare thumbnail rendering speed and memory against the original
+    method, using the given images or a generated 24-megapixel JPEG. '''
+
+    import tempfile
+    from .benchmarks import bench_thumbnails, synthetic_jpeg
+    from .thumbnails import allowed_previews
+
+    temp_dir = None
+    if not paths:
+        temp_dir = tempfile.TemporaryDirectory()
+        paths = [os.path.join( temp_dir.name, 'synthetic.jpg' )]
+        synthetic_jpeg( paths[0] )
+
+    results = bench_thumbnails( list( paths ), allowed_previews(), repeat )
+    for name, result in results.items():
+        click.echo( '{}: {:.2f} images/sec ({:.2f}s), ' \
+            'peak RSS {} KiB (+{} KiB)'.format(
+                name, result['images_per_sec'], result['seconds'],
+                result['peak_rss_kib'], result['added_rss_kib'] ) )
+
+    if temp_dir:
+        temp_dir.cleanup()
+
+@current_app.cli.command( "bench-item-pages" )
+@click.option( '--synthetic', default=0,
+    help='Run against a scratch DB of this many fake pictures instead.' )
+@click.option( '--pages', default=20, help='Number of pages to fetch.' )
+def cloud_cli_bench_item_pages( synthetic, pages ):
+
+    ''' Compare the cost of listing pictures through the old item_meta
+    subqueries and through the denormalized picture columns. '''
+
+    import tempfile
+    from . import create_app
+    from .benchmarks import bench_item_pages, synthetic_pictures
+
+    def run():
+        for name, result in bench_item_pages(
+            pages, current_app.config['ITEMS_PER_PAGE'] ).items():
+            click.echo( '{}: {:.2f} ms/page ({} rows)'.format(
+                name, result['ms_per_page'], result['rows'] ) )
+
+    if not synthetic:
+        run()
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        class BenchConfig( object ):
+            SQLALCHEMY_DATABASE_URI = \
+                'sqlite:///' + os.path.join( temp_dir, 'bench.sqlite3' )
+            THUMBNAIL_PATH = os.path.join( temp_dir, 'thumbnails' )
+
+        with create_app( BenchConfig ).app_context():
+            library = Library( machine_name='bench', display_name='Bench',
+                absolute_path=temp_dir, nsfw=False )
+            db.session.add( library )
+            db.session.commit()
+            folder = Folder( name='bench', library_id=library.id )
+            db.session.add( folder )
+            db.session.commit()
+            synthetic_pictures( folder.id, synthetic )
+            run()
+            db.session.remove()
+
+@current_app.cli.command( "bench-search-parse" )
+@click.option( '--repeat', default=2000, help='Passes over the corpus.' )
+def cloud_cli_bench_search_parse( repeat ):
+
+    ''' Time lexing and parsing a corpus of typical search queries. '''
+
+    from .benchmarks import bench_search_parse
+
+    for query_str, usec in bench_search_parse( repeat ):
+        click.echo( '{:8.1f} us  {}'.format( usec, query_str
+            if 60 >= len( query_str ) else query_str[:57] + '...' ) )
+
+@current_app.cli.command( "migrate" )
+def cloud_cli_migrate():
+
+    ''' Add tables and columns introduced since the database was created. '''
+
+    from .migrations import upgrade
+
+    added = upgrade()
+    for table, columns in added.items():
+        click.echo( '{}: added {}'.format( table, ', '.join( columns ) ) )
+    click.echo( 'database is up to date' )
+
+@current_app.cli.command( "fulltext" )
+@click.option( '--rebuild', is_flag=True,
+    help='First reindex every item.' )
+@click.option( '--limit', default=20, help='Number of matches to list.' )
+@click.argument( 'words', nargs=-1 )
+def cloud_cli_fulltext( rebuild, limit, words ):
+
+    ''' List the items best matching words in the full-text index. '''
+
+    from .fulltext import index_for
+
+    index = index_for( db.engine )
+    if not index:
+        raise click.ClickException(
+            'full-text search is not available on this database' )
+
+    if rebuild:
+        count = index.rebuild( db.session.connection() )
+        db.session.commit()
+        click.echo( '{} items indexed'.format( count ) )
+
+    if not words or not index.terms( ' '.join( words ) ):
+        return
+
+    matches = db.session.execute(
+        index.ranked( ' '.join( words ), limit=limit ) ).fetchall()
+    items = {i.id: i for i in db.session.query( Item ) \
+        .filter( Item.id.in_( [m[0] for m in matches] ) )}
+    for item_id, score in matches:
+        if item_id in items:
+            click.echo( '{:8.3f}  {} ({})'.format(
+                score, items[item_id].absolute_path, item_id ) )
+
+@current_app.cli.command( "duplicates" )
+@click.option( '--workers', default=None, type=int,
+    help='Number of hashing processes (default: one per CPU).' )
+@click.option( '--watch', is_flag=True,
+    help='Keep searching again whenever items change.' )
+@click.option( '--interval', default=60.0,
+    help='Seconds between checks for changes with --watch.' )
+def cloud_cli_duplicates( workers, watch, interval ):
+
+    ''' Find groups of byte-identical items across all libraries, storing
+    them for the duplicates page, and list them. '''
+
+    groups = DuplicateFinder.refresh( workers )
+    for group in DuplicateFinder.describe( groups ):
+        click.echo( '{} bytes:'.format( group['size'] ) )
+        for item in group['items']:
+            click.echo( '    {} ({})'.format( item['path'], item['id'] ) )
+
+    click.echo( '{} duplicate groups found'.format( len( groups ) ) )
+
+    while watch:
+        time.sleep( interval )
+        # End the transaction, so the next check sees new writes.
+        db.session.rollback()
+        if DuplicateFinder.stored_status()[1]:
+            groups = DuplicateFinder.refresh( workers )
+            click.echo( '{} duplicate groups found'.format( len( groups ) ) )
+
+@current_app.cli.command( "similar" )
+@click.option( '--distance', default=DEFAULT_MAX_DISTANCE,
+    help='Maximum differing perceptual hash bits.' )
+def cloud_cli_similar( distance ):
+
+    ''' List clusters of near-duplicate pictures across all libraries. '''
+
+    clusters = SimilarityIndex.clusters( distance )
+    for cluster in DuplicateFinder.describe( clusters ):
+        click.echo( 'cluster:' )
+        for item in cluster['items']:
+            click.echo( '    {} ({})'.format( item['path'], item['id'] ) )
+
+    click.echo( '{} clusters found'.format( len( clusters ) ) )
+
+@current_app.cli.command( "phash" )
+def cloud_cli_phash():
+
+    ''' Compute perceptual hashes for pictures imported without one. '''
+
+    from .files.picture import Picture, MACHINE_NAME
+
+    has_phash = db.session.query( ItemMeta.item_id ) \
+        .filter( ItemMeta.key == PHASH_META_KEY )
+    query = db.session.query( Picture ) \
+        .filter( Item.plugin == MACHINE_NAME ) \
+        .filter( ~Item.id.in_( has_phash ) )
+
+    count = 0
+    for picture in query.all():
+        try:
+            picture.meta[PHASH_META_KEY] = \
+                Picture.probe( picture.absolute_path )[PHASH_META_KEY]
+        except (OSError, IOError) as e:
+            current_app.logger.warning(
+                'unable to hash %s: %s', picture.absolute_path, e )
+            continue
+        count += 1
+        if 0 == count % 500:
+            db.session.commit()
+    db.session.commit()
+
+    click.echo( '{} pictures hashed'.format( count ) )
 
 def cloud_update_item_meta( item ):
     if not os.path.exists( item.absolute_path ):
@@ -41,4 +398,33 @@ def cloud_cli_refresh():
     #    print( res )
     for item in db.session.query( Item ):
         cloud_update_item_meta( item )
-    db.session.commit()
\ No newline at end of file
+    db.session.commit()
+
+@current_app.cli.command( "plugins" )
+@click.option( '--enable', multiple=True, help='Enable the named plugin.' )
+@click.option( '--disable', multiple=True, help='Disable the named plugin.' )
+def cloud_cli_plugins( enable, disable ):
+
+    ''' List plugins, optionally enabling or disabling some first. '''
+
+    for plugin in db.session.query( Plugin ):
+        if plugin.machine_name in enable:
+            plugin.enabled = True
+        elif plugin.machine_name in disable:
+            plugin.enabled = False
+    db.session.commit()
+
+    for plugin in db.session.query( Plugin ).order_by( Plugin.machine_name ):
+        click.echo( '{} ({}): {}, {}'.format(
+            plugin.machine_name, plugin.display_name,
+            'enabled' if plugin.enabled else 'disabled',
+            ', '.join( sorted( plugin.extensions ) ) ) )
+
+    if enable or disable:
+        click.echo( 'Restart the app for running workers to see the change.' )
+
+@current_app.cli.command( "rebuild-paths" )
+def cloud_cli_rebuild_paths():
+    Folder.rebuild_paths()
+    Tag.rebuild_paths( db.session.connection() )
+    db.session.commit()
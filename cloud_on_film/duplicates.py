@@ -0,0 +1,254 @@
+import os
+import time
+from itertools import chain
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from .hashing import BulkHasher, HashEnum
+from .models import \
+    db, \
+    DataVersion, \
+    DuplicateItem, \
+    Folder, \
+    Item, \
+    Library, \
+    WorkerSemaphore
+
+# Files of the same size are first compared on this many leading bytes, so
+# most non-duplicates are ruled out without reading them in full.
+PARTIAL_HASH_LENGTH = 64 * 1024
+
+# The semaphore recording when the stored groups were found: its timestamp,
+# the number of groups as progress, and the items data version as note.
+DUPLICATES_SEMAPHORE_ID = 'duplicates'
+
+class DuplicateFinder( object ):
+
+    ''' Finds groups of byte-identical items across every library.
+
+    Items hashed with the same algorithm are grouped by their stored hash
+    using the (hash_algo, hash) index, without touching the disk. Items
+    whose size matches an item stored under a different algorithm are
+    compared by hashing their first PARTIAL_HASH_LENGTH bytes, and then
+    fully hashing only the partial matches. '''
+
+    def __init__( self, user_id, hash_algo=HashEnum.blake2b, workers=None ):
+        self.user_id = user_id
+        self.hash_algo = hash_algo
+        self.workers = workers
+
+    @staticmethod
+    def secure( query, user_id ):
+
+        ''' Join the items in query to their libraries and filter out those
+        the user may not access. '''
+
+        query = query \
+            .join( Folder, Item.folder_id == Folder.id ) \
+            .join( Library, Folder.library_id == Library.id )
+
+        if 0 <= user_id:
+            query = query.filter( db.or_(
+                Library.owner_id == None,
+                user_id == Library.owner_id ) )
+
+        return query
+
+    def _secure( self, query ):
+        return DuplicateFinder.secure( query, self.user_id )
+
+    def _stored_groups( self ):
+
+        ''' Yield (key, item ID) for items sharing a stored hash. '''
+
+        dups = db.session.query( Item.hash_algo, Item.hash ) \
+            .group_by( Item.hash_algo, Item.hash ) \
+            .having( func.count( Item.id ) > 1 ) \
+            .subquery()
+
+        query = self._secure( db.session.query(
+            Item.id, Item.hash_algo, Item.hash ) \
+            .join( dups, db.and_(
+                Item.hash_algo == dups.c.hash_algo,
+                Item.hash == dups.c.hash ) ) )
+
+        for item_id, hash_algo, item_hash in query.yield_per( 1000 ):
+            yield (hash_algo, item_hash), item_id
+
+    def _mixed_candidates( self ):
+
+        ''' Return (ID, size, absolute path) for items whose size is shared
+        with an item stored under a different hash algorithm. '''
+
+        sizes = db.session.query( Item.size ) \
+            .group_by( Item.size ) \
+            .having( func.count( func.distinct( Item.hash_algo ) ) > 1 ) \
+            .subquery()
+
+        query = self._secure( db.session.query(
+            Item.id, Item.size, Library.absolute_path, Folder.path, Item.name ) \
+            .join( sizes, Item.size == sizes.c.size ) )
+
+        return [(item_id, size, os.path.join( lib_path, folder_path, name ))
+            for item_id, size, lib_path, folder_path, name in query]
+
+    def _content_groups( self ):
+
+        ''' Yield (key, item ID) for mixed-algorithm candidates sharing
+        their content hash. '''
+
+        candidates = self._mixed_candidates()
+        if not candidates:
+            return
+
+        with BulkHasher( self.hash_algo, self.workers ) as hasher:
+            partial_hashes = hasher.hash(
+                [c[2] for c in candidates], PARTIAL_HASH_LENGTH )
+
+            by_partial = defaultdict( list )
+            for candidate, partial_hash in zip( candidates, partial_hashes ):
+                if partial_hash is not None:
+                    by_partial[(candidate[1], partial_hash)].append( candidate )
+
+            full = []
+            for (size, partial_hash), group in by_partial.items():
+                if 2 > len( group ):
+                    continue
+                elif PARTIAL_HASH_LENGTH >= size:
+                    # The partial hash already covered the whole file.
+                    for candidate in group:
+                        yield ('content', partial_hash), candidate[0]
+                else:
+                    full += group
+
+            full_hashes = hasher.hash( [c[2] for c in full] )
+            for candidate, full_hash in zip( full, full_hashes ):
+                if full_hash is not None:
+                    yield ('content', full_hash), candidate[0]
+
+    def find( self ):
+
+        ''' Return a sorted list of duplicate groups, each a sorted list of
+        item IDs. '''
+
+        # Union-find, so an item matched by both passes joins one group.
+        parents = {}
+        key_items = {}
+
+        def root( item_id ):
+            while parents[item_id] != item_id:
+                parents[item_id] = parents[parents[item_id]]
+                item_id = parents[item_id]
+            return item_id
+
+        for key, item_id in \
+        chain( self._stored_groups(), self._content_groups() ):
+            parents.setdefault( item_id, item_id )
+            if key in key_items:
+                parents[root( item_id )] = root( key_items[key] )
+            else:
+                key_items[key] = item_id
+
+        groups = defaultdict( list )
+        for item_id in parents:
+            groups[root( item_id )].append( item_id )
+
+        return sorted( [sorted( g ) for g in groups.values() if 1 < len( g )] )
+
+    @staticmethod
+    def refresh( workers=None ):
+
+        ''' Find the duplicate groups across every library and replace the
+        stored ones with them. Return the groups. '''
+
+        # Read first, so writes made while searching leave them stale.
+        version = DataVersion.get( DataVersion.ITEMS )
+        groups = DuplicateFinder( -1, workers=workers ).find()
+
+        db.session.query( DuplicateItem ).delete( synchronize_session=False )
+        db.session.bulk_insert_mappings( DuplicateItem, [
+            {'group_id': group_id, 'item_id': item_id}
+            for group_id, group in enumerate( groups, 1 )
+            for item_id in group] )
+
+        semaphore = db.session.query( WorkerSemaphore ) \
+            .get( DUPLICATES_SEMAPHORE_ID )
+        if not semaphore:
+            semaphore = WorkerSemaphore( id=DUPLICATES_SEMAPHORE_ID )
+            db.session.add( semaphore )
+        semaphore.timestamp = int( time.time() )
+        semaphore.progress = len( groups )
+        semaphore.note = str( version )
+        db.session.commit()
+
+        return groups
+
+    @staticmethod
+    def stored_status():
+
+        ''' Return when the stored groups were found (or None if they never
+        have been) and whether items have been written since. '''
+
+        semaphore = db.session.query( WorkerSemaphore ) \
+            .get( DUPLICATES_SEMAPHORE_ID )
+        if not semaphore:
+            return None, True
+        return semaphore.timestamp, \
+            str( DataVersion.get( DataVersion.ITEMS ) ) != semaphore.note
+
+    @staticmethod
+    def stored_page( user_id, offset, limit ):
+
+        ''' Return the number of stored groups with at least two items the
+        user may access, and a page of them (lists of those item IDs). '''
+
+        group_ids = DuplicateFinder.secure(
+            db.session.query( DuplicateItem.group_id ) \
+                .join( Item, DuplicateItem.item_id == Item.id ),
+            user_id ) \
+            .group_by( DuplicateItem.group_id ) \
+            .having( func.count( DuplicateItem.item_id ) > 1 )
+
+        total = group_ids.count()
+        page_ids = [r[0] for r in group_ids \
+            .order_by( DuplicateItem.group_id ) \
+            .offset( offset ) \
+            .limit( limit )]
+        if not page_ids:
+            return total, []
+
+        groups = {}
+        for group_id, item_id in DuplicateFinder.secure(
+            db.session.query( DuplicateItem.group_id, DuplicateItem.item_id ) \
+                .join( Item, DuplicateItem.item_id == Item.id ),
+            user_id ) \
+            .filter( DuplicateItem.group_id.in_( page_ids ) ) \
+            .order_by( DuplicateItem.item_id ):
+            groups.setdefault( group_id, [] ).append( item_id )
+
+        return total, [groups[g] for g in page_ids]
+
+    @staticmethod
+    def describe( groups ):
+
+        ''' Return a JSON-friendly list describing the given groups, with
+        all of their items loaded in one query. '''
+
+        item_ids = [i for g in groups for i in g]
+        rows = {}
+        if item_ids:
+            rows = {r[0]: r for r in db.session.query(
+                Item.id, Item.size, Library.machine_name, Folder.path,
+                Item.name ) \
+                .join( Folder, Item.folder_id == Folder.id ) \
+                .join( Library, Folder.library_id == Library.id ) \
+                .filter( Item.id.in_( item_ids ) )}
+
+        return [{
+            'size': rows[group[0]][1] if group[0] in rows else None,
+            'items': [{
+                'id': item_id,
+                'path': '/'.join( rows[item_id][2:] )
+            } for item_id in group if item_id in rows]
+        } for group in groups]
@@ -4,8 +4,8 @@ import stat
 import errno
 from datetime import datetime
 from flask import current_app, url_for, render_template
-from sqlalchemy import func
-from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy import func, event
+from sqlalchemy.orm import Session
 from PIL import Image
 from cloud_on_film.models import \
     db, \
@@ -44,73 +44,63 @@ class Picture( Item ):
         'polymorphic_identity': MACHINE_NAME
     }
 
-    @declared_attr
-    def width( self ):
-        return db.column_property(
-            db.select(
-                [db.cast( ItemMeta.value, db.Integer )],
-                db.and_(
-                    ItemMeta.key == 'width',
-                    ItemMeta.item_id == self.id ) ).label( 'width' ) )
-
-    @declared_attr
-    def height( self ):
-
-        ''' Convenience access for meta['height']. '''
-
-        return db.column_property(
-            db.select(
-                [db.cast( ItemMeta.value, db.Integer )],
-                db.and_(
-                    ItemMeta.key == 'height',
-                    ItemMeta.item_id == self.id ) ).label( 'height' ) )
-
-    @declared_attr
-    def rating( self ):
-
-        ''' Convenience access for meta['rating']. '''
-
-        return db.column_property(
-            db.case( [
-                (db.select( [func.count( ItemMeta.value )],
-                db.and_( # See if there's a meta['rating'] row.
-                    ItemMeta.key == 'rating',
-                    ItemMeta.item_id == self.id ) ).label( 'rating' ) == 1,
-                (db.select( [db.cast( ItemMeta.value, db.Integer )],
-                db.and_( # Return int( meta['rating'] ) if such a row exists.
-                    ItemMeta.key == 'rating',
-                    ItemMeta.item_id == self.id ) ).label( 'rating' )))
-            ], else_=0 ) )
-
-    @declared_attr
-    def comment( self ):
-
-        ''' Convenience access for meta['comment']. '''
-
-        return db.column_property(
-            db.case( [
-                (db.select( [func.count( ItemMeta.value )],
-                db.and_( # See if there's a meta['rating'] row.
-                    ItemMeta.key == 'comment',
-                    ItemMeta.item_id == self.id ) ).label( 'comment' ) != None,
-                (db.select( [ItemMeta.value],
-                db.and_( # Return int( meta['rating'] ) if such a row exists.
-                    ItemMeta.key == 'comment',
-                    ItemMeta.item_id == self.id ) ).label( 'comment' )))
-            ], else_=None ) )
-
-    @declared_attr
-    def aspect( self ):
-
-        ''' Convenience access for meta['aspect']. '''
-
-        return db.column_property(
-            db.case( [
-                (16.0 * self.height.expression / self.width == 10.0, 10),
-                (16.0 * self.height.expression / self.width == 9.0, 9),
-                (4.0 * self.height.expression / self.width == 3.0, 4),
-                (self.height.expression == self.width, 1),
-            ], else_=0 ).label( 'aspect' ) )
+    # Copies of meta values kept as plain columns on the items row, so
+    # listing and searching pictures needs no subqueries into item_meta.
+    # meta stays authoritative; sync_meta_columns() keeps these in step.
+    width = db.Column( db.Integer, index=True, unique=False, nullable=True )
+    height = db.Column( db.Integer, index=True, unique=False, nullable=True )
+    rating = db.Column( db.Integer, index=True, unique=False,
+        nullable=False, default=0, server_default='0' )
+    comment = \
+        db.Column( db.String( 256 ), index=False, unique=False, nullable=True )
+    aspect = db.Column( db.Integer, index=True, unique=False,
+        nullable=False, default=0, server_default='0' )
+
+    # Meta keys mirrored by the columns above.
+    META_COLUMNS = ('width', 'height', 'rating', 'comment')
+
+    @staticmethod
+    def sync_meta_columns( connection, item_ids=None ):
+
+        ''' Copy meta values into the denormalized columns of the given
+        pictures (or all of them) with two UPDATE statements. '''
+
+        items = Item.__table__
+
+        def meta_value( key, cast=None ):
+            value = ItemMeta.value if not cast else db.cast( ItemMeta.number, cast )
+            return db.select( [value] ) \
+                .where( db.and_(
+                    ItemMeta.item_id == items.c.id,
+                    ItemMeta.key == key ) ) \
+                .limit( 1 ) \
+                .as_scalar()
+
+        where = items.c.plugin == MACHINE_NAME
+        if item_ids is not None:
+            item_ids = list( item_ids )
+            if not item_ids:
+                return
+            where = db.and_( where, items.c.id.in_( item_ids ) )
+
+        connection.execute( items.update().where( where ).values( {
+            items.c.width: meta_value( 'width', db.Integer ),
+            items.c.height: meta_value( 'height', db.Integer ),
+            items.c.rating: func.coalesce(
+                meta_value( 'rating', db.Integer ), 0 ),
+            items.c.comment: meta_value( 'comment' ) } ) )
+
+        # Aspect depends on the values just written, so it goes second.
+        width = items.c.width
+        height = items.c.height
+        connection.execute( items.update().where( where ).values( {
+            items.c.aspect: db.case( [
+                (db.or_( width == None, height == None, width == 0 ), 0),
+                (16.0 * height / width == 10.0, 10),
+                (16.0 * height / width == 9.0, 9),
+                (4.0 * height / width == 3.0, 4),
+                (height == width, 1),
+            ], else_=0 ) } ) )
 
     def to_dict( self, ignore_keys=None, max_depth=-1 ):
         dict_out = super().to_dict( ignore_keys, max_depth )
@@ -167,32 +157,40 @@ class Picture( Item ):
                 errno.ENOENT, os.strerror(errno.ENOENT), self.absolute_path )
         return img_out
 
+    @staticmethod
+    def probe( absolute_path ):
+
+        ''' Read the picture dimensions and perceptual hash. '''
+
+        from cloud_on_film.similarity import perceptual_hash
+
+        with Image.open( absolute_path ) as im:
+            meta_out = {'width': im.size[0], 'height': im.size[1]}
+            meta_out['phash'] = perceptual_hash( im )
+        return meta_out
+
     def thumbnail_mime( self ):
         return 'image/jpeg'
 
-    def thumbnail_path( self, size ):
+    def thumbnail_path( self, size, generate=True ):
+
+        ''' Return the path to this picture's thumbnail of the given size,
+        rendering it now if it is missing and generate is set. '''
+
+        from cloud_on_film.thumbnails import store, render_thumbnails
 
         # Safety checks should be performed by the caller.
-        if not os.path.exists( current_app.config['THUMBNAIL_PATH'] ):
-            os.makedirs( current_app.config['THUMBNAIL_PATH'] )
-
-        thumb_path = os.path.join(
-            current_app.config['THUMBNAIL_PATH'],
-            '{}_{}x{}.jpg'.format( self.hash, size[0], size[1] ) )
-
-        if not os.path.exists( thumb_path ):
-            with Image.open( self.absolute_path ) as im:
-                try:
-                    im.thumbnail( size, Image.LANCZOS )
-                except OSError as e:
-                    current_app.logger.warn(
-                        'while generating thumbnail for %s: %s',
-                        self.absolute_path, e )
-                thumb = Image.new( 'RGB', size, (0, 0, 0) )
-                thumb.paste( im,
-                    (int( (size[0] - im.size[0]) / 2 ),
-                    int( (size[1] - im.size[1]) / 2 )) )
-                thumb.save( thumb_path, quality=75 )
+        thumb_path = store().path( self.hash, size )
+
+        if generate and not os.path.exists( thumb_path ):
+            error = render_thumbnails(
+                self.absolute_path, [(size, thumb_path)] )
+            if error:
+                current_app.logger.warn(
+                    'while generating thumbnail for %s: %s',
+                    self.absolute_path, error )
+            else:
+                store().record( [thumb_path] )
 
         return thumb_path
 
@@ -218,11 +216,11 @@ class Picture( Item ):
             db.session.add( picture )
             db.session.commit()
 
-        if 'width' not in picture.meta or 'height' not in picture.meta:
-            with Image.open( picture.absolute_path ) as im:
-                print( im.size )
-                picture.meta['width'] = im.size[0]
-                picture.meta['height'] = im.size[1]
+        if 'width' not in picture.meta or \
+        'height' not in picture.meta or \
+        'phash' not in picture.meta:
+            for key, value in Picture.probe( picture.absolute_path ).items():
+                picture.meta[key] = str( value )
             db.session.commit()
 
             current_app.logger.info( 'found new image with size: {}x{}'.format(
@@ -258,25 +256,53 @@ class Picture( Item ):
         html_out = render_template( 'file_card_picture.html.j2', **self_dict )
         return html_out
 
-plugin = db.session.query( Plugin ) \
-    .filter( Plugin.machine_name == MACHINE_NAME ) \
-    .first()
-
-if not plugin:
-    plugin = Plugin(
-        machine_name=MACHINE_NAME,
-        display_name='Pictures',
-        module_path='cloud_on_film.files.picture',
-        model_name='Picture',
-        enabled=True )
-    db.session.add( plugin )
-    db.session.commit()
-
-    plugin.extensions['jpg'] = 'image/jpeg'
-    plugin.extensions['jpeg'] = 'image/jpeg'
-    plugin.extensions['gif'] = 'image/gif'
-    plugin.extensions['png'] = 'image/png'
-    plugin.extensions['bmp'] = 'image/bmp'
-    plugin.extensions['ico'] = 'image/ico'
-
-    db.session.commit()
+@event.listens_for( Session, 'after_flush' )
+def picture_after_flush( session, flush_context ):
+
+    ''' Resync the columns of pictures whose mirrored meta changed. '''
+
+    item_ids = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance( obj, ItemMeta ) and obj.key in Picture.META_COLUMNS:
+            item_ids.add( obj.item_id if obj.item_id else obj.item.id )
+
+    if not item_ids:
+        return
+
+    Picture.sync_meta_columns( session.connection(), item_ids )
+
+    # Loaded pictures must reread the values written behind their back.
+    for obj in session.identity_map.values():
+        if isinstance( obj, Picture ) and obj.id in item_ids:
+            session.expire( obj, ['width', 'height', 'rating', 'comment',
+                'aspect'] )
+
+def register_plugin():
+
+    ''' Make sure this plugin and its file extensions are present in the
+    plugins table. '''
+
+    plugin = db.session.query( Plugin ) \
+        .filter( Plugin.machine_name == MACHINE_NAME ) \
+        .first()
+
+    if not plugin:
+        plugin = Plugin(
+            machine_name=MACHINE_NAME,
+            display_name='Pictures',
+            module_path='cloud_on_film.files.picture',
+            model_name='Picture',
+            enabled=True )
+        db.session.add( plugin )
+        db.session.commit()
+
+        plugin.extensions['jpg'] = 'image/jpeg'
+        plugin.extensions['jpeg'] = 'image/jpeg'
+        plugin.extensions['gif'] = 'image/gif'
+        plugin.extensions['png'] = 'image/png'
+        plugin.extensions['bmp'] = 'image/bmp'
+        plugin.extensions['ico'] = 'image/ico'
+
+        db.session.commit()
+
+    return plugin
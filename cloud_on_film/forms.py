@@ -100,7 +100,7 @@ class SearchQueryForm( FlaskForm, COFBaseFormMixin ):
     search = SubmitField( 'Search' )
     #save_as = StringField( 'Query Name', dropdown=True, validators=[RequiredIf( save=True )] )
     #save = SubmitField( 'Save', dropdown=True )
-    page = HiddenField( '' )
+    after = HiddenField( '' )
 
 class SearchDeleteForm( FlaskForm, COFBaseFormMixin ):
 
@@ -0,0 +1,329 @@
+import re
+from abc import ABC, abstractmethod
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .models import db, Item, ItemMeta, Tag, items_tags
+
+FULLTEXT_TABLE = 'items_fulltext'
+
+# The parts of an item that are indexed, in the order they are stored.
+FULLTEXT_FIELDS = ('name', 'comment', 'tags')
+
+COMMENT_META_KEY = 'comment'
+
+FULLTEXT_BATCH_SIZE = 500
+
+# A search term: a word, optionally ending in * to match it as a prefix.
+TERM_PATTERN = re.compile( r'(\w+)(\*?)' )
+
+class FullTextIndex( ABC ):
+
+    ''' A full-text index of item names, comments and tag paths, kept in a
+    table of its own next to items. Subclasses store and query it with a
+    particular database's full-text features. '''
+
+    @staticmethod
+    def terms( text ):
+
+        ''' Return the (word, prefix) terms in a search string. Everything
+        but words is dropped, so a user can never inject query syntax. '''
+
+        return [(word.lower(), bool( star ))
+            for word, star in TERM_PATTERN.findall( str( text ) )]
+
+    def exists( self, connection ):
+        return connection.dialect.has_table( connection, FULLTEXT_TABLE )
+
+    @abstractmethod
+    def create( self, connection ):
+        pass
+
+    def drop( self, connection ):
+        connection.execute( 'DROP TABLE IF EXISTS {}'.format( FULLTEXT_TABLE ) )
+
+    @abstractmethod
+    def remove( self, connection, item_ids ):
+        pass
+
+    @abstractmethod
+    def insert( self, connection, documents ):
+        pass
+
+    @abstractmethod
+    def match( self, text, field=None ):
+
+        ''' Return a select of the IDs of items matching every term in text,
+        in field or in any field. '''
+
+    @abstractmethod
+    def ranked( self, text, field=None, limit=20 ):
+
+        ''' Return a select of (item ID, score) for the best limit matches
+        of text, best first. '''
+
+    def update( self, connection, item_ids ):
+
+        ''' Reindex the given items, dropping any that no longer exist. '''
+
+        item_ids = list( item_ids )
+        for idx in range( 0, len( item_ids ), FULLTEXT_BATCH_SIZE ):
+            batch = item_ids[idx:idx + FULLTEXT_BATCH_SIZE]
+            self.remove( connection, batch )
+            documents = self.documents( connection, batch )
+            if documents:
+                self.insert( connection, documents )
+
+    def rebuild( self, connection ):
+
+        ''' Reindex every item. Return the number indexed. '''
+
+        connection.execute( 'DELETE FROM {}'.format( FULLTEXT_TABLE ) )
+        item_ids = [r[0] for r in connection.execute(
+            db.select( [Item.id] ).order_by( Item.id ) )]
+        self.update( connection, item_ids )
+        return len( item_ids )
+
+    @staticmethod
+    def documents( connection, item_ids ):
+
+        ''' Return a list of {id, name, comment, tags} for the given items. '''
+
+        documents = {r[0]: {'id': r[0], 'name': r[1], 'comment': '',
+            'tags': []} for r in connection.execute(
+                db.select( [Item.id, Item.name] ) \
+                .where( Item.id.in_( item_ids ) ) )}
+        if not documents:
+            return []
+
+        for item_id, comment in connection.execute(
+            db.select( [ItemMeta.item_id, ItemMeta.value] ) \
+            .where( ItemMeta.key == COMMENT_META_KEY ) \
+            .where( ItemMeta.item_id.in_( item_ids ) )
+        ):
+            documents[item_id]['comment'] = comment or ''
+
+        for item_id, path in connection.execute(
+            db.select( [items_tags.c.items_id, Tag.path] ) \
+            .select_from( items_tags.join(
+                Tag.__table__, items_tags.c.tags_id == Tag.id ) ) \
+            .where( items_tags.c.items_id.in_( item_ids ) )
+        ):
+            if item_id in documents:
+                documents[item_id]['tags'].append( path or '' )
+
+        for document in documents.values():
+            document['tags'] = '\n'.join( document['tags'] )
+        return list( documents.values() )
+
+class SQLiteFullTextIndex( FullTextIndex ):
+
+    ''' An FTS5 virtual table whose rowids are item IDs. '''
+
+    table = db.table( FULLTEXT_TABLE, db.column( 'rowid' ),
+        *[db.column( f ) for f in FULLTEXT_FIELDS] )
+
+    def create( self, connection ):
+        connection.execute( 'CREATE VIRTUAL TABLE IF NOT EXISTS {} ' \
+            'USING fts5( {}, tokenize="unicode61 remove_diacritics 2" )' \
+            .format( FULLTEXT_TABLE, ', '.join( FULLTEXT_FIELDS ) ) )
+
+    def remove( self, connection, item_ids ):
+        connection.execute( self.table.delete() \
+            .where( self.table.c.rowid.in_( item_ids ) ) )
+
+    def insert( self, connection, documents ):
+        connection.execute( self.table.insert(), [dict(
+            rowid=d['id'], **{f: d[f] for f in FULLTEXT_FIELDS} )
+            for d in documents] )
+
+    def query( self, text, field=None ):
+        phrases = ['"{}"{}'.format( word, '*' if prefix else '' )
+            for word, prefix in self.terms( text )]
+        if field:
+            phrases = ['{{{}}} : {}'.format( field, p ) for p in phrases]
+        return ' AND '.join( phrases )
+
+    def _matches( self, text, field ):
+        return db.literal_column( FULLTEXT_TABLE ) \
+            .op( 'MATCH' )( self.query( text, field ) )
+
+    def match( self, text, field=None ):
+        return db.select( [self.table.c.rowid] ) \
+            .where( self._matches( text, field ) )
+
+    def ranked( self, text, field=None, limit=20 ):
+        # bm25() is lower for better matches.
+        score = db.func.bm25( db.literal_column( FULLTEXT_TABLE ) )
+        return db.select( [self.table.c.rowid, score] ) \
+            .where( self._matches( text, field ) ) \
+            .order_by( score ) \
+            .limit( limit )
+
+class PostgresFullTextIndex( FullTextIndex ):
+
+    ''' A table of one tsvector per item, under a GIN index. Fields are
+    told apart by weight: A for the name, B the comment and C the tags. '''
+
+    CONFIG = 'simple'
+
+    WEIGHTS = {'name': 'A', 'comment': 'B', 'tags': 'C'}
+
+    table = db.table( FULLTEXT_TABLE,
+        db.column( 'item_id' ), db.column( 'document' ) )
+
+    def create( self, connection ):
+        connection.execute( 'CREATE TABLE IF NOT EXISTS {0} ( ' \
+            'item_id INTEGER PRIMARY KEY ' \
+            'REFERENCES items ( id ) ON DELETE CASCADE, ' \
+            'document TSVECTOR NOT NULL )'.format( FULLTEXT_TABLE ) )
+        connection.execute( 'CREATE INDEX IF NOT EXISTS ix_{0}_document ' \
+            'ON {0} USING GIN ( document )'.format( FULLTEXT_TABLE ) )
+
+    def remove( self, connection, item_ids ):
+        connection.execute( self.table.delete() \
+            .where( self.table.c.item_id.in_( item_ids ) ) )
+
+    def insert( self, connection, documents ):
+        document = None
+        for field in FULLTEXT_FIELDS:
+            vector = db.func.setweight( db.func.to_tsvector( self.CONFIG,
+                db.bindparam( 'doc_' + field ) ), self.WEIGHTS[field] )
+            document = vector if document is None \
+                else document.op( '||' )( vector )
+        connection.execute( self.table.insert().values(
+            item_id=db.bindparam( 'doc_id' ), document=document ),
+            [{'doc_' + k: v for k, v in d.items()} for d in documents] )
+
+    def query( self, text, field=None ):
+        weight = self.WEIGHTS[field] if field else ''
+        return ' & '.join( '{}:{}{}'.format( word, '*' if prefix else '',
+            weight ) for word, prefix in self.terms( text ) )
+
+    def _tsquery( self, text, field ):
+        return db.func.to_tsquery( self.CONFIG, self.query( text, field ) )
+
+    def match( self, text, field=None ):
+        return db.select( [self.table.c.item_id] ) \
+            .where( self.table.c.document.op( '@@' )(
+                self._tsquery( text, field ) ) )
+
+    def ranked( self, text, field=None, limit=20 ):
+        tsquery = self._tsquery( text, field )
+        score = db.func.ts_rank( self.table.c.document, tsquery )
+        return db.select( [self.table.c.item_id, score] ) \
+            .where( self.table.c.document.op( '@@' )( tsquery ) ) \
+            .order_by( score.desc() ) \
+            .limit( limit )
+
+FULLTEXT_BACKENDS = {
+    'sqlite': SQLiteFullTextIndex,
+    'postgresql': PostgresFullTextIndex
+}
+
+def index_for( bind ):
+
+    ''' Return the FullTextIndex for an engine or connection's database, or
+    None if it has no full-text backend. '''
+
+    backend = FULLTEXT_BACKENDS.get( bind.dialect.name )
+    return backend() if backend else None
+
+def update_items( connection, item_ids ):
+
+    ''' Reindex the given items, for writes that bypass the session (e.g.
+    bulk inserts). Does not commit. '''
+
+    index = index_for( connection )
+    if index and item_ids:
+        index.update( connection, item_ids )
+
+@event.listens_for( Item.__table__, 'after_create' )
+def fulltext_after_create( target, connection, **kw ):
+    index = index_for( connection )
+    if index:
+        index.create( connection )
+
+@event.listens_for( Item.__table__, 'before_drop' )
+def fulltext_before_drop( target, connection, **kw ):
+    index = index_for( connection )
+    if index:
+        index.drop( connection )
+
+def tagged_items( connection, tag_ids ):
+
+    ''' Return the IDs of items tagged with any of tag_ids or with any of
+    their descendants, which are found by path. '''
+
+    tag_ids = list( tag_ids )
+    subtrees = [Tag.subtree_filter( r[0] ) for r in connection.execute(
+        db.select( [Tag.path] ).where( Tag.id.in_( tag_ids ) ) ) if r[0]]
+    tags = db.select( [Tag.id] ) \
+        .where( db.or_( Tag.id.in_( tag_ids ), *subtrees ) )
+    return set( r[0] for r in connection.execute(
+        db.select( [items_tags.c.items_id] ) \
+        .where( items_tags.c.tags_id.in_( tags ) ) ) )
+
+@event.listens_for( Session, 'before_flush' )
+def fulltext_before_flush( session, flush_context, instances ):
+
+    ''' Note the items of tags about to be deleted. The flush deletes their
+    items_tags rows, so after_flush can no longer find them. '''
+
+    tag_ids = set( obj.id for obj in session.deleted
+        if isinstance( obj, Tag ) and obj.id is not None )
+    if not tag_ids:
+        return
+
+    connection = session.connection()
+    if index_for( connection ):
+        session.info.setdefault( 'fulltext_item_ids', set() ).update(
+            tagged_items( connection, tag_ids ) )
+
+@event.listens_for( Session, 'after_flush' )
+def fulltext_after_flush( session, flush_context ):
+
+    ''' Reindex items whose name, comment or tags were written. '''
+
+    item_ids = session.info.pop( 'fulltext_item_ids', set() )
+    tag_ids = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance( obj, Item ):
+            state = db.inspect( obj )
+            if obj in session.new or obj in session.deleted or \
+            state.attrs.name.history.has_changes() or \
+            state.attrs.tags.history.has_changes():
+                item_ids.add( obj.id )
+        elif isinstance( obj, ItemMeta ) and COMMENT_META_KEY == obj.key:
+            if obj.item_id:
+                item_ids.add( obj.item_id )
+            elif obj.item:
+                item_ids.add( obj.item.id )
+            else:
+                # An orphan removed from its item's meta.
+                item_ids.update(
+                    db.inspect( obj ).attrs.item_id.history.deleted )
+        elif isinstance( obj, Tag ) and obj not in session.new:
+            # A renamed or moved tag changes its descendants' paths, too.
+            # Tagging an item also dirties the tag, but not these.
+            # Deleted tags were handled in fulltext_before_flush().
+            state = db.inspect( obj )
+            if obj not in session.deleted and (
+            state.attrs.name.history.has_changes() or
+            state.attrs.parent_id.history.has_changes() ):
+                tag_ids.add( obj.id )
+
+    item_ids.discard( None )
+    if not item_ids and not tag_ids:
+        return
+
+    connection = session.connection()
+    index = index_for( connection )
+    if not index:
+        return
+
+    if tag_ids:
+        item_ids |= tagged_items( connection, tag_ids )
+
+    index.update( connection, item_ids )
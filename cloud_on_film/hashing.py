@@ -0,0 +1,115 @@
+import hashlib
+import logging
+from enum import Enum
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Large reads keep syscall and interpreter overhead negligible next to the
+# hashing itself; hashlib releases the GIL for updates this size.
+HASH_BUFFER_SIZE = 1024 * 1024
+
+class HashEnum( Enum ):
+    md5 = 1
+    sha128 = 2
+    sha256 = 3
+    blake2b = 4
+    xxh64 = 5
+
+class HashAlgoException( Exception ):
+    pass
+
+def _hasher_for( hash_algo ):
+
+    hash_algo = HashEnum( hash_algo )
+
+    if HashEnum.md5 == hash_algo:
+        return hashlib.md5()
+    elif HashEnum.sha128 == hash_algo:
+        # There is no 128-bit SHA, so this is taken to mean SHA-1.
+        return hashlib.sha1()
+    elif HashEnum.sha256 == hash_algo:
+        return hashlib.sha256()
+    elif HashEnum.blake2b == hash_algo:
+        return hashlib.blake2b()
+    elif HashEnum.xxh64 == hash_algo:
+        if not xxhash:
+            raise HashAlgoException( 'xxh64 requires the xxhash module' )
+        return xxhash.xxh64()
+
+    raise HashAlgoException( 'unsupported hash: {}'.format( hash_algo ) )
+
+def hash_file( absolute_path, hash_algo=1, length=None ):
+
+    ''' Return the hex digest of the given file using the HashEnum (or its
+    integer value) hash_algo. If length is given, only hash that many bytes
+    from the start of the file. '''
+
+    hash_out = _hasher_for( hash_algo )
+    buf = bytearray( min( length, HASH_BUFFER_SIZE ) \
+        if length else HASH_BUFFER_SIZE )
+    view = memoryview( buf )
+    remaining = length
+    with open( absolute_path, 'rb', buffering=0 ) as file_f:
+        read_len = file_f.readinto( buf )
+        while read_len:
+            if remaining is not None:
+                read_len = min( read_len, remaining )
+                remaining -= read_len
+            hash_out.update( view[:read_len] )
+            if 0 == remaining:
+                break
+            read_len = file_f.readinto( buf )
+    return hash_out.hexdigest()
+
+def _hash_file_or_none( args ):
+    absolute_path, hash_algo, length = args
+    try:
+        return hash_file( absolute_path, hash_algo, length )
+    except (OSError, IOError) as e:
+        logging.getLogger( 'hashing' ).warning(
+            'unable to hash %s: %s', absolute_path, e )
+        return None
+
+class BulkHasher( object ):
+
+    ''' Hashes files across a pool of worker processes. Use as a context
+    manager so the pool is shut down afterwards. '''
+
+    def __init__( self, hash_algo=1, workers=None, chunksize=8 ):
+        self.hash_algo = getattr( hash_algo, 'value', hash_algo )
+        self.workers = workers
+        self.chunksize = chunksize
+        self.pool = None
+
+        # Fail early rather than in every worker.
+        _hasher_for( self.hash_algo )
+
+    def __enter__( self ):
+        self.pool = ProcessPoolExecutor( max_workers=self.workers )
+        return self
+
+    def __exit__( self, *args ):
+        self.pool.shutdown()
+        self.pool = None
+
+    def submit( self, absolute_path ):
+
+        ''' Queue a single file, returning a future for its digest (or None
+        if it could not be read). '''
+
+        return self.pool.submit(
+            _hash_file_or_none, (absolute_path, self.hash_algo, None) )
+
+    def hash( self, absolute_paths, length=None ):
+
+        ''' Hash a batch of files (or only their first length bytes),
+        returning a list of digests (or None for unreadable files) in the
+        same order as absolute_paths. '''
+
+        return list( self.pool.map( _hash_file_or_none,
+            [(p, self.hash_algo, length) for p in absolute_paths],
+            chunksize=self.chunksize ) )
@@ -1,132 +1,661 @@
-
+import codecs
+import itertools
+import json
 import logging
-import re
 import os
 import stat
-import hashlib
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
 from datetime import datetime
-from PIL import Image
-from .models import InvalidFolderException, db, HashEnum, Folder, Item, Tag, Library
-#from .files.picture import Picture
+from .models import \
+    db, \
+    DataVersion, \
+    Folder, \
+    HashEnum, \
+    ImportJob, \
+    InvalidFolderException, \
+    Item, \
+    ItemMeta, \
+    JobStatusEnum, \
+    Library, \
+    LibraryRootException, \
+    Tag, \
+    WorkerSemaphore, \
+    items_tags
+from .hashing import hash_file
+from .fulltext import update_items
+from . import thumbnails
 from threading import Thread
 
+IMPORT_BATCH_SIZE = 500
+
+# Bytes read from an import file at a time.
+IMPORT_READ_SIZE = 1024 * 1024
+
+# The most one record may take up (in characters) before the file is taken
+# to be malformed, rather than read on until its end.
+IMPORT_MAX_RECORD_BYTES = 4 * 1024 * 1024
+
+# Only the first few failures are kept for reporting; the rest are logged.
+IMPORT_MAX_ERRORS = 100
+
+# Running jobs whose worker has not checkpointed for this long (e.g. it was
+# killed) are resumed by the next worker.
+IMPORT_STALE_SECONDS = 600
+
 class ItemImportException( Exception ):
     pass
 
-class ItemImportThread( Thread ):
-    def __init__( self, pictures, app ):
-        self.progress = 0
+class LibraryPrefixMap( object ):
+
+    ''' Finds the library holding an absolute path: the one whose own path
+    is the longest prefix of it. Built once, so each lookup is a few dict
+    probes rather than a pass over every library. '''
+
+    def __init__( self, libraries ):
+        self.library_ids = {os.path.normpath( lib.absolute_path ): lib.id
+            for lib in libraries}
+
+    def find( self, absolute_path ):
+
+        ''' Return (library ID, path relative to the library), or (None,
+        None) if no library holds absolute_path. '''
+
+        absolute_path = os.path.normpath( absolute_path )
+        head = os.path.dirname( absolute_path )
+        while True:
+            # Walking up from the file, the first match is the longest.
+            library_id = self.library_ids.get( head )
+            if library_id:
+                return library_id, os.path.relpath( absolute_path, head )
+            parent = os.path.dirname( head )
+            if parent == head:
+                return None, None
+            head = parent
+
+def read_picture( absolute_path, hash_algo ):
+
+    ''' Stat and hash a picture and compute its perceptual hash, which also
+    checks that it can be decoded. Runs in the worker processes, so this
+    must not touch the app or the DB. Returns (stat result, probed meta,
+    file hash) or None. '''
+
+    from .files.picture import Picture
+
+    try:
+        return os.stat( absolute_path ), Picture.probe( absolute_path ), \
+            hash_file( absolute_path, hash_algo )
+    except (OSError, IOError) as e:
+        logging.getLogger( 'importing.worker' ).warning(
+            'unable to read %s: %s', absolute_path, e )
+        return None
+
+class ItemImporter( object ):
+
+    ''' Imports picture records exported from the old gallery, each a dict
+    with a filename under some library, a rating, an optional comment,
+    width, height, tag paths and time_created.
+
+    Records are taken from any iterable in batches of batch_size. Each
+    batch resolves its folders and tags once, checks which items already
+    exist in one query, hashes and probes the new files across a pool of
+    worker processes, then bulk-inserts items, meta and tag links and
+    commits once. A failed record is logged and skipped; a batch the
+    database rejects is rolled back, its new records failed, and the
+    import goes on with the next batch.
+
+    If given, on_batch( importer ) is called before each batch commits, so
+    anything it writes to the session is committed along with the batch. '''
+
+    def __init__(
+        self, batch_size=IMPORT_BATCH_SIZE, workers=None,
+        hash_algo=HashEnum.md5, on_batch=None
+    ):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.hash_algo = HashEnum( hash_algo )
+        self.on_batch = on_batch
+        self.logger = logging.getLogger( 'importing' )
+
+        self.libraries = None
+        self.tag_ids = {}
+        self.errors = []
+
         self.filename = ''
-        self.pictures = pictures
+        self.records_seen = 0
+        self.items_added = 0
+        self.items_skipped = 0
+        self.items_failed = 0
+        self.start_time = None
+
+    @property
+    def records_per_sec( self ):
+        elapsed = time.time() - self.start_time if self.start_time else 0
+        return self.records_seen / elapsed if 0 < elapsed else 0.0
+
+    def stats( self ):
+        return {
+            'records_seen': self.records_seen,
+            'items_added': self.items_added,
+            'items_skipped': self.items_skipped,
+            'items_failed': self.items_failed,
+            'elapsed': time.time() - self.start_time,
+            'records_per_sec': self.records_per_sec }
+
+    def run( self, records, pool=None ):
+
+        ''' Import every record, reading files on pool, or on a private
+        process pool if none is given. Return the stats. '''
+
+        if not pool:
+            with ProcessPoolExecutor( max_workers=self.workers ) as pool:
+                return self.run( records, pool )
+
+        self.start_time = time.time()
+        self.libraries = LibraryPrefixMap( Library.enumerate_all( -1 ) )
+
+        batch = []
+        for record in records:
+            batch.append( record )
+            if len( batch ) >= self.batch_size:
+                self._import_batch( pool, batch )
+                batch = []
+        if batch:
+            self._import_batch( pool, batch )
+
+        stats = self.stats()
+        self.logger.info( '%d records imported, %d already present, ' \
+            '%d failed in %.1fs (%.1f records/sec)', stats['items_added'],
+            stats['items_skipped'], stats['items_failed'], stats['elapsed'],
+            stats['records_per_sec'] )
+        return stats
+
+    def _fail( self, record, message ):
+        self.items_failed += 1
+        self.logger.error( message )
+        if IMPORT_MAX_ERRORS > len( self.errors ):
+            self.errors.append( (record.get( 'filename' ) \
+                if isinstance( record, dict ) else None, message) )
+
+    @staticmethod
+    def _invalid( record ):
+
+        ''' Return why record cannot be imported, or None if it can. '''
+
+        if not isinstance( record, dict ):
+            return 'Not a record: {!r}'.format( record )[:256]
+
+        filename = record.get( 'filename' )
+        if not filename or not isinstance( filename, str ):
+            return 'Record has no filename: {!r}'.format( record )[:256]
+
+        try:
+            datetime.fromtimestamp( record['time_created'] )
+        except KeyError:
+            return 'Record has no time_created: {}'.format( filename )
+        except (TypeError, ValueError, OverflowError, OSError):
+            return 'Invalid time_created for: {}'.format( filename )
+
+        # Paths such as "" or "/" name no tag; resolve_paths() skips them.
+        tags = record.get( 'tags', [] )
+        if not isinstance( tags, list ) or \
+        not all( isinstance( t, str ) and Tag.normalize_path( t )
+            for t in tags ):
+            return 'Invalid tags for: {}'.format( filename )
+
+        return None
+
+    def _validate( self, records ):
+
+        ''' Return the records that can be imported, failing the rest. '''
+
+        valid = []
+        for record in records:
+            message = self._invalid( record )
+            if message:
+                self._fail( record, message )
+            else:
+                valid.append( record )
+        return valid
+
+    def _resolve_folders( self, records ):
+
+        ''' Return [(record, folder ID, name)] for the records whose library
+        and folder could be found, resolving each folder once. '''
+
+        folder_ids = {}
+        resolved = []
+        for record in records:
+            library_id, relative_path = \
+                self.libraries.find( record['filename'] )
+            if not library_id:
+                self._fail( record, 'Unable to find library for: {}'.format(
+                    record['filename'] ) )
+                continue
+
+            folder_path = os.path.dirname( relative_path )
+            key = (library_id, folder_path)
+            if key not in folder_ids:
+                try:
+                    # Circumvent user checking.
+                    folder_ids[key] = Folder.from_path(
+                        library_id, folder_path, -1 ).id
+                except (InvalidFolderException, LibraryRootException):
+                    folder_ids[key] = None
+            if not folder_ids[key]:
+                self._fail( record, 'Folder does not exist: {}'.format(
+                    folder_path ) )
+                continue
+
+            resolved.append( (record, folder_ids[key],
+                os.path.basename( relative_path )) )
+
+        return resolved
+
+    def _existing( self, resolved ):
+
+        ''' Return the (folder ID, name) of the records already in the DB. '''
+
+        if not resolved:
+            return set()
+
+        return set( db.session.query( Item.folder_id, Item.name ) \
+            .filter( Item.folder_id.in_( set( r[1] for r in resolved ) ) ) \
+            .filter( Item.name.in_( set( r[2] for r in resolved ) ) ) )
+
+    def _resolve_tags( self, paths ):
+
+        ''' Return {path: tag ID}, creating missing tags. Paths are only
+        looked up once per import, and each batch's new ones together. '''
+
+        missing = [p for p in paths if p not in self.tag_ids]
+        if missing:
+            self.tag_ids.update( Tag.resolve_paths( missing ) )
+        return self.tag_ids
+
+    def _import_batch( self, pool, records ):
+
+        from .files.picture import Picture, MACHINE_NAME
+
+        self.records_seen += len( records )
+        records = self._validate( records )
+        if records:
+            self.filename = records[-1]['filename']
+
+        # Restored if the batch is rolled back, which fails all of it.
+        counts = (self.items_added, self.items_skipped, self.items_failed)
+        errors = len( self.errors )
+
+        try:
+            resolved = self._resolve_folders( records )
+            existing = self._existing( resolved )
+
+            pending = []
+            for record, folder_id, name in resolved:
+                if (folder_id, name) in existing:
+                    self.items_skipped += 1
+                    self.logger.info( 'Item already exists: %s',
+                        record['filename'] )
+                    continue
+                # Also catch the same file twice in one batch.
+                existing.add( (folder_id, name) )
+                pending.append( (record, folder_id, name, pool.submit(
+                    read_picture, record['filename'], self.hash_algo.value )) )
+
+            tag_ids = self._resolve_tags( set(
+                t for p in pending for t in p[0].get( 'tags', [] ) ) )
+
+            items = []
+            metas = []
+            tags = []
+            for record, folder_id, name, read_future in pending:
+                read = read_future.result()
+                if read is None:
+                    self._fail( record, 'Unable to read picture: {}'.format(
+                        record['filename'] ) )
+                    continue
+
+                st, probed, file_hash = read
+                items.append( {
+                    'name': name,
+                    'folder_id': folder_id,
+                    'timestamp': datetime.fromtimestamp( st[stat.ST_MTIME] ),
+                    'size': st[stat.ST_SIZE],
+                    'added': datetime.fromtimestamp( record['time_created'] ),
+                    'hash': file_hash,
+                    'hash_algo': self.hash_algo.value,
+                    'plugin': MACHINE_NAME } )
+
+                meta = {
+                    'rating': record.get( 'rating' ),
+                    'width': record.get( 'width' ) or probed['width'],
+                    'height': record.get( 'height' ) or probed['height'],
+                    'phash': probed['phash'] }
+                if record.get( 'comment' ):
+                    meta['comment'] = record['comment']
+                metas.append( meta )
+
+                tags.append( set(
+                    tag_ids[t] for t in record.get( 'tags', [] ) ) )
+
+            if items:
+                db.session.bulk_insert_mappings(
+                    Item, items, return_defaults=True )
+
+                db.session.bulk_insert_mappings( ItemMeta, [{
+                    'item_id': item['id'],
+                    'key': key,
+                    'value': str( value ),
+                    'number': ItemMeta.number_of( value )
+                } for item, meta in zip( items, metas )
+                    for key, value in meta.items() if value is not None] )
+
+                tag_links = [{'items_id': item['id'], 'tags_id': tag_id}
+                    for item, item_tags in zip( items, tags )
+                    for tag_id in item_tags]
+                if tag_links:
+                    db.session.execute( items_tags.insert(), tag_links )
+
+                # Bulk writes skip the session listeners, so do their work.
+                item_ids = [i['id'] for i in items]
+                connection = db.session.connection()
+                Picture.sync_meta_columns( connection, item_ids )
+                update_items( connection, item_ids )
+                thumbnails.enqueue( item_ids )
+                DataVersion.bump( db.session, DataVersion.ITEMS )
+                DataVersion.bump( db.session, DataVersion.PHASH )
+
+            self.items_added += len( items )
+            if self.on_batch:
+                self.on_batch( self )
+            db.session.commit()
+
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            self.logger.exception( 'batch ending with %s failed',
+                self.filename )
+            self.items_added, self.items_skipped, self.items_failed = counts
+            del self.errors[errors:]
+            for record in records:
+                self._fail( record, 'Unable to store {}: {}'.format(
+                    record['filename'], e )[:256] )
+            return
+
+        except Exception:
+            db.session.rollback()
+            raise
+
+        self.logger.debug( 'imported batch of %d records ending with %s',
+            len( records ), self.filename )
+
+class JSONRecordReader( object ):
+
+    ''' Iterates over the records in a JSON file without loading it whole.
+    The file may hold one JSON array of record objects, as the old gallery
+    exports, or JSON Lines: one record object per line. It is read and
+    decoded read_size bytes at a time, so memory use depends only on the
+    size of the largest record, which may be no more than max_record. '''
+
+    def __init__(
+        self, path, read_size=IMPORT_READ_SIZE,
+        max_record=IMPORT_MAX_RECORD_BYTES
+    ):
+        self.path = path
+        self.read_size = read_size
+        self.max_record = max_record
+        self.size = os.path.getsize( path )
+        self.bytes_read = 0
+
+    @property
+    def progress( self ):
+        if not self.size:
+            return 100
+        return 100 * self.bytes_read / self.size
+
+    def __iter__( self ):
+
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder( 'utf-8' )()
+
+        with open( self.path, 'rb' ) as json_file:
+
+            def read():
+                data = json_file.read( self.read_size )
+                self.bytes_read += len( data )
+                return utf8.decode( data, final=not data ), not data
+
+            buf, eof = read()
+            pos = 0
+            in_array = None
+            while True:
+                # Skip to the start of the next value.
+                while pos < len( buf ) and \
+                (buf[pos].isspace() or (in_array and ',' == buf[pos])):
+                    pos += 1
+                if pos >= len( buf ):
+                    if eof:
+                        break
+                    buf, eof = read()
+                    pos = 0
+                    continue
+
+                if in_array is None:
+                    in_array = '[' == buf[pos]
+                    if in_array:
+                        pos += 1
+                        continue
+                elif in_array and ']' == buf[pos]:
+                    break
+
+                try:
+                    record, end = decoder.raw_decode( buf, pos )
+                except ValueError as e:
+                    if eof or len( buf ) - pos > self.max_record:
+                        raise ItemImportException( 'Invalid JSON in {}: {}' \
+                            .format( self.path, e ) ) from e
+                    # The record runs past the end of what has been read.
+                    more, eof = read()
+                    buf = buf[pos:] + more
+                    pos = 0
+                    continue
+
+                if not isinstance( record, dict ):
+                    raise ItemImportException(
+                        'Expected a record object in {} at character {}' \
+                        .format( self.path, pos ) )
+
+                pos = end
+                yield record
+
+def spool_upload( upload ):
+
+    ''' Copy an uploaded file to the import spool directory in chunks and
+    return the path it was saved to. '''
+
+    spool_path = current_app.config['IMPORT_SPOOL_PATH']
+    os.makedirs( spool_path, exist_ok=True )
+    path = os.path.join( spool_path, '{}.json'.format( uuid.uuid4().hex ) )
+    upload.save( path, buffer_size=IMPORT_READ_SIZE )
+    return path
+
+class ImportWorker( object ):
+
+    ''' Works through the import job queue. Several workers (in the web
+    processes or the import-worker command) may share a queue; jobs are
+    claimed with a conditional update. A running job checkpoints into its
+    WorkerSemaphore after every batch: the semaphore's timestamp is its
+    heartbeat, its progress the percent of the file read and its note the
+    number of records done. A job whose worker stops checkpointing is put
+    back in the queue and resumed from its last checkpoint. A failed job
+    keeps its file and checkpoint, so it can be requeued once the cause
+    is fixed. '''
+
+    def __init__( self, workers=None, batch_size=IMPORT_BATCH_SIZE ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.logger = logging.getLogger( 'importing' )
+        self.done = 0
+        self.failed = 0
+
+    def _reset_stale( self ):
+        stale_before = int( time.time() ) - IMPORT_STALE_SECONDS
+        for job in db.session.query( ImportJob ) \
+        .filter( ImportJob.status == JobStatusEnum.running ):
+            semaphore = db.session.query( WorkerSemaphore ) \
+                .get( job.semaphore_id )
+            if not semaphore or semaphore.timestamp < stale_before:
+                self.logger.warning( 'resuming stale import job %s', job.id )
+                job.status = JobStatusEnum.pending
+        db.session.commit()
+
+    def _claim( self ):
+
+        ''' Mark the oldest pending job as ours and return it with its
+        semaphore, or (None, None) if the queue is empty. '''
+
+        while True:
+            job_id = db.session.query( ImportJob.id ) \
+                .filter( ImportJob.status == JobStatusEnum.pending ) \
+                .order_by( ImportJob.timestamp, ImportJob.id ) \
+                .limit( 1 ) \
+                .scalar()
+            if not job_id:
+                return None, None
+
+            claimed = db.session.query( ImportJob ) \
+                .filter( ImportJob.id == job_id ) \
+                .filter( ImportJob.status == JobStatusEnum.pending ) \
+                .update( {ImportJob.status: JobStatusEnum.running},
+                    synchronize_session=False )
+            if not claimed:
+                # Another worker got there first.
+                db.session.rollback()
+                continue
+
+            job = db.session.query( ImportJob ).get( job_id )
+            db.session.refresh( job )
+            semaphore = db.session.query( WorkerSemaphore ) \
+                .get( job.semaphore_id )
+            if not semaphore:
+                semaphore = WorkerSemaphore( id=job.semaphore_id, progress=0,
+                    note='0' )
+                db.session.add( semaphore )
+            semaphore.timestamp = int( time.time() )
+            db.session.commit()
+            return job, semaphore
+
+    def run_job( self, job, semaphore, pool ):
+
+        ''' Import the records in job's file, from its last checkpoint. '''
+
+        records = JSONRecordReader( job.path )
+        start = int( semaphore.note or 0 )
+        added, skipped, failed = \
+            job.items_added, job.items_skipped, job.items_failed
+
+        def checkpoint( importer ):
+            semaphore.timestamp = int( time.time() )
+            semaphore.progress = int( records.progress )
+            semaphore.note = str( start + importer.records_seen )
+            job.items_added = added + importer.items_added
+            job.items_skipped = skipped + importer.items_skipped
+            job.items_failed = failed + importer.items_failed
+
+        if start:
+            self.logger.info( 'resuming import job %s after %d records',
+                job.id, start )
+
+        try:
+            importer = ItemImporter( self.batch_size, on_batch=checkpoint )
+            importer.run( itertools.islice( records, start, None ), pool )
+            # Failures after the last batch (e.g. a missing library) are
+            # not checkpointed.
+            checkpoint( importer )
+            job.status = JobStatusEnum.done
+            self.done += 1
+        except Exception as e:
+            db.session.rollback()
+            self.logger.exception( 'import job %s failed', job.id )
+            job.status = JobStatusEnum.failed
+            job.note = str( e )[:256]
+            self.failed += 1
+
+        job.timestamp = int( time.time() )
+        if JobStatusEnum.done == job.status:
+            db.session.delete( semaphore )
+        db.session.commit()
+
+        if JobStatusEnum.done == job.status:
+            try:
+                os.remove( job.path )
+            except OSError as e:
+                self.logger.warning( 'unable to remove %s: %s', job.path, e )
+
+    def run( self, pool ):
+
+        ''' Run claimed jobs until the queue is empty. '''
+
+        self._reset_stale()
+
+        job, semaphore = self._claim()
+        while job:
+            self.run_job( job, semaphore, pool )
+            job, semaphore = self._claim()
+
+        return self.done, self.failed
+
+    def process( self ):
+
+        ''' Drain the queue once with a private process pool. '''
+
+        with ProcessPoolExecutor( max_workers=self.workers ) as pool:
+            return self.run( pool )
+
+class ImportWorkerThread( Thread ):
+
+    ''' Drains the import queue from inside a web process, for setups that
+    do not run the import-worker command. '''
+
+    def __init__( self, app ):
         self.app = app
-        super().__init__()
+        super().__init__( daemon=True )
 
     def run( self ):
         with self.app.app_context():
-            self.logger = logging.getLogger(
-                'importing.threads.' + str( self.ident ) )
-
-            pictures_len = len( self.pictures )
-            idx = 0
-            for pic in self.pictures:
-                self.progress = 100 * idx / pictures_len
-                self.filename = pic['filename']
-                try:
-                    picture( pic )
-                except ItemImportException as e:
-                    self.logger.error( e )
-                idx += 1
-
-threads = {}
-
-def start_import_thread( pictures ):
-    id = uuid.uuid1()
-    threads[id.hex] = ItemImportThread(
-        pictures, current_app._get_current_object() )
-    threads[id.hex].start()
-    return id.hex
-
-def picture( picture ):
-
-    logger = logging.getLogger( 'libraries.import.picture' )
-
-    current_uid = -1 # TODO: override current_uid
-
-    # Find matching library.
-    relative_path = None
-    library = None
-    for lib in Library.enumerate_all( -1 ):
-        match = re.match(
-            r'^{}\/(.*)'.format( lib.absolute_path ), picture['filename'] )
-        if match:
-            relative_path = match.groups()[0]
-            library = lib
-            print( relative_path )
-            break
-
-    # Don't accept pictures not in a library.
-    if not library:
-        raise ItemImportException( 'Unable to find library for: {}'.format(
-            picture['filename'] ) )
-
-    # See if this picture's folder exists already.
-
-    # Spelunk into folders starting from the library we found.
-    # Circumvent user checking.
-    folder_relative_path = os.path.dirname( relative_path )
-    try:
-        folder = Folder.from_path( library.id, folder_relative_path, current_uid )
-    except InvalidFolderException:
-        raise ItemImportException( 'Folder does not exist: {}'.format(
-            folder_relative_path ) )
-
-    # See if the picture already exists.
-    name = os.path.basename( picture['filename'] )
-    query = db.session.query( Item ) \
-        .filter( Item.folder_id == folder.id ) \
-        .filter( Item.name == name )
-    if None != query.first():
-        raise ItemImportException(  'Item already exists: {}'.format(
-            picture['filename'] ) )
-
-    # Make sure the picture file exists.
-    if not os.path.exists( picture['filename'] ):
-        raise ItemImportException( 'Item file does not exist: {}'.format(
-            picture['filename'] ) )
-
-    with Image.open( picture['filename'] ) as im:
-        if not im:
-            raise ItemImportException( 'Unable to read picture: {}'.format(
-                picture['filename'] ) )
-
-        st = os.stat( picture['filename'] )
-
-        from .files.picture import Picture
-        pic = Picture(
-            name=name,
-            folder_id=folder.id,
-            timestamp=datetime.fromtimestamp( st[stat.ST_MTIME] ),
-            size=st[stat.ST_SIZE],
-            added=datetime.fromtimestamp( picture['time_created'] ),
-            hash=Item.hash_file( picture['filename'] ),
-            hash_algo=1 )
-        db.session.add( pic )
-        db.session.flush()
-        db.session.refresh( pic )
-
-        pic.tags += [Tag.from_path( t ) for t in picture['tags']]
-
-        if picture['comment']:
-            pic.meta['comment'] = picture['comment']
-
-        pic.meta['rating'] = picture['rating']
-        pic.meta['width'] = picture['width']
-        pic.meta['height'] = picture['height']
+            try:
+                ImportWorker().process()
+            finally:
+                db.session.remove()
+
+def start_import_job( path ):
+
+    ''' Queue the records in the JSON file at path for import, deleting the
+    file when done, and return the new job's ID. Unless the IMPORT_WORKER
+    config is "cli", the job is started in a thread of this process;
+    otherwise it is left for the import-worker command. '''
 
+    job = ImportJob( id=uuid.uuid4().hex, path=path,
+        status=JobStatusEnum.pending, timestamp=int( time.time() ) )
+    db.session.add( job )
     db.session.commit()
 
-    logger.debug( 'Imported picture {} under {}'.format(
-        name, folder.name ) )
+    if 'cli' != current_app.config['IMPORT_WORKER']:
+        ImportWorkerThread( current_app._get_current_object() ).start()
 
+    return job.id
+
+def requeue_import_job( job_id ):
+
+    ''' Put a failed job back in the queue, to be resumed from its last
+    checkpoint. Return False if there is no such failed job. '''
+
+    requeued = db.session.query( ImportJob ) \
+        .filter( ImportJob.id == job_id ) \
+        .filter( ImportJob.status == JobStatusEnum.failed ) \
+        .update( {ImportJob.status: JobStatusEnum.pending,
+            ImportJob.note: None}, synchronize_session=False )
+    db.session.commit()
+    return 0 < requeued
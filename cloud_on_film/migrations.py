@@ -0,0 +1,96 @@
+import logging
+
+from sqlalchemy import inspect
+
+from . import db
+
+def add_missing_columns( connection, table ):
+
+    ''' Add the columns and indexes of table that an existing database is
+    missing. Columns must be nullable or have a server default. Return the
+    names of the columns added. '''
+
+    inspector = inspect( connection )
+    existing = set( c['name'] for c in inspector.get_columns( table.name ) )
+    existing_indexes = \
+        set( i['name'] for i in inspector.get_indexes( table.name ) )
+
+    added = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+
+        ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table.name, column.name,
+            column.type.compile( dialect=connection.dialect ) )
+        if column.server_default is not None:
+            ddl += ' DEFAULT {}'.format( column.server_default.arg )
+        if not column.nullable:
+            ddl += ' NOT NULL'
+        connection.execute( ddl )
+        added.append( column.name )
+
+    for index in table.indexes:
+        if index.name not in existing_indexes:
+            index.create( connection )
+
+    return added
+
+def upgrade():
+
+    ''' Bring an existing database up to the current models: create new
+    tables, add new columns and indexes, and fill any columns that copy
+    meta values. Return a dict of the columns added, by table. '''
+
+    logger = logging.getLogger( 'migrations' )
+
+    from .models import DataVersion, ItemMeta, Tag
+
+    connection = db.session.connection()
+    inspector = inspect( connection )
+    tables = set( inspector.get_table_names() )
+
+    # Older databases could hold a key more than once per item, which the
+    # unique index will not allow.
+    if 'item_meta' in tables and 'ix_item_meta_item_id_key' not in \
+    set( i['name'] for i in inspector.get_indexes( 'item_meta' ) ):
+        removed = ItemMeta.remove_duplicates( connection )
+        if removed:
+            logger.info( 'removed %d duplicate item meta values', removed )
+
+    added = {}
+    for table in db.metadata.sorted_tables:
+        if table.name in tables:
+            columns = add_missing_columns( connection, table )
+            if columns:
+                logger.info( 'added %s to %s', ', '.join( columns ), table.name )
+                added[table.name] = columns
+
+    if 'number' in added.get( 'item_meta', [] ):
+        ItemMeta.sync_numbers( connection )
+
+    if 'path' in added.get( 'tags', [] ):
+        Tag.rebuild_paths( connection )
+
+    if 'data_versions' in tables:
+        DataVersion.create_missing( connection )
+
+    # The full-text index is only created along with a new items table.
+    from .fulltext import index_for, FULLTEXT_TABLE, FULLTEXT_FIELDS
+    index = index_for( connection )
+    if index and 'items' in tables and not index.exists( connection ):
+        index.create( connection )
+        logger.info( 'indexed %d items for full-text search',
+            index.rebuild( connection ) )
+        added[FULLTEXT_TABLE] = list( FULLTEXT_FIELDS )
+
+    db.session.commit()
+    db.create_all()
+
+    if 'items' in added or 'item_meta' in added:
+        from .models import plugin_registry
+        for model in plugin_registry.models().values():
+            model.sync_meta_columns( db.session.connection() )
+        db.session.commit()
+
+    return added
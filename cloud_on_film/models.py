@@ -1,27 +1,52 @@
 
 import os
+import re
 import errno
-import hashlib
 import shutil
 import importlib
+import itertools
+import threading
 from enum import Enum
-from sqlalchemy import func
+from sqlalchemy import func, event
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import Session, validates
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.ext.associationproxy import association_proxy
 
 from flask import current_app
 
 from . import db
-
-class HashEnum( Enum ):
-    md5 = 1
-    sha128 = 2
-    sha256 = 3
+from .cache import LRUCache
+from .hashing import HashEnum, hash_file
 
 class StatusEnum( Enum ):
     missing = 1
 
+class JobStatusEnum( Enum ):
+    pending = 1
+    running = 2
+    done = 3
+    failed = 4
+
+# Meta values that are also stored as numbers.
+NUMBER_PATTERN = re.compile( r'^\s*[-+]?(\d+\.?\d*|\.\d+)\s*$' )
+
+# The meta key perceptual hashes are stored under.
+PHASH_META_KEY = 'phash'
+
+FOLDER_PATH_CACHE_SIZE = 4096
+
+# Maps (library_id, relative path) to folder IDs for Folder.from_path().
+folder_path_cache = LRUCache( FOLDER_PATH_CACHE_SIZE )
+
+TAG_PATH_CACHE_SIZE = 4096
+
+# Maps tag paths to tag IDs for Tag.resolve_paths().
+tag_path_cache = LRUCache( TAG_PATH_CACHE_SIZE )
+
+# Most paths looked up in one IN clause.
+TAG_LOOKUP_BATCH_SIZE = 500
+
 # region exceptions
 
 class InvalidFolderException( Exception ):
@@ -252,7 +277,9 @@ class Library( db.Model, JSONItemMixin ):
 
 items_tags = db.Table( 'items_tags', db.metadata,
     db.Column( 'items_id', db.Integer, db.ForeignKey( 'items.id' ) ),
-    db.Column( 'tags_id', db.Integer, db.ForeignKey( 'tags.id' ) ) )
+    db.Column( 'tags_id', db.Integer, db.ForeignKey( 'tags.id' ) ),
+    # Tag searches go from tag IDs to the items that carry them.
+    db.Index( 'ix_items_tags_tags_id_items_id', 'tags_id', 'items_id' ) )
 
 class TagMeta( db.Model, MetaPropertyMixin ):
 
@@ -287,6 +314,11 @@ class Tag( db.Model ):
     children = db.relationship( 'Tag', backref=db.backref(
         'tag_parent', remote_side=[id] ), viewonly=True )
 
+    # Materialized path (e.g. "Places/Beach"), maintained by the listeners
+    # below so a batch of paths can be resolved with a single query.
+    path = db.Column(
+        db.String( 768 ), index=True, unique=False, nullable=True )
+
     # Tags are a bit different than meta relationships at they're many-to-many.
     _items = db.relationship( 'Item', secondary=items_tags, back_populates='tags' )
 
@@ -299,55 +331,198 @@ class Tag( db.Model ):
     def to_dict( self, *args, **kwargs ):
         return self.path
 
-    @property
-    def path( self ):
+    @staticmethod
+    def build_path( connection, parent_id, name ):
 
-        parent_list = []
-        tag_iter = self
+        ''' Return the materialized path for a tag called name beneath the
+        tag with parent_id, reading the parent's stored path. '''
 
-        # Traverse the folder's parents upwards.
-        while isinstance( tag_iter, Tag ) and tag_iter.name:
-            parent_list.insert( 0, tag_iter.name )
-            tag_iter = tag_iter.parent
+        if not parent_id:
+            return name
 
-        return '/'.join( parent_list )
+        tags = Tag.__table__
+        parent_path = connection.execute(
+            db.select( [tags.c.path] ) \
+                .where( tags.c.id == parent_id ) ).scalar()
+
+        # Tags beneath an unnamed root tag are top-level.
+        return '/'.join( [parent_path, name] ) if parent_path else name
 
     @staticmethod
-    def from_path( path ):
+    def rebuild_paths( connection ):
+
+        ''' Recalculate the materialized path of every tag from the parent
+        chain, for databases that predate the path column. Does not
+        commit. '''
+
+        tags = Tag.__table__
+        rows = {r[0]: (r[1], r[2]) for r in connection.execute(
+            db.select( [tags.c.id, tags.c.name, tags.c.parent_id] ) )}
+
+        paths = {}
+        def path_of( tag_id ):
+            if tag_id not in paths:
+                name, parent_id = rows[tag_id]
+                parent_path = path_of( parent_id ) if parent_id in rows \
+                    else None
+                paths[tag_id] = '/'.join( [parent_path, name] ) \
+                    if parent_path else name
+            return paths[tag_id]
+
+        for tag_id in rows:
+            connection.execute( tags.update() \
+                .where( tags.c.id == tag_id ) \
+                .values( path=path_of( tag_id ) ) )
+
+        tag_path_cache.clear()
+        return len( rows )
 
-        path = path.split( '/' )
-        tag_iter = None
-        tag_parent = None
-        while 0 < len( path ):
-            tag_parent_id = None
-            parent_path = 'root'
-            if tag_parent:
-                parent_path = tag_parent.path
-                tag_parent_id = tag_parent.id
-
-            tag_iter = db.session.query( Tag ) \
-                .filter( Tag.name == path[0] ) \
-                .filter( Tag.parent_id == tag_parent_id ) \
-                .first()
-            if not tag_iter:
-                # Create the missing new tag.
-                tag_iter = Tag( parent_id=tag_parent_id, name=path[0] )
-                current_app.logger.info(
-                    'creating new tag %s under %s',
-                    tag_iter.path, parent_path )
-                db.session.add( tag_iter )
+    @staticmethod
+    def normalize_path( path ):
+        return '/'.join( s for s in path.split( '/' ) if s )
+
+    @staticmethod
+    def subtree_filter( path ):
+
+        ''' Return a filter matching all tags beneath path, as
+        Folder.subtree_filter() does for folders. '''
+
+        return db.and_(
+            Tag.path > path + '/',
+            Tag.path < path + '0' )
+
+    @staticmethod
+    def resolve_paths( paths ):
+
+        ''' Return {path: tag ID} for every non-empty path in paths, creating
+        any missing tags (and their parents) in bulk and committing once.
+        Cached paths cost nothing; the rest are looked up together. '''
+
+        normalized = {p: Tag.normalize_path( p ) for p in paths}
+
+        # Renamed, moved or deleted tags (in any process) make cached paths
+        # stale; new ones do not.
+        tag_path_cache.check_version( DataVersion.get( DataVersion.TAGS ) )
+
+        tag_ids = {}
+        missing = set()
+        for path in set( normalized.values() ):
+            tag_id = tag_path_cache.get( path ) if path else None
+            if tag_id:
+                tag_ids[path] = tag_id
+            elif path:
+                missing.add( path )
+
+        if missing:
+            # Look for every ancestor, too, so new tags find their parents.
+            segments = {p: p.split( '/' ) for p in missing}
+            prefixes = sorted( set( '/'.join( s[:i + 1] )
+                for s in segments.values() for i in range( len( s ) ) ) )
+
+            found = {}
+            tags = Tag.__table__
+            connection = db.session.connection()
+            for idx in range( 0, len( prefixes ), TAG_LOOKUP_BATCH_SIZE ):
+                for tag_id, path in connection.execute(
+                    db.select( [tags.c.id, tags.c.path] ) \
+                        .where( tags.c.path.in_(
+                            prefixes[idx:idx + TAG_LOOKUP_BATCH_SIZE] ) ) \
+                        .order_by( tags.c.id )
+                ):
+                    # Keep the oldest of any duplicates.
+                    found.setdefault( path, tag_id )
+
+            # Create what is missing a level at a time, parents first.
+            created = [p for p in prefixes if p not in found]
+            created.sort( key=lambda p: p.count( '/' ) )
+            for depth, level in itertools.groupby(
+                created, key=lambda p: p.count( '/' )
+            ):
+                rows = [{
+                    'name': p.rsplit( '/', 1 )[-1],
+                    'parent_id': found[p.rsplit( '/', 1 )[0]] if depth \
+                        else None,
+                    'path': p} for p in level]
+                db.session.bulk_insert_mappings(
+                    Tag, rows, return_defaults=True )
+                found.update( (row['path'], row['id']) for row in rows )
+
+            if created:
                 db.session.commit()
+                current_app.logger.info( 'created %d new tags: %s',
+                    len( created ), ', '.join( created ) )
+
+            for path in missing:
+                tag_ids[path] = found[path]
+                tag_path_cache.set( path, found[path] )
+
+        return {p: tag_ids[n] for p, n in normalized.items() if n}
+
+    @staticmethod
+    def from_paths( paths ):
+
+        ''' Return the tags at paths (creating any that are missing) in
+        order, without repeats. '''
 
-            path.pop( 0 )
-            tag_parent = tag_iter
+        tag_ids = Tag.resolve_paths( paths )
+        tags = {t.id: t for t in db.session.query( Tag ) \
+            .filter( Tag.id.in_( set( tag_ids.values() ) ) )} \
+            if tag_ids else {}
 
-        return tag_iter
+        return list( dict.fromkeys(
+            tags[tag_ids[p]] for p in paths if p in tag_ids ) )
+
+    @staticmethod
+    def from_path( path ):
+        tags = Tag.from_paths( [path] )
+        return tags[0] if tags else None
 
     @staticmethod
     def enumerate_roots():
         return db.session.query( Tag ) \
             .filter( Tag.parent_id == None )
 
+@event.listens_for( Tag, 'before_insert' )
+def tag_before_insert( mapper, connection, target ):
+    target.path = Tag.build_path( connection, target.parent_id, target.name )
+
+@event.listens_for( Tag, 'before_update' )
+def tag_before_update( mapper, connection, target ):
+
+    ''' Keep materialized paths up to date when a tag is renamed or moved,
+    rewriting the paths of everything beneath it in one statement. '''
+
+    state = inspect( target )
+    if not state.attrs.name.history.has_changes() and \
+    not state.attrs.parent_id.history.has_changes():
+        return
+
+    old_path = state.attrs.path.history.unchanged[0] \
+        if state.attrs.path.history.unchanged else target.path
+    target.path = Tag.build_path( connection, target.parent_id, target.name )
+    if not old_path:
+        return
+
+    tag_path_cache.evict(
+        lambda k: k == old_path or k.startswith( old_path + '/' ) )
+
+    tags = Tag.__table__
+    connection.execute( tags.update() \
+        .where( Tag.subtree_filter( old_path ) ) \
+        .values( path=db.literal( target.path ) + \
+            func.substr( tags.c.path, len( old_path ) + 1 ) ) )
+
+@event.listens_for( Tag, 'after_delete' )
+def tag_after_delete( mapper, connection, target ):
+    if target.path:
+        tag_path_cache.evict( lambda k: k == target.path or \
+            k.startswith( target.path + '/' ) )
+
+@event.listens_for( Tag.__table__, 'after_create' )
+def tag_after_create( target, connection, **kw ):
+    # A new database reuses tag IDs the cache may still hold.
+    tag_path_cache.clear()
+
 # endregion
 
 # region folder
@@ -395,6 +570,17 @@ class Folder( db.Model, JSONItemMixin ):
         order_by=name )
     status = db.Column( db.Enum( StatusEnum ) )
 
+    # Materialized path relative to the library root (e.g. "2019/summer"),
+    # maintained by the insert/update listeners below so path lookups are a
+    # single column read and subtrees are an indexed range scan.
+    path = db.Column(
+        db.String( 768 ), index=True, unique=False, nullable=True )
+
+    # Directory st_mtime_ns as of the last completed scan, used to skip
+    # listing directories whose entries have not changed since.
+    dir_mtime = db.Column(
+        db.BigInteger, index=False, unique=False, nullable=True )
+
     owner_id = db.column_property(
         db.select(
             [Library.owner_id],
@@ -411,24 +597,6 @@ class Folder( db.Model, JSONItemMixin ):
     def __repr__( self ):
         return self.name
 
-    @property
-    def path( self, include_lib=False ):
-
-        parent_list = []
-        folder_iter = self
-
-        # Traverse the folder's parents upwards.
-        while isinstance( folder_iter, Folder ):
-            parent_list.insert( 0, folder_iter.name )
-            folder_iter = db.session.query( Folder ) \
-                .filter( Folder.id == folder_iter.parent_id ) \
-                .first()
-
-        if include_lib:
-            parent_list.insert( 0, self.library.machine_name )
-
-        return '/'.join( parent_list )
-
     @property
     def absolute_path( self ):
         return '/'.join( [self.library.absolute_path, self.path] )
@@ -450,12 +618,121 @@ class Folder( db.Model, JSONItemMixin ):
 
         return parent_list
 
+    @staticmethod
+    def build_path( connection, parent_id, name ):
+
+        ''' Return the materialized path for a folder called name beneath
+        the folder with parent_id, reading the parent's stored path. '''
+
+        if not parent_id:
+            return name
+
+        folders = Folder.__table__
+        parent_path = connection.execute(
+            db.select( [folders.c.path] ) \
+                .where( folders.c.id == parent_id ) ).scalar()
+
+        return '/'.join( [parent_path, name] )
+
+    @staticmethod
+    def subtree_filter( path ):
+
+        ''' Return a filter matching all folders beneath path (but not the
+        folder at path itself). The range comparison can use the index on
+        the path column, which LIKE cannot on every backend. '''
+
+        # '0' is the character directly after '/', so this bounds every
+        # string starting with path + '/'.
+        return db.and_(
+            Folder.path > path + '/',
+            Folder.path < path + '0' )
+
+    @staticmethod
+    def descendants_query( library_id, path, user_id ):
+
+        ''' Return a query for all folders beneath path in the given
+        library. '''
+
+        return Folder.secure_query( user_id ) \
+            .filter( Folder.library_id == library_id ) \
+            .filter( Folder.subtree_filter( path ) )
+
+    @staticmethod
+    def rebuild_paths():
+
+        ''' Recalculate the materialized path of every folder from the
+        parent chain. Useful for databases that predate the path column. '''
+
+        folders = Folder.__table__
+        connection = db.session.connection()
+
+        # Walk downwards one level at a time so parents are always done first.
+        level = connection.execute(
+            db.select( [folders.c.id, folders.c.name] ) \
+                .where( folders.c.parent_id == None ) ).fetchall()
+        parent_paths = {}
+        while level:
+            for folder_id, folder_path in level:
+                parent_paths[folder_id] = folder_path
+                connection.execute( folders.update() \
+                    .where( folders.c.id == folder_id ) \
+                    .values( path=folder_path ) )
+            children = connection.execute(
+                db.select(
+                    [folders.c.id, folders.c.name, folders.c.parent_id] ) \
+                    .where( folders.c.parent_id.in_(
+                        [f[0] for f in level] ) ) ).fetchall()
+            level = [(f[0], '/'.join( [parent_paths[f[2]], f[1]] ) )
+                for f in children]
+
+        db.session.commit()
+
+    @staticmethod
+    def _from_cache( library_id, path, user_id ):
+
+        folder_id = folder_path_cache.get( (library_id, path) )
+        if folder_id is None:
+            return None
+
+        # This is free if the folder is already in the identity map.
+        folder = db.session.query( Folder ).get( folder_id )
+        if not folder or \
+        folder.library_id != library_id or \
+        folder.path != path:
+            # Stale entry (e.g. the database was recreated underneath us).
+            folder_path_cache.pop( (library_id, path) )
+            return None
+
+        if 0 <= user_id and \
+        folder.owner_id is not None and \
+        folder.owner_id != user_id:
+            return None
+
+        return folder
+
     @staticmethod
     def from_path( library_id, path, user_id ):
 
         # Do the fetching from scratch to ensure permissions.
         assert( isinstance( library_id, int ) )
 
+        if path:
+            path = path.strip( '/' )
+
+        if path:
+            folder = Folder._from_cache( library_id, path, user_id )
+            if folder:
+                return folder
+
+            # Resolve the whole path in one query using the stored path.
+            folder = Folder.secure_query( user_id ) \
+                .filter( Folder.library_id == library_id ) \
+                .filter( Folder.path == path ) \
+                .first()
+            if folder:
+                folder_path_cache.set( (library_id, path), folder.id )
+                return folder
+
         library = Library.secure_query( user_id ) \
             .filter( Library.id == library_id ) \
             .first()
@@ -466,57 +743,58 @@ class Folder( db.Model, JSONItemMixin ):
         if not path:
             raise LibraryRootException( library_id=library.id )
 
-        path_right = path.split( '/' )
-        path_left = []
+        return Folder._create_from_path( library, path )
 
-        folder_iter = None
-        parent = None
+    @staticmethod
+    def _create_from_path( library, path ):
 
-        #library_absolute_path = library.absolute_path
+        ''' Create DB entries for any folders in path which exist on the
+        filesystem but not in the DB, raising InvalidFolderException if a
+        folder is in neither. '''
 
-        while( len( path_right ) > 0 ):
-            parent_id = None
-            if folder_iter:
-                parent_id = parent.id
+        path_segments = path.split( '/' )
+        prefixes = ['/'.join( path_segments[:i + 1] )
+            for i in range( len( path_segments ) )]
 
-            query = db.session.query( Folder ).filter(
-                Folder.parent_id == parent_id,
-                Folder.library_id == library.id,
-                Folder.name == path_right[0] )
-            folder_iter = query.first()
+        # Grab whichever ancestors already exist in one go.
+        existing = {f.path: f for f in db.session.query( Folder ) \
+            .filter( Folder.library_id == library.id ) \
+            .filter( Folder.path.in_( prefixes ) ) \
+            .all()}
 
-            # Use the parent's absolute path if available, otherwise use the library's.
-            absolute_path = os.path.join( library.absolute_path, path_right[0] )
-            if parent:
-                absolute_path = os.path.join( parent.absolute_path, path_right[0] )
+        parent = None
+        for segment, prefix in zip( path_segments, prefixes ):
+            folder_iter = existing.get( prefix )
+            if folder_iter:
+                parent = folder_iter
+                continue
 
-            if not os.path.exists( absolute_path ) and not folder_iter:
-                # Folder does not exist on FS or in DB.
+            absolute_path = os.path.join( library.absolute_path, prefix )
+            if not os.path.isdir( absolute_path ):
+                # Folder does not exist on FS or in DB (or is a file).
                 raise InvalidFolderException(
-                    name=path[0], library_id=library.id, absolute_path=absolute_path )
-
-            elif os.path.exists( absolute_path ) and not folder_iter:
-                # Add folder to DB if it does exist.
-                current_app.logger.info(
-                    'creating missing DB entry for {} under {}...'.format(
-                        absolute_path, parent ) )
-
-                # Assume we're under the root by default, but use parent if available.
-                parent_id = None
-                if parent:
-                    parent_id = parent.id
-
-                assert( library )
-                folder_iter = Folder(
-                    parent_id=parent_id,
-                    library_id=library.id,
-                    name=path_right[0] )
-                db.session.add( folder_iter )
-                db.session.commit()
-            path_left.append( path_right.pop( 0 ) )
+                    name=segment, library_id=library.id,
+                    parent_id=parent.id if parent else None,
+                    absolute_path=absolute_path )
+
+            # Add folder to DB if it does exist.
+            current_app.logger.info(
+                'creating missing DB entry for {} under {}...'.format(
+                    absolute_path, parent ) )
+
+            folder_iter = Folder(
+                parent_id=parent.id if parent else None,
+                library_id=library.id,
+                name=segment )
+            db.session.add( folder_iter )
+            db.session.flush()
             parent = folder_iter
 
-        return folder_iter
+        db.session.commit()
+
+        folder_path_cache.set( (library.id, path), parent.id )
+
+        return parent
 
     @staticmethod
     def secure_query( user_id ):
@@ -551,6 +829,47 @@ class Folder( db.Model, JSONItemMixin ):
 
         return folder
 
+@event.listens_for( Folder, 'before_insert' )
+def folder_before_insert( mapper, connection, target ):
+    target.path = Folder.build_path( connection, target.parent_id, target.name )
+
+@event.listens_for( Folder, 'before_update' )
+def folder_before_update( mapper, connection, target ):
+
+    ''' Keep materialized paths up to date when a folder is renamed or moved,
+    rewriting the paths of everything beneath it in one statement. '''
+
+    state = inspect( target )
+    if not state.attrs.name.history.has_changes() and \
+    not state.attrs.parent_id.history.has_changes() and \
+    not state.attrs.library_id.history.has_changes():
+        return
+
+    old_path = state.attrs.path.history.unchanged[0] \
+        if state.attrs.path.history.unchanged else target.path
+    old_library_id = state.attrs.library_id.history.deleted[0] \
+        if state.attrs.library_id.history.deleted else target.library_id
+    folder_path_cache.evict(
+        lambda k: k[0] == old_library_id and \
+            (k[1] == old_path or k[1].startswith( old_path + '/' )) )
+    target.path = Folder.build_path( connection, target.parent_id, target.name )
+
+    folders = Folder.__table__
+    connection.execute( folders.update() \
+        .where( folders.c.library_id == old_library_id ) \
+        .where( folders.c.path > old_path + '/' ) \
+        .where( folders.c.path < old_path + '0' ) \
+        .values(
+            library_id=target.library_id,
+            path=db.literal( target.path ) + \
+                func.substr( folders.c.path, len( old_path ) + 1 ) ) )
+
+@event.listens_for( Folder, 'after_delete' )
+def folder_after_delete( mapper, connection, target ):
+    folder_path_cache.evict(
+        lambda k: k[0] == target.library_id and \
+            (k[1] == target.path or k[1].startswith( target.path + '/' )) )
+
 # endregion
 
 # region plugin
@@ -616,18 +935,109 @@ class Plugin( db.Model ):
 
     @staticmethod
     def polymorph():
+        return plugin_registry.polymorph()
 
-        plugins = db.session.query( Plugin ) \
-            .filter( Plugin.enabled ) \
-            .all()
+    @staticmethod
+    def models_by_extension():
+
+        ''' Return a dict mapping lowercase file extensions to the
+        (machine_name, model) of the enabled plugin that handles them. '''
+
+        return plugin_registry.models_by_extension()
+
+class PluginRegistry( object ):
+
+    ''' Imports the enabled plugins' models once, and caches the
+    polymorphic Item entity and extension map built from them until a
+    plugin or file extension is added, changed or removed. '''
+
+    def __init__( self ):
+        # Reentrant, as importing a plugin module may register the plugin.
+        self._lock = threading.RLock()
+        self._models = None
+        self._extensions = None
+        self._mime_types = None
+        self._polymorph = None
+        self.hits = 0
+        self.misses = 0
+
+    def load( self ):
+
+        ''' (Re)load the enabled plugins from the DB. '''
+
+        models = {}
+        extensions = {}
+        mime_types = {}
+        with self._lock:
+            for plugin in db.session.query( Plugin ).filter( Plugin.enabled ):
+                plugin_module = importlib.import_module( plugin.module_path )
+                plugin_model = getattr( plugin_module, plugin.model_name )
+                models[plugin.machine_name] = plugin_model
+                for extension, mime_type in plugin.extensions.items():
+                    extensions[extension.lower()] = \
+                        (plugin.machine_name, plugin_model)
+                    mime_types[extension.lower()] = mime_type
+
+            self._models = models
+            self._extensions = extensions
+            self._mime_types = mime_types
+            self._polymorph = db.with_polymorphic( Item, list( models.values() ) )
+
+    def _loaded( self ):
+        with self._lock:
+            if self._polymorph is None:
+                self.misses += 1
+                self.load()
+            else:
+                self.hits += 1
+            return self._models, self._extensions, self._mime_types, \
+                self._polymorph
+
+    def polymorph( self ):
+        return self._loaded()[3]
+
+    def models( self ):
+
+        ''' Return a dict mapping machine names to enabled plugin models. '''
+
+        return dict( self._loaded()[0] )
+
+    def models_by_extension( self ):
+        return dict( self._loaded()[1] )
+
+    def mime_types( self ):
+
+        ''' Return a dict mapping lowercase file extensions to their MIME
+        types. Do not modify. '''
+
+        return self._loaded()[2]
 
-        models = []
-        for plugin in plugins:
-            plugin_module = importlib.import_module( plugin.module_path )
-            plugin_model = getattr( plugin_module, plugin.model_name )
-            models.append( plugin_model )
+    def invalidate( self ):
+        with self._lock:
+            self._models = None
+            self._extensions = None
+            self._mime_types = None
+            self._polymorph = None
 
-        return db.with_polymorphic( Item, models )
+    def stats( self ):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'plugins': sorted( self._models ) if self._models else [] }
+
+plugin_registry = PluginRegistry()
+
+@event.listens_for( Plugin, 'after_insert' )
+@event.listens_for( Plugin, 'after_update' )
+@event.listens_for( Plugin, 'after_delete' )
+@event.listens_for( FileExtension, 'after_insert' )
+@event.listens_for( FileExtension, 'after_update' )
+@event.listens_for( FileExtension, 'after_delete' )
+def plugin_after_change( mapper, connection, target ):
+
+    # Enabling, disabling or (un)registering a plugin changes the models.
+    plugin_registry.invalidate()
 
 # endregion
 
@@ -635,12 +1045,23 @@ class Plugin( db.Model ):
 
 class ItemMeta( db.Model, MetaPropertyMixin ):
 
+    ''' A model for storing variable metadata key-value pairs related
+    to Items. Numeric values are also kept in number, so range filters on
+    them can use the (key, number) index instead of casting value. '''
+
     __tablename__ = 'item_meta'
+    __table_args__ = (
+        # Each item has at most one value per key.
+        db.Index( 'ix_item_meta_item_id_key', 'item_id', 'key', unique=True ),
+        db.Index( 'ix_item_meta_key_number', 'key', 'number' ),
+        db.Index( 'ix_item_meta_key_value', 'key', 'value' ),
+    )
 
     id = db.Column( db.Integer, primary_key=True )
     key = db.Column( db.String( 12 ), index=True, unique=False, nullable=False )
     value = \
         db.Column( db.String( 256 ), index=False, unique=False, nullable=True )
+    number = db.Column( db.Float, index=False, unique=False, nullable=True )
     item_id = db.Column( db.Integer, db.ForeignKey( 'items.id' ) )
     item = db.relationship( 'Item',
         backref=db.backref(
@@ -649,9 +1070,75 @@ class ItemMeta( db.Model, MetaPropertyMixin ):
             lazy="joined",
             cascade="all, delete-orphan" ) )
 
+    @validates( 'value' )
+    def validate_value( self, key, value ):
+        self.number = ItemMeta.number_of( value )
+        return value
+
+    @staticmethod
+    def number_of( value ):
+
+        ''' Return value as a float if it is a plain number, or None. '''
+
+        if value is None or isinstance( value, bool ):
+            return None
+        if isinstance( value, (int, float) ):
+            return float( value )
+        # float() also takes "nan", "inf" or "1e3", which are not meant as
+        # numbers here.
+        if not NUMBER_PATTERN.match( str( value ) ):
+            return None
+        return float( value )
+
+    @staticmethod
+    def sync_numbers( connection, batch_size=1000 ):
+
+        ''' Fill number for every row from value. Return the rows updated. '''
+
+        table = ItemMeta.__table__
+        updated = 0
+        last_id = 0
+        while True:
+            rows = connection.execute( db.select(
+                [table.c.id, table.c.value, table.c.number] ) \
+                .where( table.c.id > last_id ) \
+                .order_by( table.c.id ) \
+                .limit( batch_size ) ).fetchall()
+            if not rows:
+                return updated
+            last_id = rows[-1][0]
+
+            changes = [{'meta_id': r[0], 'new_number': ItemMeta.number_of( r[1] )}
+                for r in rows if ItemMeta.number_of( r[1] ) != r[2]]
+            if changes:
+                connection.execute( table.update() \
+                    .where( table.c.id == db.bindparam( 'meta_id' ) ) \
+                    .values( number=db.bindparam( 'new_number' ) ), changes )
+                updated += len( changes )
+
+    @staticmethod
+    def remove_duplicates( connection ):
+
+        ''' Delete all but the newest value of any key repeated on an item,
+        so the unique (item_id, key) index can be created. Return the rows
+        deleted. '''
+
+        table = ItemMeta.__table__
+        keep = db.select( [func.max( table.c.id ).label( 'id' )] ) \
+            .group_by( table.c.item_id, table.c.key ) \
+            .alias( 'keep' )
+        return connection.execute( table.delete().where(
+            ~table.c.id.in_( db.select( [keep.c.id] ) ) ) ).rowcount
+
 class Item( db.Model, JSONItemMixin ):
 
     __tablename__ = 'items'
+    __table_args__ = (
+        # Duplicate detection groups by hash within each algorithm.
+        db.Index( 'ix_items_hash_algo_hash', 'hash_algo', 'hash' ),
+        # Folder listings seek through items in (name, id) order.
+        db.Index( 'ix_items_folder_id_name_id', 'folder_id', 'name', 'id' ),
+    )
 
     id = db.Column( db.Integer, primary_key=True )
     meta = association_proxy( '_meta', 'value',
@@ -665,7 +1152,7 @@ class Item( db.Model, JSONItemMixin ):
     timestamp = db.Column(
         db.DateTime, index=False, unique=False, nullable=False )
     size = db.Column(
-        db.Integer, index=False, unique=False, nullable=False )
+        db.Integer, index=True, unique=False, nullable=False )
     added = db.Column( db.DateTime, index=False, unique=False, nullable=False )
     hash = db.Column(
         db.String( 512 ), index=False, unique=False, nullable=False )
@@ -705,12 +1192,13 @@ class Item( db.Model, JSONItemMixin ):
         'polymorphic_on': plugin
     }
 
-    mime_type = db.column_property(
-        db.select(
-            [FileExtension.mime_type],
-            db.and_(
-                FileExtension.plugin_id == Plugin.id,
-                Plugin.machine_name == plugin ) ).limit( 1 ).label( 'mime_type' ) )
+    @property
+    def mime_type( self ):
+
+        ''' The MIME type registered for this item's file extension. '''
+
+        extension = os.path.splitext( self.name )[1][1:].lower()
+        return plugin_registry.mime_types().get( extension )
 
     def __str__( self ):
         return self.name
@@ -775,18 +1263,27 @@ class Item( db.Model, JSONItemMixin ):
     def absolute_path( self ):
         return '/'.join( [self.folder.absolute_path, self.name] )
 
+    @staticmethod
+    def probe( absolute_path ):
+
+        ''' Return a dict of meta values read from the file for bulk
+        ingestion. Plugins override this with type-specific probing. '''
+
+        return {}
+
+    @staticmethod
+    def sync_meta_columns( connection, item_ids=None ):
+
+        ''' Refresh any columns a plugin keeps as copies of meta values,
+        for writes that bypass the ORM. '''
+
+        pass
+
     @staticmethod
     def hash_file( absolute_path, hash_algo=HashEnum.md5 ):
         # We don't need to bother with the folder, since this can just fail if
         # the file doesn't really exist.
-        absolute_path = os.path.join( absolute_path )
-        hash_out = hashlib.md5()
-        with open( absolute_path, 'rb' ) as file_f:
-            buf = file_f.read( 4096 )
-            while 0 < len( buf ):
-                hash_out.update( buf )
-                buf = file_f.read( 4096 )
-        return hash_out.hexdigest()
+        return hash_file( absolute_path, hash_algo )
 
     @staticmethod
     def from_path( library_id, relative_path, user_id ):
@@ -825,9 +1322,10 @@ class Item( db.Model, JSONItemMixin ):
         poly = Plugin.polymorph()
         query = db.session.query( poly )
         if 0 <= user_id:
+            # Named, so cached page queries can rebind it.
             query = query.filter( db.or_(
                 Item.owner_id == None,
-                user_id == Item.owner_id ) )
+                Item.owner_id == db.bindparam( 'user_id', user_id ) ) )
 
         return query
 
@@ -867,3 +1365,194 @@ class WorkerSemaphore( db.Model ):
         db.Column( db.Integer, index=False, unique=False, nullable=False )
     note = \
         db.Column( db.String( 256 ), index=False, unique=False, nullable=True )
+
+class DuplicateItem( db.Model ):
+
+    ''' An item's place in a group of byte-identical items, as last found
+    by the duplicates command. '''
+
+    __tablename__ = "duplicate_items"
+
+    id = db.Column( db.Integer, primary_key=True )
+    group_id = db.Column(
+        db.Integer, index=True, unique=False, nullable=False )
+    item_id = db.Column(
+        db.Integer, db.ForeignKey( 'items.id', ondelete='CASCADE' ),
+        index=True, unique=True, nullable=False )
+
+class ThumbnailJob( db.Model ):
+
+    ''' A queued request to pre-render every allowed preview size of an
+    item, picked up by the thumbnail workers. '''
+
+    __tablename__ = "thumbnail_jobs"
+
+    id = db.Column( db.Integer, primary_key=True )
+    item_id = db.Column(
+        db.Integer, db.ForeignKey( 'items.id', ondelete='CASCADE' ),
+        index=True, unique=True, nullable=False )
+    # Deleting an item deletes its job, too.
+    item = db.relationship( 'Item', backref=db.backref( 'thumbnail_job',
+        uselist=False, cascade='all, delete-orphan' ) )
+    status = db.Column(
+        db.Enum( JobStatusEnum ), index=True, unique=False, nullable=False )
+    # Timestamp stored as integer for simpler math later.
+    timestamp = \
+        db.Column( db.Integer, index=False, unique=False, nullable=False )
+    note = \
+        db.Column( db.String( 256 ), index=False, unique=False, nullable=True )
+
+class ImportJob( db.Model ):
+
+    ''' A spooled import file, queued for (or being worked through by) an
+    import worker. The worker running it holds the WorkerSemaphore named by
+    semaphore_id, which carries its heartbeat, progress and checkpoint, so
+    any web worker can report on the job and a dead one can be resumed. '''
+
+    __tablename__ = "import_jobs"
+
+    id = db.Column( db.String( 32 ), primary_key=True )
+    path = db.Column(
+        db.String( 1024 ), index=False, unique=False, nullable=False )
+    status = db.Column(
+        db.Enum( JobStatusEnum ), index=True, unique=False, nullable=False )
+    # Timestamp stored as integer for simpler math later.
+    timestamp = \
+        db.Column( db.Integer, index=False, unique=False, nullable=False )
+    items_added = db.Column( db.Integer, nullable=False, default=0 )
+    items_skipped = db.Column( db.Integer, nullable=False, default=0 )
+    items_failed = db.Column( db.Integer, nullable=False, default=0 )
+    note = \
+        db.Column( db.String( 256 ), index=False, unique=False, nullable=True )
+
+    @property
+    def semaphore_id( self ):
+        return 'import-{}'.format( self.id )
+
+    @property
+    def progress( self ):
+
+        ''' Percent of the file imported, as last checkpointed. '''
+
+        if JobStatusEnum.done == self.status:
+            return 100
+        semaphore = db.session.query( WorkerSemaphore ) \
+            .get( self.semaphore_id )
+        return semaphore.progress if semaphore else 0
+
+    def to_dict( self ):
+        return {
+            'id': self.id,
+            'status': self.status.name,
+            'progress': self.progress,
+            'items_added': self.items_added,
+            'items_skipped': self.items_skipped,
+            'items_failed': self.items_failed,
+            'note': self.note }
+
+class DataVersion( db.Model ):
+
+    ''' A counter bumped after every committed write to a group of tables,
+    so caches built from them in any process can tell when they have gone
+    stale.
+
+    Counters are incremented in a short transaction of their own once the
+    write has committed, so concurrent writers never wait on each other's
+    transactions for the row. A cache may be built from new data under the
+    old version in between, which only means it is rebuilt once more. '''
+
+    __tablename__ = "data_versions"
+
+    # Items, their meta and tags, and the folders and libraries they sit in.
+    ITEMS = 'items'
+
+    # Tag renames, moves and deletions, which change tag paths.
+    TAGS = 'tags'
+
+    # Perceptual hashes of items.
+    PHASH = 'phash'
+
+    # Every counter, created along with the table.
+    NAMES = (ITEMS, TAGS, PHASH)
+
+    name = db.Column( db.String( 32 ), primary_key=True )
+    version = \
+        db.Column( db.Integer, index=False, unique=False, nullable=False )
+
+    @staticmethod
+    def get( name ):
+        row = db.session.query( DataVersion.version ) \
+            .filter( DataVersion.name == name ) \
+            .first()
+        return row[0] if row else 0
+
+    @staticmethod
+    def create_missing( connection ):
+
+        ''' Add a row for every counter the table does not have yet. '''
+
+        table = DataVersion.__table__
+        existing = set( r[0] for r in connection.execute(
+            db.select( [table.c.name] ) ) )
+        missing = [{'name': n, 'version': 0}
+            for n in DataVersion.NAMES if n not in existing]
+        if missing:
+            connection.execute( table.insert(), missing )
+
+    @staticmethod
+    def bump( session, name ):
+
+        ''' Increment the named counter once session commits. Nothing is
+        bumped if it rolls back. '''
+
+        session.info.setdefault( DATA_VERSION_PENDING_KEY, set() ).add( name )
+
+    @staticmethod
+    def increment( bind, names ):
+
+        ''' Increment the named counters now, in a transaction of their
+        own. '''
+
+        table = DataVersion.__table__
+        with bind.begin() as connection:
+            for name in sorted( names ):
+                connection.execute( table.update() \
+                    .where( table.c.name == name ) \
+                    .values( version=table.c.version + 1 ) )
+
+# Where a session holds the names of the counters its commit should bump.
+DATA_VERSION_PENDING_KEY = 'data_versions'
+
+@event.listens_for( DataVersion.__table__, 'after_create' )
+def data_version_after_create( target, connection, **kw ):
+    DataVersion.create_missing( connection )
+
+@event.listens_for( Session, 'after_flush' )
+def data_version_after_flush( session, flush_context ):
+
+    # Bulk writes (e.g. the scanner's) skip this and bump for themselves.
+    for obj in itertools.chain( session.new, session.dirty, session.deleted ):
+        if isinstance( obj, (Item, ItemMeta, Tag, Folder, Library) ):
+            DataVersion.bump( session, DataVersion.ITEMS )
+        if isinstance( obj, ItemMeta ) and PHASH_META_KEY == obj.key:
+            DataVersion.bump( session, DataVersion.PHASH )
+        if isinstance( obj, Tag ) and obj not in session.new:
+            state = inspect( obj )
+            if obj in session.deleted or \
+            state.attrs.name.history.has_changes() or \
+            state.attrs.parent_id.history.has_changes():
+                DataVersion.bump( session, DataVersion.TAGS )
+
+@event.listens_for( Session, 'after_commit' )
+def data_version_after_commit( session ):
+    names = session.info.pop( DATA_VERSION_PENDING_KEY, None )
+    if names:
+        DataVersion.increment( session.get_bind(), names )
+
+@event.listens_for( Session, 'after_soft_rollback' )
+def data_version_after_soft_rollback( session, previous_transaction ):
+
+    # Rolling back a savepoint leaves the outer transaction's bumps (and a
+    # harmless few of its own) to be made on commit.
+    if previous_transaction.parent is None:
+        session.info.pop( DATA_VERSION_PENDING_KEY, None )
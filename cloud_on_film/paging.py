@@ -0,0 +1,103 @@
+import json
+import base64
+import binascii
+
+from sqlalchemy.ext import baked
+
+from .models import db, Item
+
+PAGE_QUERY_CACHE_SIZE = 512
+
+# Compiled page queries for seek_cached().
+page_bakery = baked.bakery( size=PAGE_QUERY_CACHE_SIZE )
+
+#region exceptions
+
+class InvalidCursorException( Exception ):
+    pass
+
+#endregion
+
+def encode_cursor( item ):
+
+    ''' Return an opaque token for the position just after item in a
+    listing ordered by (name, id). '''
+
+    return base64.urlsafe_b64encode(
+        json.dumps( [item.name, item.id] ).encode( 'utf-8' ) ) \
+        .decode( 'ascii' ).rstrip( '=' )
+
+def decode_cursor( token ):
+
+    ''' Return the (name, id) a token from encode_cursor() points after.
+    Raise an InvalidCursorException for anything else. '''
+
+    try:
+        name, item_id = json.loads( base64.urlsafe_b64decode(
+            token + '=' * (-len( token ) % 4) ).decode( 'utf-8' ) )
+    except (binascii.Error, UnicodeError, ValueError, TypeError) as e:
+        raise InvalidCursorException( 'invalid cursor' ) from e
+
+    if not isinstance( name, str ) or not isinstance( item_id, int ):
+        raise InvalidCursorException( 'invalid cursor' )
+
+    return name, item_id
+
+def seek( query, after, limit ):
+
+    ''' Return the next limit items of query ordered by (name, id), after
+    the position in the token after (or from the start if it is empty),
+    and the token for the page after those, or None on the last page.
+
+    Unlike an OFFSET, which reads and discards every row before the page,
+    this starts straight from the position in the (name, id) index, so any
+    page costs the same as the first. '''
+
+    if after:
+        name, item_id = decode_cursor( after )
+        # Written out rather than as a row comparison so the leading
+        # name >= bound can use the index on every backend.
+        query = query.filter( Item.name >= name ).filter( db.or_(
+            Item.name > name,
+            Item.id > item_id ) )
+
+    # One extra row tells whether there is a page after this one.
+    items = query \
+        .order_by( Item.name, Item.id ) \
+        .limit( limit + 1 ) \
+        .all()
+
+    return _next_page( items, limit )
+
+def seek_cached( key, build, after, limit, **params ):
+
+    ''' Like seek(), for a query that is paged through over and over. The
+    query from build( session ) is constructed and compiled to SQL only
+    the first time key is seen; later pages just rebind the cursor and
+    params. key must identify everything build() puts in the query, save
+    what it takes through bindparam()s named in params. '''
+
+    bq = page_bakery( build, key )
+
+    if after:
+        name, item_id = decode_cursor( after )
+        params['after_name'] = name
+        params['after_id'] = item_id
+        bq += lambda q: q \
+            .filter( Item.name >= db.bindparam( 'after_name' ) ) \
+            .filter( db.or_(
+                Item.name > db.bindparam( 'after_name' ),
+                Item.id > db.bindparam( 'after_id' ) ) )
+
+    bq.add_criteria( lambda q: q \
+        .order_by( Item.name, Item.id ) \
+        .limit( limit + 1 ), limit )
+
+    return _next_page( bq( db.session() ).params( **params ).all(), limit )
+
+def _next_page( items, limit ):
+    if len( items ) <= limit:
+        return items, None
+
+    items = items[:limit]
+    return items, encode_cursor( items[-1] )
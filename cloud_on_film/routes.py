@@ -1,5 +1,4 @@
 
-import json
 import os
 import mimetypes
 import io
@@ -14,6 +13,7 @@ from flask import \
     redirect, \
     url_for, \
     jsonify
+from markupsafe import escape
 from sqlalchemy import exc
 
 from .models import \
@@ -22,6 +22,7 @@ from .models import \
     Item, \
     Folder, \
     Tag, \
+    ImportJob, \
     InvalidFolderException, \
     LibraryRootException, \
     SavedSearch, \
@@ -34,8 +35,9 @@ from .forms import \
     EditItemForm, \
     SearchDeleteForm
 
-from .importing import start_import_thread, threads
-from .search import Searcher
+from .importing import start_import_job, spool_upload
+from .search import Searcher, SearchSyntaxException, SearchExecuteException
+from .paging import seek, InvalidCursorException
 from .widgets import \
     EditBatchItemFormWidget, \
     FormRenderer, \
@@ -94,8 +96,7 @@ def cloud_libraries_new():
     return render.render()
 
 @libraries.route( '/libraries/upload', methods=['GET', 'POST'] )
-@libraries.route( '/libraries/upload/<thread_id>', methods=['GET', 'POST'] )
-def cloud_libraries_upload( thread_id='' ):
+def cloud_libraries_upload():
 
     title = 'Upload Library Data'
     progress = 0
@@ -105,26 +106,25 @@ def cloud_libraries_upload( thread_id='' ):
 
         form = UploadLibraryForm( request.form )
         if form.validate_on_submit():
-            pictures = \
-                json.loads( request.files['upload'].read().decode( 'utf-8' ) )
-            thread_id = start_import_thread( pictures )
-            return redirect(
-                url_for( 'libraries.cloud_libraries_upload' ) + '?thread_id=thread_id' )
+            # Large exports are streamed from disk rather than decoded
+            # whole in memory.
+            job_id = start_import_job(
+                spool_upload( request.files['upload'] ) )
+            return redirect( url_for(
+                'libraries.cloud_libraries_upload', job_id=job_id ) )
 
     elif 'GET' == request.method:
-        thread_id = int( request.args['thread_id'] ) \
-            if 'thread_id' in request.args else None
         form = UploadLibraryForm()
-        form.progress.url = \
-            url_for( 'libraries.ajax_libraries_upload' ) + \
-            '?thread_id=' + str( thread_id )
-        
-        title = 'Uploading thread #{}'.format( thread_id )
-        # XXX: DEBUG
-        if 999 == thread_id:
-            progress = 33
-        else:
-            progress = threads[thread_id].progress if thread_id in threads else 0
+        job_id = request.args.get( 'job_id' )
+        form.progress.url = url_for(
+            'libraries.ajax_libraries_upload', job_id=job_id )
+        if job_id:
+            # Any web worker can report on the job, from the DB.
+            job = db.session.query( ImportJob ).get( job_id )
+            if not job:
+                abort( 404 )
+            title = 'Importing upload {}'.format( job_id )
+            progress = job.progress
 
     form_widget = FormWidget( form=form, form_pfx='form' )
     render = FormRenderer( form_widget, title=title, progress=progress )
@@ -135,10 +135,10 @@ def cloud_libraries_upload( thread_id='' ):
 @libraries.route( '/libraries/<string:machine_name>/<path:relative_path>', methods=['GET'] )
 def cloud_libraries( machine_name=None, relative_path=None ):
 
-    page = int( request.args['page'] ) if 'page' in request.args and request.args['page'] else 0
-    offset = page * current_app.config['ITEMS_PER_PAGE']
+    after = request.args.get( 'after' )
+    limit = current_app.config['ITEMS_PER_PAGE']
 
-    renderer = LibraryRenderer( page=page )
+    renderer = LibraryRenderer()
 
     # These forms will never be handled by this route, so they don't need
     # to collect POSTs.
@@ -162,15 +162,12 @@ def cloud_libraries( machine_name=None, relative_path=None ):
         if not folder:
             abort( 404 )
 
-        items = Item.secure_query( current_uid ) \
-            .filter( Item.folder_id == folder.id ) \
-            .order_by( Item.name ) \
-            .offset( offset ) \
-            .limit( current_app.config['ITEMS_PER_PAGE'] ) \
-            .all()
+        items, next_page = seek( Item.secure_query( current_uid ) \
+            .filter( Item.folder_id == folder.id ), after, limit )
 
         renderer.kwargs['this_folder'] = folder
         renderer.kwargs['items'] = items
+        renderer.kwargs['next_page'] = next_page
         renderer.kwargs['folders'] = folder.children
 
         return renderer.render()
@@ -178,18 +175,18 @@ def cloud_libraries( machine_name=None, relative_path=None ):
     except LibraryRootException as e:
         # Show the root of the given library ID.
 
-        items = Item.secure_query( current_uid ) \
-            .filter( Item.folder_id == None ) \
-            .order_by( Item.name ) \
-            .offset( offset ) \
-            .limit( current_app.config['ITEMS_PER_PAGE'] ) \
-            .all()
+        items, next_page = seek( Item.secure_query( current_uid ) \
+            .filter( Item.folder_id == None ), after, limit )
 
         renderer.kwargs['items'] = items
+        renderer.kwargs['next_page'] = next_page
         renderer.kwargs['folders'] = library.children
 
         return renderer.render()
 
+    except InvalidCursorException:
+        abort( 400 )
+
     except InvalidFolderException as e:
 
         # Try to see if this is a valid file and display it if so.
@@ -205,7 +202,7 @@ def cloud_libraries( machine_name=None, relative_path=None ):
         # TODO: Individual file display.
         return render_template(
             'file_item.html.j2', file_item=file_item,
-            page=page, edit_form=edit_form, search_form=search_form )
+            search_form=search_form )
 
 # endregion
 
@@ -294,19 +291,20 @@ def cloud_items_search_saved( search_id ):
     if not search:
         abort( 404 )
 
-    page = int( request.args['page'] ) \
-        if 'page' in request.args and request.args['page'] else 0
-    offset = page * current_app.config['ITEMS_PER_PAGE']
+    after = request.args.get( 'after' )
     limit = current_app.config['ITEMS_PER_PAGE']
-    searcher = Searcher( search.query )
-    searcher.lexer.lex()
-    items = searcher.search( current_uid ) \
-        .order_by( Item.name ) \
-        .offset( offset ) \
-        .limit( limit ) \
-        .all()
-
-    renderer = LibraryRenderer( items=items, page=page )
+    try:
+        items, next_page = Searcher.page_snapshot(
+            search.query, current_uid, after, limit )
+    except InvalidCursorException:
+        abort( 400 )
+    except (SearchSyntaxException, SearchExecuteException) as e:
+        # Saved before the grammar changed, probably; show the query so it
+        # can be fixed and saved again.
+        flash( escape( 'Invalid search: {}'.format( e ) ), 'error' )
+        items, next_page = [], None
+
+    renderer = LibraryRenderer( items=items, next_page=next_page )
 
     search_form.query.data = search.query
     save_search_form.query.data = search_form.query.data
@@ -323,16 +321,14 @@ def cloud_items_search_saved( search_id ):
 @libraries.route( '/search', methods=['GET'] )
 def cloud_items_search():
 
-    page = int( request.args['page'] ) \
-        if 'page' in request.args and request.args['page'] else 0
-    offset = page * current_app.config['ITEMS_PER_PAGE']
+    after = request.args.get( 'after' )
 
     current_uid = User.current_uid()
 
     save_search_form = SaveSearchForm( request.args )
     search_form = SearchQueryForm( request.args )
 
-    renderer = LibraryRenderer( page=page )
+    renderer = LibraryRenderer( next_page=None )
 
     search_form_widget = SearchFormWidget( search_form )
     renderer.add_widget( search_form_widget )
@@ -343,17 +339,19 @@ def cloud_items_search():
     if search_form.validate():
         query_str = search_form.query.data
 
-        searcher = Searcher( query_str )
-        searcher.lexer.lex()
-        items = searcher.search( current_uid ) \
-            .order_by( Item.name ) \
-            .offset( offset ) \
-            .limit( current_app.config['ITEMS_PER_PAGE'] ) \
-            .all()
+        try:
+            items, next_page = Searcher.page( query_str, current_uid, after,
+                current_app.config['ITEMS_PER_PAGE'] )
+        except InvalidCursorException:
+            abort( 400 )
+        except (SearchSyntaxException, SearchExecuteException) as e:
+            flash( escape( 'Invalid search: {}'.format( e ) ), 'error' )
+            items, next_page = [], None
 
         search_form.query.data = search_form.query.data
 
         renderer.kwargs['items'] = items
+        renderer.kwargs['next_page'] = next_page
 
     else:
         for field, errors in search_form.errors.items():
@@ -366,20 +364,16 @@ def cloud_items_search():
 
 # region ajax_json
 
-@current_app.route( '/ajax/libraries/upload', methods=['GET'] )
-def cloud_ajax_libraries_upload():
+@libraries.route( '/ajax/libraries/upload', methods=['GET'] )
+def ajax_libraries_upload():
 
-    thread_id = int( request.args['thread_id'] ) if 'thread_id' in request.args else None
+    job = db.session.query( ImportJob ).get( request.args.get( 'job_id' ) ) \
+        if request.args.get( 'job_id' ) else None
 
-    if not thread_id:
+    if not job:
         abort( 404 )
 
-    if 999 == thread_id:
-        progress = 33
-    else:
-        progress = threads[thread_id].progress if thread_id in threads else 0
-    
-    return jsonify( {'progress': progress} )
+    return jsonify( job.to_dict() )
 
 @libraries.route( '/tags/<path:path>' )
 def cloud_tags( path ):
@@ -425,20 +419,21 @@ def cloud_items_ajax_search_delete():
 
 # region ajax_html
 
-@libraries.route( '/ajax/html/items/<int:folder_id>/<int:page>', methods=['GET'] )
-def cloud_items_ajax_json( folder_id, page ):
-
-    offset = page * current_app.config['ITEMS_PER_PAGE']
+@libraries.route( '/ajax/html/items/<int:folder_id>', methods=['GET'] )
+def cloud_items_ajax_json( folder_id ):
 
-    items = Item.secure_query( User.current_uid() ) \
-        .filter( Item.folder_id == folder_id ) \
-        .order_by( Item.name ) \
-        .offset( offset ) \
-        .limit( current_app.config['ITEMS_PER_PAGE'] ) \
-        .all()
+    try:
+        items, next_page = seek( Item.secure_query( User.current_uid() ) \
+            .filter( Item.folder_id == folder_id ),
+            request.args.get( 'after' ),
+            current_app.config['ITEMS_PER_PAGE'] )
+    except InvalidCursorException:
+        abort( 400 )
 
     #return jsonify( [i.to_dict( ignore_keys=['parent', 'folder'] ) for i in items] )
-    return jsonify( [m.library_html() for m in items] )
+    return jsonify( {
+        'items': [m.library_html() for m in items],
+        'next': next_page } )
 
 @libraries.route( '/ajax/html/search', methods=['GET'] )
 def cloud_items_ajax_search():
@@ -448,23 +443,17 @@ def cloud_items_ajax_search():
     if not search_form.validate():
         return jsonify( { 'submit_status': 'error', 'fields': search_form.errors } )
 
-    page = 0
-    try:
-        page = int( search_form.page.data )
-    except ValueError:
-        pass
-
     query_str = search_form.query.data
-    offset = page * current_app.config['ITEMS_PER_PAGE']
 
-    searcher = Searcher( query_str )
-    searcher.lexer.lex()
-    query = searcher.search( User.current_uid() ) \
-        .order_by( Item.name ) \
-        .offset( offset ) \
-        .limit( current_app.config['ITEMS_PER_PAGE'] )
-
-    return jsonify( [m.library_html() for m in query.all()] )
+    try:
+        items, next_page = Searcher.page( query_str, User.current_uid(),
+            search_form.after.data, current_app.config['ITEMS_PER_PAGE'] )
+    except InvalidCursorException:
+        abort( 400 )
+
+    return jsonify( {
+        'items': [m.library_html() for m in items],
+        'next': next_page } )
 
 @libraries.route( '/ajax/html/batch', methods=['GET'] )
 def cloud_items_ajax_batch():
@@ -0,0 +1,461 @@
+import os
+import time
+import logging
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .hashing import BulkHasher
+from .fulltext import update_items
+from . import thumbnails
+from .models import \
+    db, \
+    DataVersion, \
+    Folder, \
+    Item, \
+    ItemMeta, \
+    Plugin, \
+    HashEnum, \
+    StatusEnum, \
+    WorkerSemaphore
+
+ScanFile = namedtuple( 'ScanFile', ['name', 'size', 'mtime'] )
+
+class ScanListing( object ):
+
+    ''' The contents of a single directory as read by a scan worker. If
+    unchanged is set, the directory was not listed at all. The mtime is
+    None if the listing may be incomplete. '''
+
+    def __init__( self, dirs, files, mtime=None, unchanged=False ):
+        self.dirs = dirs
+        self.files = files
+        self.mtime = mtime
+        self.unchanged = unchanged
+
+def scan_directory( absolute_path, known_mtime=None ):
+
+    ''' List a directory with os.scandir, returning a ScanListing with sorted
+    subdirectory names and stat results for files. If the directory's mtime
+    matches known_mtime, its entries cannot have changed, so it is not
+    listed. If any entry could not be listed or stat'ed, the mtime is left
+    out, so the directory is not recorded as scanned and its unlisted items
+    are not marked missing. Runs in worker threads, so this must not touch
+    the database. '''
+
+    logger = logging.getLogger( 'scanner.worker' )
+
+    try:
+        mtime = os.stat( absolute_path ).st_mtime_ns
+    except OSError as e:
+        logger.error( 'unable to scan %s: %s', absolute_path, e )
+        return ScanListing( [], [] )
+
+    if known_mtime is not None and known_mtime == mtime:
+        return ScanListing( [], [], mtime, unchanged=True )
+
+    dirs = []
+    files = []
+    complete = True
+    try:
+        with os.scandir( absolute_path ) as dir_iter:
+            for entry in dir_iter:
+                try:
+                    if entry.is_dir( follow_symlinks=False ):
+                        dirs.append( entry.name )
+                    elif entry.is_file():
+                        entry_stat = entry.stat()
+                        files.append( ScanFile(
+                            entry.name, entry_stat.st_size,
+                            entry_stat.st_mtime ) )
+                except OSError as e:
+                    logger.warning( 'unable to stat %s: %s', entry.path, e )
+                    complete = False
+    except OSError as e:
+        logger.error( 'unable to scan %s: %s', absolute_path, e )
+        complete = False
+
+    dirs.sort()
+    files.sort()
+    return ScanListing( dirs, files, mtime if complete else None )
+
+def probe_file( model, absolute_path ):
+
+    ''' Probe a single new file for metadata. Runs in worker threads.
+    Returns None if the file could not be read. '''
+
+    try:
+        return model.probe( absolute_path )
+    except (OSError, IOError) as e:
+        logging.getLogger( 'scanner.worker' ).warning(
+            'unable to probe %s: %s', absolute_path, e )
+        return None
+
+class Scanner( object ):
+
+    ''' Walks a library's directory tree with a pool of scandir workers and
+    adds any new folders and items to the DB in bulk batches. New files are
+    hashed on a separate pool of processes.
+
+    Directories are committed in a fixed (sorted, depth-first) order and the
+    last committed directory is checkpointed in a WorkerSemaphore, so an
+    interrupted scan resumes from where it stopped.
+
+    Rescans are incremental: a directory whose mtime matches the one stored
+    on its Folder is not listed (only its known subfolders are stat'ed),
+    and in directories that did change only files whose size or mtime
+    differ from the DB are re-hashed and re-probed. Set full to compare
+    every file regardless of directory mtimes, which also catches files
+    modified in place. '''
+
+    def __init__(
+        self, library, workers=8, batch_size=500, resume=True, full=False,
+        hash_algo=HashEnum.md5, hash_workers=None
+    ):
+        self.library = library
+        self.workers = workers
+        self.hash_algo = HashEnum( hash_algo )
+        self.hash_workers = hash_workers
+        self.batch_size = batch_size
+        self.resume = resume
+        self.full = full
+        self.logger = logging.getLogger( 'scanner' )
+
+        self.semaphore_id = 'scan-{}'.format( library.id )
+        self.checkpoint = None
+        self.extensions = {}
+        self.hasher = None
+        self.pending = []
+        self.missing = []
+        self.present = []
+        self.folder_mtimes = []
+        self.last_dir = None
+
+        self.files_seen = 0
+        self.dirs_skipped = 0
+        self.folders_added = 0
+        self.items_added = 0
+        self.items_updated = 0
+        self.items_missing = 0
+        self.start_time = None
+
+    @property
+    def files_per_sec( self ):
+        elapsed = time.time() - self.start_time if self.start_time else 0
+        return self.files_seen / elapsed if 0 < elapsed else 0.0
+
+    def stats( self ):
+        return {
+            'files_seen': self.files_seen,
+            'dirs_skipped': self.dirs_skipped,
+            'folders_added': self.folders_added,
+            'items_added': self.items_added,
+            'items_updated': self.items_updated,
+            'items_missing': self.items_missing,
+            'elapsed': time.time() - self.start_time,
+            'files_per_sec': self.files_per_sec }
+
+    def _load_checkpoint( self ):
+
+        semaphore = db.session.query( WorkerSemaphore ) \
+            .get( self.semaphore_id )
+
+        if not semaphore:
+            semaphore = WorkerSemaphore(
+                id=self.semaphore_id,
+                timestamp=int( time.time() ),
+                progress=0 )
+            db.session.add( semaphore )
+
+        elif self.resume and semaphore.note is not None:
+            self.checkpoint = tuple( semaphore.note.split( '/' ) ) \
+                if semaphore.note else ()
+            self.files_seen = semaphore.progress
+            self.logger.info( 'resuming scan of %s after "%s"',
+                self.library.machine_name, semaphore.note )
+
+        else:
+            semaphore.progress = 0
+            semaphore.note = None
+
+        self.semaphore = semaphore
+        db.session.commit()
+
+    def _is_done( self, rel_path ):
+
+        ''' Return True if the whole subtree at rel_path was committed by a
+        previous run. Ancestors of the checkpoint are not done, as their
+        later children may still be pending. '''
+
+        return self.checkpoint is not None and \
+            rel_path < self.checkpoint and \
+            rel_path != self.checkpoint[:len( rel_path )]
+
+    def _files_done( self, rel_path ):
+        return self.checkpoint is not None and \
+            rel_path == self.checkpoint[:len( rel_path )]
+
+    def _known_children( self, folder_id ):
+
+        ''' Return a dict of (ID, stored mtime) by name for the DB children
+        of the given folder (or of the library root). '''
+
+        query = db.session.query( Folder.id, Folder.name, Folder.dir_mtime ) \
+            .filter( Folder.library_id == self.library.id ) \
+            .filter( Folder.parent_id == folder_id )
+        return {name: (child_id, mtime) for child_id, name, mtime in query}
+
+    def _child_folders( self, rel_path, folder_id, listing, is_new ):
+
+        ''' Return a dict of (ID, stored mtime) by name for the child
+        folders on disk and the set of names that were new, bulk-inserting
+        any that are missing from the DB. '''
+
+        children = {}
+        if not is_new:
+            children = self._known_children( folder_id )
+
+        missing = [{
+            'parent_id': folder_id,
+            'library_id': self.library.id,
+            'name': name,
+            'path': '/'.join( rel_path + (name,) )
+        } for name in listing.dirs if name not in children]
+
+        if missing:
+            db.session.bulk_insert_mappings(
+                Folder, missing, return_defaults=True )
+            for mapping in missing:
+                children[mapping['name']] = (mapping['id'], None)
+            self.folders_added += len( missing )
+
+        return {name: children[name] for name in listing.dirs}, \
+            set( m['name'] for m in missing )
+
+    def _queue_files( self, pool, rel_path, folder_id, listing, is_new ):
+
+        absolute_path = os.path.join( self.library.absolute_path, *rel_path )
+
+        existing = {}
+        if not is_new:
+            existing = {i.name: i for i in db.session.query(
+                Item.id, Item.name, Item.size, Item.timestamp, Item.status ) \
+                .filter( Item.folder_id == folder_id )}
+
+        for scan_file in listing.files:
+            self.files_seen += 1
+
+            item_id = None
+            if scan_file.name in existing:
+                item = existing.pop( scan_file.name )
+                if item.size == scan_file.size and \
+                int( item.timestamp.timestamp() ) == int( scan_file.mtime ):
+                    # Unchanged since the last scan.
+                    if StatusEnum.missing == item.status:
+                        self.present.append( item.id )
+                    continue
+                item_id = item.id
+
+            extension = os.path.splitext( scan_file.name )[1][1:].lower()
+            if extension not in self.extensions:
+                continue
+
+            machine_name, model = self.extensions[extension]
+            file_path = os.path.join( absolute_path, scan_file.name )
+            self.pending.append( (item_id, folder_id, machine_name, scan_file,
+                self.hasher.submit( file_path ),
+                pool.submit( probe_file, model, file_path )) )
+
+        # Anything left over is in the DB but no longer on disk, unless the
+        # listing failed part way.
+        if listing.mtime is not None:
+            self.missing += [i.id for i in existing.values()
+                if StatusEnum.missing != i.status]
+
+    def _flush( self ):
+
+        ''' Wait for pending hashes, bulk-write the batch and checkpoint. '''
+
+        now = datetime.now()
+        items = []
+        metas = []
+        updates = []
+        update_metas = []
+        thumb_items = []
+        failed_folders = set()
+        by_plugin = defaultdict( list )
+        for item_id, folder_id, machine_name, scan_file, hash_future, \
+        meta_future in self.pending:
+            file_hash = hash_future.result()
+            meta = meta_future.result()
+            if file_hash is None or meta is None:
+                # Keep the folder's mtime unrecorded, so the next scan
+                # lists it and tries the file again.
+                failed_folders.add( folder_id )
+                continue
+            item = {
+                'timestamp': datetime.fromtimestamp( scan_file.mtime ),
+                'size': scan_file.size,
+                'hash': file_hash,
+                'hash_algo': self.hash_algo.value }
+            if item_id:
+                item.update( {'id': item_id, 'status': None} )
+                updates.append( item )
+                update_metas.append( meta )
+                if machine_name in self.thumbnailed:
+                    thumb_items.append( item )
+            else:
+                item.update( {
+                    'name': scan_file.name,
+                    'folder_id': folder_id,
+                    'added': now,
+                    'plugin': machine_name} )
+                items.append( item )
+                metas.append( meta )
+                if machine_name in self.thumbnailed:
+                    thumb_items.append( item )
+            by_plugin[machine_name].append( item )
+
+        if items:
+            db.session.bulk_insert_mappings(
+                Item, items, return_defaults=True )
+            self.items_added += len( items )
+
+        if updates:
+            db.session.bulk_update_mappings( Item, updates )
+
+            # Replace the probed meta values of changed items.
+            probed_keys = set( k for m in update_metas for k in m )
+            if probed_keys:
+                db.session.query( ItemMeta ) \
+                    .filter( ItemMeta.item_id.in_(
+                        [i['id'] for i in updates] ) ) \
+                    .filter( ItemMeta.key.in_( probed_keys ) ) \
+                    .delete( synchronize_session=False )
+            self.items_updated += len( updates )
+
+        if items or updates:
+            # Probed meta includes the perceptual hashes of pictures.
+            DataVersion.bump( db.session, DataVersion.PHASH )
+            db.session.bulk_insert_mappings( ItemMeta, [{
+                'item_id': item['id'],
+                'key': key,
+                'value': str( value ),
+                'number': ItemMeta.number_of( value )
+            } for item, meta in zip( items + updates, metas + update_metas )
+                for key, value in meta.items()] )
+
+        # Bulk writes skip the ORM events that keep plugin columns in step
+        # with meta, so sync them per model. IDs of new items were filled
+        # in by the bulk insert above.
+        for machine_name, plugin_items in by_plugin.items():
+            self.models[machine_name].sync_meta_columns(
+                db.session.connection(), [i['id'] for i in plugin_items] )
+
+        thumbnails.enqueue( [i['id'] for i in thumb_items] )
+
+        # Or the full-text index.
+        update_items( db.session.connection(), [i['id'] for i in items] )
+
+        if self.missing:
+            db.session.query( Item ) \
+                .filter( Item.id.in_( self.missing ) ) \
+                .update( {Item.status: StatusEnum.missing},
+                    synchronize_session=False )
+            self.items_missing += len( self.missing )
+
+        if self.present:
+            db.session.query( Item ) \
+                .filter( Item.id.in_( self.present ) ) \
+                .update( {Item.status: None}, synchronize_session=False )
+
+        # Only record directory mtimes once their contents are committed.
+        folder_mtimes = [m for m in self.folder_mtimes
+            if m['id'] not in failed_folders]
+        if folder_mtimes:
+            db.session.bulk_update_mappings( Folder, folder_mtimes )
+
+        # None of the bulk writes above are seen by the flush listener.
+        DataVersion.bump( db.session, DataVersion.ITEMS )
+
+        self.pending = []
+        self.missing = []
+        self.present = []
+        self.folder_mtimes = []
+
+        self.semaphore.timestamp = int( time.time() )
+        self.semaphore.progress = self.files_seen
+        self.semaphore.note = '/'.join( self.last_dir ) \
+            if self.last_dir is not None else None
+        db.session.commit()
+
+        self.logger.info(
+            '%s: %d files seen, %d items added, %d updated, ' \
+            '%d directories unchanged (%.1f files/sec)',
+            self.library.machine_name, self.files_seen, self.items_added,
+            self.items_updated, self.dirs_skipped, self.files_per_sec )
+
+    def run( self ):
+
+        self.start_time = time.time()
+        self.extensions = Plugin.models_by_extension()
+        self.models = dict( self.extensions.values() )
+        self.thumbnailed = set( m for m, model in self.extensions.values()
+            if hasattr( model, 'thumbnail_path' ) )
+        self._load_checkpoint()
+
+        with ThreadPoolExecutor( max_workers=self.workers ) as pool, \
+        BulkHasher( self.hash_algo, self.hash_workers ) as self.hasher:
+
+            # Each entry is (relative path tuple, folder ID, is new, listing
+            # future). Children are pushed in reverse so they pop in sorted
+            # order, but all of them are scanned in parallel straight away.
+            stack = [((), None, False,
+                pool.submit( scan_directory, self.library.absolute_path ))]
+
+            while stack:
+                rel_path, folder_id, is_new, future = stack.pop()
+                listing = future.result()
+
+                if listing.unchanged:
+                    # Nothing was added or removed here, so the DB's idea
+                    # of the subfolders is current.
+                    self.dirs_skipped += 1
+                    children = self._known_children( folder_id )
+                    new_children = set()
+
+                else:
+                    children, new_children = self._child_folders(
+                        rel_path, folder_id, listing, is_new )
+
+                    # Files directly under the library root have no folder.
+                    if rel_path and not self._files_done( rel_path ):
+                        self._queue_files(
+                            pool, rel_path, folder_id, listing, is_new )
+
+                    if rel_path and listing.mtime is not None:
+                        self.folder_mtimes.append(
+                            {'id': folder_id, 'dir_mtime': listing.mtime} )
+
+                for name in sorted( children, reverse=True ):
+                    child_path = rel_path + (name,)
+                    if self._is_done( child_path ):
+                        continue
+                    child_id, child_mtime = children[name]
+                    stack.append( (
+                        child_path, child_id, name in new_children,
+                        pool.submit( scan_directory, os.path.join(
+                            self.library.absolute_path, *child_path ),
+                            None if self.full else child_mtime ) ) )
+
+                self.last_dir = rel_path
+                if len( self.pending ) >= self.batch_size:
+                    self._flush()
+
+            self._flush()
+
+        # Finished cleanly, so the next scan starts from scratch.
+        db.session.delete( self.semaphore )
+        db.session.commit()
+
+        return self.stats()
@@ -1,9 +1,26 @@
 
+import re
 from enum import Enum
 
-from cloud_on_film.models import Item, Tag
+from cloud_on_film.models import \
+    DataVersion, Item, ItemMeta, Plugin, Tag, items_tags
+from .cache import LRUCache
 from . import db
 
+SEARCH_CACHE_SIZE = 512
+
+# Maps normalized query strings to their compiled filter expressions.
+search_filter_cache = LRUCache( SEARCH_CACHE_SIZE )
+
+SEARCH_SNAPSHOT_CACHE_SIZE = 128
+
+# Only this many leading results of a search are kept; pages past them are
+# fetched from the database.
+SEARCH_SNAPSHOT_MAX_IDS = 10000
+
+# Maps (normalized query, user ID, data version) to a SearchSnapshot.
+search_snapshot_cache = LRUCache( SEARCH_SNAPSHOT_CACHE_SIZE )
+
 #region exceptions
 
 class SearchSyntaxException( Exception ):
@@ -28,6 +45,10 @@ class SearchLexerParser( object ):
         lte = 5
         in_ = 6
         like = 7
+        match = 8
+        # Only produced by SearchPlanner.
+        one_of = 9
+        all_of = 10
 
     class Node( object ):
         def __init__( self ):
@@ -72,316 +93,484 @@ class SearchLexerParser( object ):
         def __str__( self ):
             return 'NOT'
 
+    # One alternative per kind of token; tokenize() tells them apart by
+    # their first character. A number must not run on into a word, so
+    # 640x480 stays one word. Words may carry dots and dashes after their
+    # first character, so filenames and dates need no quotes.
+    TOKEN_PATTERN = re.compile( r'''
+        \s*(
+            "[^"]*" | '[^']*' |
+            != | >= | <= | [=><@~&|!()] |
+            -?\d+(?:\.\d+)?(?![\w%.\-]) |
+            [\w%][\w%.\-]* |
+            \S
+        )''', re.VERBOSE )
+
+    NUMBER_PATTERN = re.compile( r'-?\d+(?:\.\d+)?$' )
+
+    # Digits and dots that are not a number, such as 1.2.3.
+    BAD_NUMBER_PATTERN = re.compile( r'[\d.]+$' )
+
+    # Token kinds by first character. Anything else starts a word, if it
+    # is a word character, or is an error.
+    KINDS = {
+        '"': 'string',
+        "'": 'string',
+        '=': 'op',
+        '>': 'op',
+        '<': 'op',
+        '@': 'op',
+        '~': 'op',
+        '&': 'and',
+        '|': 'or',
+        '!': 'not',
+        '(': 'lparen',
+        ')': 'rparen'
+    }
+
+    OPS = {
+        '=': Op.eq,
+        '!=': Op.neq,
+        '>': Op.gt,
+        '<': Op.lt,
+        '>=': Op.gte,
+        '<=': Op.lte,
+        '@': Op.in_,
+        '~': Op.match
+    }
+
+    # Tokens that can stand for an attribute or a value.
+    OPERANDS = frozenset( ['string', 'number', 'word'] )
+
+    # Tokens that can start a term.
+    TERM_STARTS = OPERANDS | frozenset( ['lparen', 'not'] )
+
     def __init__( self, query_str ):
         self.query_str = query_str
         self.root = SearchLexerParser.Group()
-        self.last_attrib = None
-        self.last_op = None
-        self.last_value = None
-        self.head = self.root
-
-        # ctok = current_token
-        self.ctok_value = ''
-        self.ctok_type = None
-        self.ctok_quotes = False
-
-    def is_value_pending( self ):
-        return '' != self.ctok_value and \
-            None != self.ctok_type
-
-    def lex( self ):
-        skip = False
-        for i in range( len( self.query_str ) ):
-            if skip:
-                skip = False
-                continue
-
-            c = self.query_str[i]
-
-            if "'" == c or '"' == c:
-                if not self.is_value_pending():
-                    self.ctok_quotes = True
-
-                elif self.ctok_quotes:
-                    self.ctok_quotes = False
-
-                else:
-                    raise SearchSyntaxException( 'invalid \'"\' or "\'" detected' )
-
-            elif '%' == c:
-                if None == self.last_attrib:
-                    raise SearchSyntaxException( 'invalid "%%" in attribute name' )
-
+        self.kinds = []
+        self.texts = []
+        self.pos = 0
+
+    @staticmethod
+    def tokenize( query_str ):
+
+        ''' Return a list of (kind, text) tokens for query_str, raising a
+        SearchSyntaxException on anything that is not a token. '''
+
+        kinds = SearchLexerParser.KINDS
+        tokens = []
+        for text in SearchLexerParser.TOKEN_PATTERN.findall( query_str ):
+            kind = kinds.get( text[0] )
+            if 'not' == kind and 2 == len( text ):
+                kind = 'op' # !=
+            elif 'string' == kind:
+                if 1 == len( text ):
+                    raise SearchSyntaxException( 'unterminated quote' )
+            elif kind is None:
+                if SearchLexerParser.NUMBER_PATTERN.match( text ):
+                    kind = 'number'
+                elif SearchLexerParser.BAD_NUMBER_PATTERN.match( text ):
+                    raise SearchSyntaxException(
+                        'invalid number "{}"'.format( text ) )
+                elif text[0].isalnum() or text[0] in '_%':
+                    kind = 'word'
                 else:
-                    # Don't overthink this. We'll just check if the value starts
-                    # or ends with % on push to change the op to a LIKE.
-                    self.ctok_value += c
+                    raise SearchSyntaxException(
+                        'unexpected "{}"'.format( text ) )
+            tokens.append( (kind, text) )
+        return tokens
+
+    @staticmethod
+    def normalize( query_str ):
+
+        ''' Return query_str with only the whitespace that separates two
+        operands, so equivalent queries share a cache entry. '''
+
+        operands = SearchLexerParser.OPERANDS
+        out = []
+        last_kind = None
+        for kind, text in SearchLexerParser.tokenize( query_str ):
+            if kind in operands and last_kind in operands:
+                out.append( ' ' )
+            out.append( text )
+            last_kind = kind
+        return ''.join( out )
 
-            elif '!' == c:
-                if self.ctok_quotes:
-                    self.ctok_value += c
-
-                elif not self.is_value_pending():
-                    self.push_not()
-                    if i + 1 < len( self.query_str ) and \
-                    '(' == self.query_str[i + 1]:
-                        skip = True # Skip redundant group.
-
-                else:
-                    raise SearchSyntaxException( 'stray "!" detected' )
+    def lex( self ):
 
-            elif '&' == c:
-                if self.ctok_quotes:
-                    self.ctok_value += c
+        ''' Tokenize the query and parse it into the tree under root.
+
+        Groups may be written prefix, as in &((a=1)(b=2)), or infix, as in
+        a=1 & (b=2 | c=3). & and | are prefix where a term is expected and
+        infix after one. ! binds tightest, then &, then |, and terms
+        written side by side are and'ed. '''
+
+        tokens = SearchLexerParser.tokenize( self.query_str )
+        # The sentinel saves checking for the end at every step.
+        self.kinds = [t[0] for t in tokens] + ['end']
+        self.texts = [t[1] for t in tokens] + ['end of query']
+        self.pos = 0
+
+        if tokens:
+            self._add( self.root, self._parse_or() )
+        if 'end' != self.kinds[self.pos]:
+            raise SearchSyntaxException(
+                'stray "{}"'.format( self.texts[self.pos] ) )
+
+    def _expect( self, kind ):
+        if kind != self.kinds[self.pos]:
+            raise SearchSyntaxException( 'expected {}, found "{}"'.format(
+                kind, self.texts[self.pos] ) )
+        self.pos += 1
+        return self.texts[self.pos - 1]
+
+    @staticmethod
+    def _add( group, child ):
+        child.parent = group
+        group.children.append( child )
+
+    @staticmethod
+    def _group( group_type, children ):
+
+        ''' Return the single child, or a group_type of the children. '''
+
+        if 1 == len( children ):
+            return children[0]
+        group = group_type()
+        for child in children:
+            child.parent = group
+        group.children = children
+        return group
+
+    def _parse_or( self ):
+        children = [self._parse_and()]
+        while 'or' == self.kinds[self.pos]:
+            self.pos += 1
+            children.append( self._parse_and() )
+        return self._group( SearchLexerParser.Or, children )
+
+    def _parse_and( self ):
+        kinds = self.kinds
+        term_starts = self.TERM_STARTS
+        children = [self._parse_unary()]
+        while True:
+            if 'and' == kinds[self.pos]:
+                self.pos += 1
+            elif kinds[self.pos] not in term_starts:
+                break
+            # Otherwise the terms are side by side.
+            children.append( self._parse_unary() )
+        return self._group( SearchLexerParser.And, children )
+
+    def _parse_unary( self ):
+
+        kinds = self.kinds
+        kind = kinds[self.pos]
+
+        if 'not' == kind:
+            self.pos += 1
+            node = SearchLexerParser.Not()
+            self._add( node, self._parse_unary() )
+            return node
+
+        elif 'lparen' == kind:
+            self.pos += 1
+            if 'rparen' == kinds[self.pos]:
+                raise SearchSyntaxException( 'empty group' )
+            node = self._parse_or()
+            self._expect( 'rparen' )
+            return node
+
+        elif kind in ('and', 'or'):
+            # Prefix form: the operator joins each term in the parentheses.
+            self.pos += 1
+            self._expect( 'lparen' )
+            children = []
+            while 'rparen' != kinds[self.pos]:
+                if 'end' == kinds[self.pos]:
+                    raise SearchSyntaxException( 'missing ")"' )
+                children.append( self._parse_unary() )
+                if kinds[self.pos] in ('and', 'or'):
+                    raise SearchSyntaxException( 'infix "{}" inside a ' \
+                        'prefix group needs its own parentheses'.format(
+                            self.texts[self.pos] ) )
+            self.pos += 1
+            if not children:
+                raise SearchSyntaxException( 'empty group' )
+            return self._group( SearchLexerParser.And \
+                if 'and' == kind else SearchLexerParser.Or, children )
+
+        return self._parse_compare()
+
+    def _parse_compare( self ):
+
+        kinds = self.kinds
+        pos = self.pos
+        operands = self.OPERANDS
+
+        if kinds[pos] not in operands:
+            raise SearchSyntaxException( 'expected a comparison, found "{}"'.format(
+                self.texts[pos] ) )
+        if 'op' != kinds[pos + 1]:
+            raise SearchSyntaxException( 'expected op, found "{}"'.format(
+                self.texts[pos + 1] ) )
+        if kinds[pos + 2] not in operands:
+            raise SearchSyntaxException( 'missing value' )
+        self.pos = pos + 3
+
+        op = SearchLexerParser.OPS[self.texts[pos + 1]]
+
+        # The attribute is on the left, except for "value@attribute".
+        if SearchLexerParser.Op.in_ == op:
+            attrib_kind = kinds[pos + 2]
+        else:
+            attrib_kind = kinds[pos]
+        if 'word' != attrib_kind:
+            raise SearchSyntaxException( 'invalid attribute name' )
+
+        left = self._value( kinds[pos], self.texts[pos] )
+        right = self._value( kinds[pos + 2], self.texts[pos + 2] )
+
+        negate = False
+        if isinstance( right, str ) and \
+        (right.startswith( '%' ) or right.endswith( '%' )):
+            if SearchLexerParser.Op.eq == op:
+                op = SearchLexerParser.Op.like
+            elif SearchLexerParser.Op.neq == op:
+                op = SearchLexerParser.Op.like
+                negate = True
+
+        compare = SearchLexerParser.Compare()
+        compare.op = op
+        compare.children = (left, right)
+
+        if negate:
+            node = SearchLexerParser.Not()
+            self._add( node, compare )
+            return node
+        return compare
+
+    @staticmethod
+    def _value( kind, text ):
+        if 'string' == kind:
+            return text[1:-1]
+        elif 'number' == kind:
+            return float( text ) if '.' in text else int( text )
+        return text
 
-                elif not self.is_value_pending():
-                    self.push_and()
-                    if i + 1 < len( self.query_str ) and \
-                    '(' == self.query_str[i + 1]:
-                        skip = True # Skip redundant group.
+    def dump( self ):
+        print( 'ROOT (D: 0 C:{})'.format( len( self.root.children ) ) )
+        for t in self.root.children:
+            t.dump( 1 )
 
-                else:
-                    raise SearchSyntaxException( 'stray "&" detected' )
+class SearchPlanner( object ):
+
+    ''' Rewrites a tree from SearchLexerParser into an equivalent one that
+    translates to fewer, more index-friendly predicates:
+
+    - nested groups of the same kind are flattened and !!x becomes x,
+    - equalities on one attribute or'ed together become a single IN,
+    - "name"@tags constraints become one lookup through items_tags, and'ed
+      ones grouped by item and kept if every name matched,
+    - the terms of each group are ordered by estimated selectivity: the
+      narrowest first under an AND, the widest first under an OR, so
+      either stops evaluating as early as it can. '''
+
+    Op = SearchLexerParser.Op
+
+    # The relationship whose "name"@attribute constraints can be merged.
+    TAG_ATTRIBUTE = 'tags'
+
+    # Rough fraction of items a single comparison of each kind lets
+    # through. Only the order matters.
+    SELECTIVITY = {
+        Op.eq: 0.05,
+        Op.match: 0.05,
+        Op.in_: 0.1,
+        Op.gt: 0.3,
+        Op.lt: 0.3,
+        Op.gte: 0.3,
+        Op.lte: 0.3,
+        Op.like: 0.5,
+        Op.neq: 0.95
+    }
+
+    # A LIKE without a leading wildcard can seek the index.
+    LIKE_PREFIX_SELECTIVITY = 0.1
+
+    TAG_SELECTIVITY = 0.1
+
+    @staticmethod
+    def plan( node ):
+
+        ''' Return the optimized tree for node. Compare nodes are shared
+        with the original tree; groups are new. '''
+
+        if isinstance( node, SearchLexerParser.Compare ):
+            if SearchPlanner.is_tag( node ):
+                # Normalize to ('tags', (name,)) so it can be merged.
+                return SearchPlanner._compare( SearchPlanner.Op.one_of,
+                    SearchPlanner.TAG_ATTRIBUTE, (node.children[0],) )
+            return node
+
+        elif isinstance( node, SearchLexerParser.Not ):
+            child = SearchPlanner.plan( node.children[0] )
+            if isinstance( child, SearchLexerParser.Not ):
+                return child.children[0]
+            return SearchPlanner._group( SearchLexerParser.Not, [child] )
+
+        # The root is a plain Group, which and's its children.
+        group_type = SearchLexerParser.Or \
+            if isinstance( node, SearchLexerParser.Or ) \
+            else SearchLexerParser.And
+
+        children = []
+        for child in node.children:
+            child = SearchPlanner.plan( child )
+            if type( child ) is group_type:
+                children += child.children
+            else:
+                children.append( child )
 
-            elif '|' == c:
-                if self.ctok_quotes:
-                    self.ctok_value += c
+        children = SearchPlanner._merge( group_type, children )
+        children.sort( key=SearchPlanner.selectivity,
+            reverse=group_type is SearchLexerParser.Or )
 
-                elif not self.is_value_pending():
-                    self.push_or()
-                    if i + 1 < len( self.query_str ) and \
-                    '(' == self.query_str[i + 1]:
-                        skip = True # Skip redundant group.
+        if 1 == len( children ):
+            return children[0]
+        return SearchPlanner._group( group_type, children )
 
-                else:
-                    raise SearchSyntaxException( 'stray "|" detected' )
+    @staticmethod
+    def is_tag( compare ):
+        return SearchPlanner.Op.in_ == compare.op and \
+            SearchPlanner.TAG_ATTRIBUTE == compare.children[1]
 
-            elif '=' == c:
-                if self.ctok_quotes:
-                    self.ctok_value += c
+    @staticmethod
+    def selectivity( node ):
 
-                elif str == self.ctok_type:
-                    if None != self.last_value:
-                        raise SearchSyntaxException( 'stray "=" detected' )
-                    self.push_token()
-                    self.push_eq()
+        ''' Estimate the fraction of items node matches. '''
 
-                else:
-                    raise SearchSyntaxException( 'stray "=" detected' )
+        Op = SearchPlanner.Op
 
-            elif '@' == c:
-                if self.ctok_quotes:
-                    self.ctok_value += c
+        if isinstance( node, SearchLexerParser.Not ):
+            return 1.0 - SearchPlanner.selectivity( node.children[0] )
 
-                elif str == self.ctok_type:
-                    if None != self.last_value:
-                        raise SearchSyntaxException( 'stray "@" detected' )
-                    self.push_token()
-                    self.push_in()
+        elif isinstance( node, SearchLexerParser.Or ):
+            return min( 1.0,
+                sum( SearchPlanner.selectivity( c ) for c in node.children ) )
 
-                else:
-                    raise SearchSyntaxException( 'stray "@" detected' )
-
-            elif ' ' == c:
-                if self.ctok_quotes:
-                    self.ctok_value += c
-
-            elif '>' == c:
-                if self.ctok_quotes:
-                    self.ctok_value += c
-
-                elif str == self.ctok_type and \
-                None == self.last_attrib:
-                    self.push_token()
-                    if i + 1 < len( self.query_str ) and \
-                    '=' == self.query_str[i + 1]:
-                        # Is GTE (>=).
-                        self.push_gte()
-                        skip = True # Skip '='.
-                    else:
-                        # Is GT (>).
-                        self.push_gt()
+        elif isinstance( node, SearchLexerParser.Group ):
+            estimate = 1.0
+            for child in node.children:
+                estimate *= SearchPlanner.selectivity( child )
+            return estimate
 
-                else:
-                    raise SearchSyntaxException( 'stray ">" detected' )
-
-            elif '<' == c:
-                if self.ctok_quotes:
-                    self.ctok_value += c
-
-                elif str == self.ctok_type and \
-                None == self.last_attrib:
-                    self.push_token()
-                    if i + 1 < len( self.query_str ) and \
-                    '=' == self.query_str[i + 1]:
-                        # Is LTE (<=).
-                        self.push_lte()
-                        skip = True # Skip '='.
-                    else:
-                        # Is LT (<).
-                        self.push_lt()
+        attrib, value = node.children
+        if SearchPlanner.TAG_ATTRIBUTE == attrib and \
+        node.op in (Op.one_of, Op.all_of):
+            if Op.all_of == node.op:
+                return SearchPlanner.TAG_SELECTIVITY ** len( value )
+            return min( 1.0, SearchPlanner.TAG_SELECTIVITY * len( value ) )
 
-                else:
-                    raise SearchSyntaxException( 'stray "<" detected' )
+        elif Op.one_of == node.op:
+            return min( 1.0, SearchPlanner.SELECTIVITY[Op.eq] * len( value ) )
 
-            elif '(' == c:
-                if self.ctok_quotes:
-                    self.ctok_value += c
+        elif Op.like == node.op and not str( value ).startswith( '%' ):
+            return SearchPlanner.LIKE_PREFIX_SELECTIVITY
 
-                elif '' == self.ctok_value:
-                    self.start_group()
+        return SearchPlanner.SELECTIVITY.get( node.op, 1.0 )
 
-                else:
-                    raise SearchSyntaxException( 'stray "("' )
+    @staticmethod
+    def _merge_key( group_type, node ):
 
-            elif ')' == c:
-                if self.ctok_quotes:
-                    self.ctok_value += c
+        ''' Return what node can be merged with its siblings on, or None. '''
 
-                elif '' != self.ctok_value and \
-                str == self.ctok_type and \
-                not self.ctok_quotes:
-                    self.push_token()
-                    self.end_group()
+        Op = SearchPlanner.Op
 
-                elif '' != self.ctok_value and \
-                None != self.ctok_type:
-                    self.push_token()
-                    self.end_group()
+        if not isinstance( node, SearchLexerParser.Compare ):
+            return None
 
-                elif isinstance( self.head, SearchLexerParser.Group ):
-                    self.end_group()
+        attrib, value = node.children
+        if SearchPlanner.TAG_ATTRIBUTE == attrib and \
+        node.op in (Op.one_of, Op.all_of):
+            # An item with any of several tags is one IN; an item with all
+            # of them is one IN grouped by item. Mixing the two is not.
+            if group_type is SearchLexerParser.Or and \
+            (Op.one_of == node.op or 1 == len( value )):
+                return (attrib,)
+            elif group_type is SearchLexerParser.And and \
+            (Op.all_of == node.op or 1 == len( value )):
+                return (attrib,)
 
-                #elif isinstance( self.head, SearchLexerParser.Compare ):
-                #    self.end_group()
-                #    pass
+        elif group_type is SearchLexerParser.Or and \
+        node.op in (Op.eq, Op.one_of):
+            # Meta values compare as numbers or as strings, not both.
+            values = value if Op.one_of == node.op else (value,)
+            return (attrib, isinstance( values[0], (int, float) ))
 
-                else:
-                    raise SearchSyntaxException( 'stray ")"' )
+        return None
 
-            elif c.isdigit():
-                if None == self.ctok_type:
-                    self.ctok_type = int
+    @staticmethod
+    def _merge( group_type, children ):
 
-                self.ctok_value += c
+        Op = SearchPlanner.Op
+        merge_op = Op.one_of if group_type is SearchLexerParser.Or \
+            else Op.all_of
 
-            elif c.isalpha():
-                if None == self.ctok_type:
-                    self.ctok_type = str
+        merged = []
+        firsts = {}
+        for child in children:
+            key = SearchPlanner._merge_key( group_type, child )
+            if key is None:
+                merged.append( child )
+                continue
 
-                if str == self.ctok_type:
-                    self.ctok_value += c
-                else:
-                    raise SearchSyntaxException( 'attempted to add alpha char to int' )
-
-        # Button up any remaining tokens.
-        if self.is_value_pending():
-            self.push_token()
-
-    def _push_group( self, group ):
-        assert( isinstance( self.head, SearchLexerParser.Group ) )
-        group.parent = self.head
-        self.head.children.append( group )
-
-    def start_group( self ):
-        group = SearchLexerParser.Group()
-        self._push_group( group )
-        self.head = group
-
-    def end_group( self ):
-
-        orphan = self.head
-        parent = orphan.parent
-
-        if isinstance( orphan, SearchLexerParser.Group ) and \
-        isinstance( parent, SearchLexerParser.Group ) and \
-        not isinstance( orphan, SearchLexerParser.Not ) and \
-        1 == len( orphan.children ):
-            # Remove this group with only one child.
-            parent.children.remove( orphan )
-            parent.children.append( orphan.children[0] )
-
-        self.head = parent
-
-    def push_and( self ):
-        group = SearchLexerParser.And()
-        self._push_group( group )
-        self.head = group
-
-    def push_or( self ):
-        group = SearchLexerParser.Or()
-        self._push_group( group )
-        self.head = group
-
-    def push_not( self ):
-        group = SearchLexerParser.Not()
-        self._push_group( group )
-        self.head = group
-
-    def push_like( self ):
-        if SearchLexerParser.Op.eq and not self.last_op:
-            raise SearchSyntaxException( 'invalid comparison to LIKE' )
-        self.last_op = SearchLexerParser.Op.like
-
-    def push_gt( self ):
-        self.last_op = SearchLexerParser.Op.gt
-
-    def push_in( self ):
-        self.last_op = SearchLexerParser.Op.in_
-
-    def push_lt( self ):
-        self.last_op = SearchLexerParser.Op.lt
-
-    def push_gte( self ):
-        self.last_op = SearchLexerParser.Op.gte
-
-    def push_lte( self ):
-        self.last_op = SearchLexerParser.Op.lte
-
-    def push_eq( self ):
-        self.last_op = SearchLexerParser.Op.eq
-
-    def push_token( self ):
-
-        # Change the OP to LIKE if we have a trailing %.
-        if str == self.ctok_type and \
-        (self.ctok_value.startswith( '%' ) or \
-        self.ctok_value.endswith( '%' )):
-            self.push_like()
-
-        # Determine if we're assigning attrib or value.
-        if None == self.last_attrib:
-            assert( str == self.ctok_type )
-            self.last_attrib = self.ctok_value
-
-        elif None == self.last_value:
-            self.last_value = self.ctok_type( self.ctok_value )
-
-        elif None == self.last_op:
-            raise SearchSyntaxException( 'missing operator' )
-
-        if None != self.last_attrib and \
-        None != self.last_value and \
-        None != self.last_op:
-            group = SearchLexerParser.Compare()
-            group.parent = self.head
-            group.op = self.last_op
-            group.children = (self.last_attrib, self.last_value)
-            assert( 2 == len( group.children ) )
-            self.head.children.append( group )
-            #self.head = group
-            self.last_attrib = None
-            self.last_value = None
-            self.last_op = None
-
-        self.ctok_type = None
-        self.ctok_value = ''
-        self.ctok_quotes = False
+            first = firsts.get( key )
+            if first is None:
+                firsts[key] = (len( merged ), child)
+                merged.append( child )
+                continue
 
-    def dump( self ):
-        print( 'ROOT (D: 0 C:{})'.format( len( self.root.children ) ) )
-        for t in self.root.children:
-            t.dump( 1 )
+            idx, node = first
+            values = SearchPlanner._values( node )
+            values += tuple( v for v in SearchPlanner._values( child )
+                if v not in values )
+            node = SearchPlanner._compare( merge_op, key[0], values )
+            firsts[key] = (idx, node)
+            merged[idx] = node
+
+        return merged
+
+    @staticmethod
+    def _values( compare ):
+        if compare.op in (SearchPlanner.Op.one_of, SearchPlanner.Op.all_of):
+            return compare.children[1]
+        return (compare.children[1],)
+
+    @staticmethod
+    def _compare( op, attrib, values ):
+        compare = SearchLexerParser.Compare()
+        compare.op = op
+        compare.children = (attrib, values)
+        return compare
+
+    @staticmethod
+    def _group( group_type, children ):
+        group = group_type()
+        for child in children:
+            child.parent = group
+        group.children = children
+        return group
+
+class SearchSnapshot( object ):
+
+    ''' The ordered IDs of (a prefix of) a search's results. '''
+
+    def __init__( self, ids, complete ):
+        self.ids = ids
+        self.complete = complete
+        self.positions = {item_id: i for i, item_id in enumerate( ids )}
 
 class Searcher( object ):
 
@@ -391,18 +580,113 @@ class Searcher( object ):
     def __init__( self, query_str ):
         self.lexer = SearchLexerParser( query_str )
 
-    def search( self, user_id, _tree_start=None, _query=None ):
-
-        if not _query:
-            _query = Item.secure_query( user_id )
+    @staticmethod
+    def is_meta_key( key ):
+        return db.session.query( ItemMeta.id ) \
+            .filter( ItemMeta.key == key ) \
+            .first() is not None
+
+    @staticmethod
+    def search_meta( compare ):
+
+        ''' Translate a Compare on a meta key with no column of its own into
+        a lookup of matching item IDs. Numbers compare against the number
+        column, so ranges are index range scans on (key, number). '''
+
+        key, value = compare.children
+        column = ItemMeta.number if isinstance( value, (int, float) ) \
+            else ItemMeta.value
+
+        if SearchLexerParser.Op.eq == compare.op:
+            condition = (column == value)
+        elif SearchLexerParser.Op.gt == compare.op:
+            condition = (column > value)
+        elif SearchLexerParser.Op.lt == compare.op:
+            condition = (column < value)
+        elif SearchLexerParser.Op.gte == compare.op:
+            condition = (column >= value)
+        elif SearchLexerParser.Op.lte == compare.op:
+            condition = (column <= value)
+        elif SearchLexerParser.Op.like == compare.op:
+            condition = column.like( value )
+        elif SearchLexerParser.Op.one_of == compare.op:
+            column = ItemMeta.number \
+                if isinstance( value[0], (int, float) ) else ItemMeta.value
+            condition = column.in_( value )
+        elif SearchLexerParser.Op.neq == compare.op:
+            # Items without the key at all count as not equal.
+            return ~Item.id.in_( db.session.query( ItemMeta.item_id ) \
+                .filter( ItemMeta.key == key ) \
+                .filter( column == value ) )
+        else:
+            raise SearchExecuteException(
+                'invalid operator for attribute "{}"'.format( key ) )
+
+        return Item.id.in_( db.session.query( ItemMeta.item_id ) \
+            .filter( ItemMeta.key == key ) \
+            .filter( condition ) )
+
+    @staticmethod
+    def search_tags( compare ):
+
+        ''' Translate a planned ('tags', names) Compare into a lookup of the
+        IDs of items tagged with any (one_of) or all (all_of) of the names,
+        through the items_tags index rather than an EXISTS per name. '''
+
+        names = compare.children[1]
+        tagged = db.session.query( items_tags.c.items_id ) \
+            .join( Tag, Tag.id == items_tags.c.tags_id ) \
+            .filter( Tag.name.in_( names ) )
+
+        if SearchLexerParser.Op.all_of == compare.op and 1 < len( names ):
+            # Names are not unique across the tree, so count the names.
+            tagged = tagged \
+                .group_by( items_tags.c.items_id ) \
+                .having( db.func.count( db.distinct( Tag.name ) ) == \
+                    len( names ) )
+
+        return Item.id.in_( tagged )
+
+    @staticmethod
+    def search_text( compare ):
+
+        ''' Translate a Compare of the form field~"words" into a lookup in
+        the full-text index. The field "text" searches every field. '''
+
+        from .fulltext import index_for, FULLTEXT_FIELDS, FullTextIndex
+
+        field, text = compare.children
+        if 'text' != field and field not in FULLTEXT_FIELDS:
+            raise SearchExecuteException(
+                'invalid full-text attribute "{}" specified'.format( field ) )
+        if not FullTextIndex.terms( text ):
+            raise SearchExecuteException( 'no words to search for' )
+
+        index = index_for( db.engine )
+        if not index:
+            raise SearchExecuteException(
+                'full-text search is not available on this database' )
+
+        return Item.id.in_(
+            index.match( text, None if 'text' == field else field ) )
+
+    def search( self, user_id ):
+        return Item.secure_query( user_id ).filter( self.filter() )
+
+    def filter( self, _tree_start=None ):
+
+        ''' Translate the tree (from _tree_start down) into a filter
+        expression. The expression does not depend on the user, so it may
+        be reused across requests. The whole tree is run through the
+        SearchPlanner first; a subtree passed in is translated as is. '''
 
         if not _tree_start:
-            _tree_start = self.lexer.root
+            _tree_start = SearchPlanner.plan( self.lexer.root )
 
         if isinstance( _tree_start, SearchLexerParser.Group ):
             child_filter_list = []
             for c in _tree_start.children:
-                child_filter_list.append( self.search( user_id, c, _query ) )
+                child_filter_list.append( self.filter( c ) )
 
             filter_out = None
             if isinstance( _tree_start, SearchLexerParser.Or ):
@@ -415,23 +699,30 @@ class Searcher( object ):
                 # If it's not an or then it's an and.
                 filter_out = db.and_( *child_filter_list )
 
-            if _tree_start.parent:
-                return filter_out
-            else:
-                return _query.filter( filter_out )
+            return filter_out
 
         elif isinstance( _tree_start, SearchLexerParser.Compare ):
 
             # TODO: Get plugin model or something.
             from cloud_on_film.files.picture import Picture
 
-            if SearchLexerParser.Op.in_ == _tree_start.op:
+            if _tree_start.op in \
+            (SearchLexerParser.Op.one_of, SearchLexerParser.Op.all_of) and \
+            SearchPlanner.TAG_ATTRIBUTE == _tree_start.children[0]:
+                return self.search_tags( _tree_start )
+
+            elif SearchLexerParser.Op.match == _tree_start.op:
+                return self.search_text( _tree_start )
+
+            elif SearchLexerParser.Op.in_ == _tree_start.op:
                 # Special ops that use the attrib postfix.
                 if not hasattr( Picture, _tree_start.children[1] ):
                     raise SearchExecuteException( 'invalid attribute "{}" specified'.format( _tree_start.children[1] ) )
 
             elif not hasattr( Picture, _tree_start.children[0] ):
-                raise SearchExecuteException( 'invalid attribute "{}" specified'.format( _tree_start.children[0] ) )
+                if not self.is_meta_key( _tree_start.children[0] ):
+                    raise SearchExecuteException( 'invalid attribute "{}" specified'.format( _tree_start.children[0] ) )
+                return self.search_meta( _tree_start )
 
             if SearchLexerParser.Op.eq == _tree_start.op:
                 return (getattr( Picture, _tree_start.children[0] ) == _tree_start.children[1])
@@ -447,9 +738,111 @@ class Searcher( object ):
                 return (getattr( Picture, _tree_start.children[0] ) != _tree_start.children[1])
             elif SearchLexerParser.Op.like == _tree_start.op:
                 return (getattr( Picture, _tree_start.children[0] ).like( _tree_start.children[1] ))
+            elif SearchLexerParser.Op.one_of == _tree_start.op:
+                return (getattr( Picture, _tree_start.children[0] ).in_( _tree_start.children[1] ))
             elif SearchLexerParser.Op.in_ == _tree_start.op:
                 #if 'tags' == _tree_start.children[1]:
                 #    _tree_start.children = (Tag.from_path(_tree_start.children[1] ), 'tag_ids')
                 return getattr( Picture, _tree_start.children[1] ).any( name=_tree_start.children[0] )
 
-        return _query
+        raise SearchExecuteException( 'invalid search tree' )
+
+    @staticmethod
+    def compile( query_str ):
+
+        ''' Return the filter for query_str, lexing and translating it only
+        the first time its normalized form is seen. Raises the same
+        exceptions as lex() and filter(); failures are not cached. '''
+
+        key = SearchLexerParser.normalize( query_str )
+        search_filter = search_filter_cache.get( key )
+        if search_filter is None:
+            searcher = Searcher( key )
+            searcher.lexer.lex()
+            search_filter = searcher.filter()
+            search_filter_cache.set( key, search_filter )
+        return search_filter
+
+    @staticmethod
+    def query( query_str, user_id ):
+
+        ''' Return a query of the items matching query_str that user_id may
+        see, through the compiled filter cache. '''
+
+        return Item.secure_query( user_id ) \
+            .filter( Searcher.compile( query_str ) )
+
+    @staticmethod
+    def page( query_str, user_id, after, limit ):
+
+        ''' Return a page of the items matching query_str that user_id may
+        see and the token for the next page, as paging.seek() does. The
+        SQL for each query is compiled once and reused for every user and
+        page. '''
+
+        from .paging import seek_cached
+
+        search_filter = Searcher.compile( query_str )
+        key = (SearchLexerParser.normalize( query_str ), 0 <= user_id,
+            id( Plugin.polymorph() ))
+
+        return seek_cached( key,
+            lambda session: Item.secure_query( user_id ) \
+                .with_session( session ) \
+                .filter( search_filter ),
+            after, limit, user_id=user_id )
+
+    @staticmethod
+    def snapshot( query_str, user_id ):
+
+        ''' Return the SearchSnapshot of query_str for user_id, running the
+        search only if nothing was written to items since it was taken. '''
+
+        version = DataVersion.get( DataVersion.ITEMS )
+        key = (SearchLexerParser.normalize( query_str ), user_id, version)
+        snapshot = search_snapshot_cache.get( key )
+        if snapshot is None:
+            ids = [r[0] for r in Searcher.query( query_str, user_id ) \
+                .with_entities( Item.id ) \
+                .order_by( Item.name, Item.id ) \
+                .limit( SEARCH_SNAPSHOT_MAX_IDS + 1 )]
+            snapshot = SearchSnapshot( ids[:SEARCH_SNAPSHOT_MAX_IDS],
+                len( ids ) <= SEARCH_SNAPSHOT_MAX_IDS )
+
+            # Snapshots of older versions can never be hit again.
+            search_snapshot_cache.evict( lambda k: k[2] != version )
+            search_snapshot_cache.set( key, snapshot )
+        return snapshot
+
+    @staticmethod
+    def page_snapshot( query_str, user_id, after, limit ):
+
+        ''' Like page(), but slice the page from the search's snapshot and
+        load just its rows by ID. Tokens are the same as page()'s, so a
+        page that falls outside the snapshot is fetched with page(). '''
+
+        from .paging import decode_cursor, encode_cursor
+
+        snapshot = Searcher.snapshot( query_str, user_id )
+
+        start = 0
+        if after:
+            start = snapshot.positions.get( decode_cursor( after )[1] )
+            if start is None:
+                return Searcher.page( query_str, user_id, after, limit )
+            start += 1
+
+        page_ids = snapshot.ids[start:start + limit]
+        if len( page_ids ) < limit and not snapshot.complete:
+            return Searcher.page( query_str, user_id, after, limit )
+
+        items = {}
+        if page_ids:
+            items = {i.id: i for i in Item.secure_query( user_id ) \
+                .filter( Item.id.in_( page_ids ) )}
+        items = [items[i] for i in page_ids if i in items]
+
+        if not items or (snapshot.complete and \
+        start + limit >= len( snapshot.ids )):
+            return items, None
+        return items, encode_cursor( items[-1] )
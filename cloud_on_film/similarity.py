@@ -0,0 +1,185 @@
+import threading
+from collections import defaultdict
+
+import numpy
+from PIL import Image
+
+from .models import db, DataVersion, Item, ItemMeta, PHASH_META_KEY
+
+# Side of the downscaled image the DCT is taken over, and of the block of
+# low frequencies kept from it (giving an 8 * 8 = 64-bit hash).
+PHASH_SIZE = 32
+PHASH_LOW_SIZE = 8
+
+# Pictures within this many differing bits are considered near-duplicates.
+DEFAULT_MAX_DISTANCE = 8
+
+def _dct_matrix( size ):
+    k = numpy.arange( size ).reshape( (size, 1) )
+    n = numpy.arange( size ).reshape( (1, size) )
+    matrix = numpy.cos( numpy.pi * (2 * n + 1) * k / (2 * size) )
+    matrix[0, :] *= numpy.sqrt( 1.0 / size )
+    matrix[1:, :] *= numpy.sqrt( 2.0 / size )
+    return matrix
+
+_DCT = _dct_matrix( PHASH_SIZE )
+
+def perceptual_hash( image ):
+
+    ''' Return the 64-bit DCT perceptual hash (pHash) of a PIL image as a
+    16-character hex string. '''
+
+    # Let JPEG decoding downscale in the DCT domain; this is only a hint.
+    image.draft( 'L', (PHASH_SIZE * 2, PHASH_SIZE * 2) )
+    pixels = numpy.asarray(
+        image.convert( 'L' ).resize( (PHASH_SIZE, PHASH_SIZE), Image.BILINEAR ),
+        dtype=numpy.float64 )
+
+    dct = _DCT.dot( pixels ).dot( _DCT.T )
+    low = dct[:PHASH_LOW_SIZE, :PHASH_LOW_SIZE].flatten()
+
+    # Compare against the median, leaving out the DC term which only
+    # reflects overall brightness.
+    bits = low > numpy.median( low[1:] )
+
+    return '{:016x}'.format(
+        int( numpy.packbits( bits ).view( '>u8' )[0] ) )
+
+def hamming( hash_a, hash_b ):
+    return bin( hash_a ^ hash_b ).count( '1' )
+
+class BKTree( object ):
+
+    ''' A Burkhard-Keller tree over integer hashes using Hamming distance,
+    so radius searches only visit subtrees that could hold a match. '''
+
+    def __init__( self ):
+        self.root = None
+        self.size = 0
+
+    def add( self, hash_int, item_id ):
+
+        self.size += 1
+
+        if not self.root:
+            # Each node is [hash, item IDs, children by distance].
+            self.root = [hash_int, [item_id], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming( hash_int, node[0] )
+            if 0 == distance:
+                node[1].append( item_id )
+                return
+            elif distance in node[2]:
+                node = node[2][distance]
+            else:
+                node[2][distance] = [hash_int, [item_id], {}]
+                return
+
+    def search( self, hash_int, max_distance ):
+
+        ''' Return a list of (item ID, distance) within max_distance. '''
+
+        found = []
+        if not self.root:
+            return found
+
+        candidates = [self.root]
+        while candidates:
+            node = candidates.pop()
+            distance = hamming( hash_int, node[0] )
+            if distance <= max_distance:
+                found += [(i, distance) for i in node[1]]
+
+            # By the triangle inequality, only children in this band can
+            # hold matches.
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= \
+                distance + max_distance:
+                    candidates.append( child )
+
+        return found
+
+class SimilarityIndex( object ):
+
+    ''' An in-process BK-tree of every stored picture hash, rebuilt only
+    when a hash has been written since (by any process), as told by the
+    PHASH data version. '''
+
+    _lock = threading.Lock()
+    _tree = None
+    _hashes = None
+    _version = None
+
+    @staticmethod
+    def load():
+
+        ''' Return (tree, hashes by item ID), rebuilding them if needed. '''
+
+        version = DataVersion.get( DataVersion.PHASH )
+        with SimilarityIndex._lock:
+            if version != SimilarityIndex._version:
+                tree = BKTree()
+                hashes = {}
+                for item_id, value in db.session.query(
+                    ItemMeta.item_id, ItemMeta.value ) \
+                    .filter( ItemMeta.key == PHASH_META_KEY ) \
+                    .yield_per( 1000 ):
+                    hashes[item_id] = int( value, 16 )
+                    tree.add( hashes[item_id], item_id )
+                SimilarityIndex._tree = tree
+                SimilarityIndex._hashes = hashes
+                SimilarityIndex._version = version
+
+            return SimilarityIndex._tree, SimilarityIndex._hashes
+
+    @staticmethod
+    def similar( item_id, user_id, max_distance=DEFAULT_MAX_DISTANCE ):
+
+        ''' Return a list of (item, distance) for ACCESSIBLE pictures within
+        max_distance of the given item, nearest first. '''
+
+        tree, hashes = SimilarityIndex.load()
+        if item_id not in hashes:
+            return []
+
+        distances = {i: d for i, d in
+            tree.search( hashes[item_id], max_distance ) if i != item_id}
+        if not distances:
+            return []
+
+        items = Item.secure_query( user_id ) \
+            .filter( Item.id.in_( list( distances.keys() ) ) ) \
+            .all()
+
+        return sorted( [(i, distances[i.id]) for i in items],
+            key=lambda r: (r[1], r[0].id) )
+
+    @staticmethod
+    def clusters( max_distance=DEFAULT_MAX_DISTANCE ):
+
+        ''' Return a sorted list of near-duplicate clusters, each a sorted
+        list of item IDs, across the whole index. '''
+
+        tree, hashes = SimilarityIndex.load()
+
+        parents = {i: i for i in hashes}
+
+        def root( item_id ):
+            while parents[item_id] != item_id:
+                parents[item_id] = parents[parents[item_id]]
+                item_id = parents[item_id]
+            return item_id
+
+        for item_id, hash_int in hashes.items():
+            for match_id, distance in tree.search( hash_int, max_distance ):
+                parents[root( match_id )] = root( item_id )
+
+        clusters = defaultdict( list )
+        for item_id in hashes:
+            clusters[root( item_id )].append( item_id )
+
+        return sorted(
+            [sorted( c ) for c in clusters.values() if 1 < len( c )] )
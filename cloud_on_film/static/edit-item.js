@@ -21,7 +21,8 @@ function editItem( id ) {
         $('#form-edit #name').val( itemData['name'] );
         $('#form-edit #comment').val( itemData['comment'] );
         let img_preview_tag = $('<img src="' + flaskRoot + 'contents/preview/' +
-            itemData['id'] + '?width=230&height=172" id="form-edit-preview-img" ' +
+            itemData['id'] + '?width=230&height=172&v=' + itemData['hash'] +
+            '" id="form-edit-preview-img" ' +
             'class="d-block w-100" style="display: none;" />');
         $('#form-edit-preview').empty();
         $('#form-edit-preview').append( img_preview_tag );
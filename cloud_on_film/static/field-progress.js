@@ -11,6 +11,8 @@ function updateProgress( url ) {
                 .css( { 'width': data['progress'] + '%' } );
         }
         last_progress = data['progress'];
-        setTimeout( updateProgress, 1000 );
+        if( 'pending' == data['status'] || 'running' == data['status'] ) {
+            setTimeout( function() { updateProgress( url ); }, 1000 );
+        }
     } );
 }
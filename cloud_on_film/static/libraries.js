@@ -48,15 +48,13 @@ $().ready( function() {
          query_str = '?csrf_token=' + csrfToken + '&keywords=' + encodeURI( keywords );
       } */
 
-      if( typeof page === 'undefined' ) {
-         // Only do pager stuff if page variable is defined.
+      if( typeof nextPage === 'undefined' || null === nextPage ) {
+         // Only do pager stuff if there is a page after this one.
          return;
       }
 
-      page += 1;
-      let pageRE = new RegExp( '%page%', 'g' );
       let folderIDRE = new RegExp( '%folder%', 'g' );
-      let loadURL = scrollURL.replace( pageRE, page.toString() ).replace( folderIDRE, folderID.toString() );
+      let loadURL = scrollURL.replace( folderIDRE, folderID.toString() );
       let scrollObject = {
          url: loadURL,
          method: scrollMethod
@@ -74,16 +72,18 @@ $().ready( function() {
 
       // Grab the next [loadIncrement] columns and append them to the table.
       $.ajax( scrollObject ).done( function( data ) {
-         for( var i = 0 ; data.length > i ; i++ ) {
-            let element = $(data[i]);
+         for( var i = 0 ; data.items.length > i ; i++ ) {
+            let element = $(data.items[i]);
             $('#folder-items').append( element );
             element.enableThumbnailCard();
          }
 
          recreateItemSpacers();
 
-         // Re-enable scrolling after get is finished.
-         if( 0 < data.length ) {
+         // Re-enable scrolling after get is finished, unless that was the
+         // last page.
+         nextPage = data.next;
+         if( null !== nextPage ) {
             scrollingEnabled = true;
          }
       } );
@@ -6,12 +6,12 @@ var searchSubmitTimer = null;
 $.fn.searchSubmitAJAX = function() {
     
     console.log( 'submitting search...' );
-    page = 0; // Starting a new search.
+    nextPage = null; // Starting a new search.
 
     let formUUID = $(this).parents( 'form' ).attr( 'data-form-uuid' );
     let queryText = $('#' + formUUID + '-query').val();
 
-    $('.search-query .page').val( page.toString() );
+    $('.search-query .after').val( '' );
     $.ajax( {
         url: flaskRoot + 'ajax/html/search?query=' + encodeURIComponent( queryText ),
         type: 'GET',
@@ -19,8 +19,8 @@ $.fn.searchSubmitAJAX = function() {
 
             clearDynamicPage();
 
-            for( var i = 0 ; data.length > i ; i++ ) {
-                let element = $(data[i]);
+            for( var i = 0 ; data.items.length > i ; i++ ) {
+                let element = $(data.items[i]);
                 $('#folder-items').append( element );
                 $(element).enableThumbnailCard();
             }
@@ -28,15 +28,12 @@ $.fn.searchSubmitAJAX = function() {
             recreateItemSpacers();
             scrollURL = flaskRoot + 'ajax/html/search';
             scrollArgsCallback = searchArgs;
-            scrollArgsCaller = this;
+            scrollArgsCaller = queryText;
             scrollMethod = 'GET';
-    
-            // Re-enable scrolling after get is finished.
-            /* if( 0 < data.length ) {
-                scrollingEnabled = true;
-            } else {
-                scrollingEnabled = false;
-            } */
+
+            // Continue from the end of these results on scroll.
+            nextPage = data.next;
+            scrollingEnabled = null !== nextPage;
         }
     } );
 }
@@ -48,8 +45,9 @@ $.fn.searchSubmitAJAX = function() {
     return $('#search-query').serialize();
 } */
 
-function searchArgs( element ) {
-    return 'query=' + $(element).val() + '&page=' + page.toString();
+function searchArgs( queryText ) {
+    return 'query=' + encodeURIComponent( queryText ) +
+        '&after=' + encodeURIComponent( nextPage );
 }
 
 var searchCallerElement = null;
@@ -0,0 +1,280 @@
+import io
+import os
+import time
+import uuid
+import logging
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from PIL import Image
+
+from .models import \
+    db, \
+    Item, \
+    Folder, \
+    Library, \
+    ThumbnailJob, \
+    JobStatusEnum
+
+THUMBNAIL_QUALITY = 75
+
+# Images are shrunk with cheap integer reduction (in the JPEG decoder or by
+# reduce()) only down to this multiple of the target, then LANCZOS does the
+# rest, which keeps the output indistinguishable from a full resample.
+REDUCING_GAP = 2
+
+# Jobs left running longer than this (e.g. by a killed worker) are retried.
+STALE_JOB_SECONDS = 600
+
+# How often a waiting preview request checks for its thumbnail.
+WAIT_POLL_SECONDS = 0.1
+
+PLACEHOLDER_COLOR = (64, 64, 64)
+
+def allowed_previews( config=None ):
+
+    ''' Return the ALLOWED_PREVIEWS config as a list of (width, height). '''
+
+    config = config if config else current_app.config
+    return [tuple( [int( i ) for i in r.split( ',' )] )
+        for r in config['ALLOWED_PREVIEWS']]
+
+def store():
+    return current_app.extensions['thumbnail_store']
+
+def thumbnail_file( item_hash, size ):
+    return store().path( item_hash, size )
+
+def _fit( source_size, size ):
+
+    ''' Return source_size scaled to fit within size, keeping the aspect
+    ratio and never enlarging (like Image.thumbnail()). '''
+
+    ratio = min( size[0] / source_size[0], size[1] / source_size[1] )
+    if 1 <= ratio:
+        return source_size
+    return (max( 1, round( source_size[0] * ratio ) ),
+        max( 1, round( source_size[1] * ratio ) ))
+
+def render_thumbnails( source_path, targets ):
+
+    ''' Render the source image into each (size, thumbnail path) in
+    targets from a single decode. Runs in the worker processes, so it must
+    not touch the app or the DB. Return None, or an error message. '''
+
+    logger = logging.getLogger( 'thumbnails' )
+
+    if not targets:
+        return None
+
+    try:
+        with Image.open( source_path ) as im:
+            source_size = im.size
+            fits = [_fit( source_size, size ) for size, thumb_path in targets]
+
+            # Let JPEG decoding downscale in the DCT domain, to no less than
+            # REDUCING_GAP times the largest thumbnail so LANCZOS still has
+            # pixels to work with.
+            im.draft( 'RGB', (
+                max( f[0] for f in fits ) * REDUCING_GAP,
+                max( f[1] for f in fits ) * REDUCING_GAP) )
+            try:
+                im.load()
+            except OSError as e:
+                # Truncated files still yield what was decoded.
+                logger.warning( 'while generating thumbnail for %s: %s',
+                    source_path, e )
+            if im.mode not in ('RGB', 'RGBA', 'L'):
+                im = im.convert( 'RGBA' )
+
+            # Largest first, so each size starts from the reduction made for
+            # the one before it.
+            order = sorted( range( len( targets ) ),
+                key=lambda i: fits[i][0] * fits[i][1], reverse=True )
+            for idx in order:
+                size, thumb_path = targets[idx]
+                fit = fits[idx]
+
+                factor = int( min( im.size[0] / (fit[0] * REDUCING_GAP),
+                    im.size[1] / (fit[1] * REDUCING_GAP) ) )
+                if 2 <= factor:
+                    im = im.reduce( factor )
+                scaled = im if im.size == fit \
+                    else im.resize( fit, Image.LANCZOS )
+
+                thumb = Image.new( 'RGB', size, (0, 0, 0) )
+                thumb.paste( scaled,
+                    (int( (size[0] - scaled.size[0]) / 2 ),
+                    int( (size[1] - scaled.size[1]) / 2 )) )
+
+                # Write beside the target and rename, so readers never see
+                # a partial file. Only the top level of shards is created
+                # up front.
+                os.makedirs( os.path.dirname( thumb_path ), exist_ok=True )
+                temp_path = '{}.{}.tmp'.format( thumb_path, os.getpid() )
+                thumb.save( temp_path, 'JPEG', quality=THUMBNAIL_QUALITY )
+                os.replace( temp_path, thumb_path )
+    except (OSError, IOError) as e:
+        return str( e )[:256]
+
+    return None
+
+@lru_cache( maxsize=16 )
+def placeholder( size ):
+
+    ''' Return the JPEG bytes of a plain placeholder of the given size. '''
+
+    buf = io.BytesIO()
+    Image.new( 'RGB', size, PLACEHOLDER_COLOR ) \
+        .save( buf, 'JPEG', quality=THUMBNAIL_QUALITY )
+    return buf.getvalue()
+
+def wait_for( thumb_path, timeout ):
+
+    ''' Poll for thumb_path to appear for up to timeout seconds. '''
+
+    deadline = time.time() + timeout
+    while not os.path.exists( thumb_path ):
+        if time.time() >= deadline:
+            return False
+        time.sleep( WAIT_POLL_SECONDS )
+    return True
+
+def enqueue( item_ids ):
+
+    ''' Mark the given items as needing thumbnails. Jobs already pending or
+    running are left alone. Does not commit. '''
+
+    item_ids = list( set( item_ids ) )
+    if not item_ids:
+        return
+
+    now = int( time.time() )
+    existing = {}
+    for job in db.session.query( ThumbnailJob ) \
+    .filter( ThumbnailJob.item_id.in_( item_ids ) ):
+        existing[job.item_id] = job
+
+    for job in existing.values():
+        if job.status not in (JobStatusEnum.pending, JobStatusEnum.running):
+            job.status = JobStatusEnum.pending
+            job.timestamp = now
+            job.note = None
+
+    db.session.bulk_insert_mappings( ThumbnailJob, [{
+        'item_id': item_id,
+        'status': JobStatusEnum.pending,
+        'timestamp': now
+    } for item_id in item_ids if item_id not in existing] )
+
+class ThumbnailWorker( object ):
+
+    ''' Drains the thumbnail job queue, rendering every allowed preview size
+    of each queued item across a pool of worker processes. Several workers
+    may share a queue; jobs are claimed with a conditional update. '''
+
+    def __init__( self, workers=None, batch_size=100 ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.sizes = allowed_previews()
+        self.logger = logging.getLogger( 'thumbnails' )
+        self.done = 0
+        self.failed = 0
+        self.store = store()
+
+    def _reset_stale( self ):
+        db.session.query( ThumbnailJob ) \
+            .filter( ThumbnailJob.status == JobStatusEnum.running ) \
+            .filter( ThumbnailJob.timestamp < \
+                int( time.time() ) - STALE_JOB_SECONDS ) \
+            .update( {ThumbnailJob.status: JobStatusEnum.pending},
+                synchronize_session=False )
+        db.session.commit()
+
+    def _claim( self ):
+
+        ''' Mark a batch of pending jobs as ours. Return the number claimed
+        and the jobs with the details needed to render their items. Jobs
+        whose item has gone are deleted rather than returned. '''
+
+        job_ids = [r[0] for r in db.session.query( ThumbnailJob.id ) \
+            .filter( ThumbnailJob.status == JobStatusEnum.pending ) \
+            .order_by( ThumbnailJob.id ) \
+            .limit( self.batch_size )]
+        if not job_ids:
+            return 0, []
+
+        token = uuid.uuid4().hex
+        claimed = db.session.query( ThumbnailJob ) \
+            .filter( ThumbnailJob.id.in_( job_ids ) ) \
+            .filter( ThumbnailJob.status == JobStatusEnum.pending ) \
+            .update( {
+                ThumbnailJob.status: JobStatusEnum.running,
+                ThumbnailJob.timestamp: int( time.time() ),
+                ThumbnailJob.note: token}, synchronize_session=False )
+        db.session.commit()
+
+        rows = db.session.query( ThumbnailJob, Item.hash,
+            Library.absolute_path, Folder.path, Item.name ) \
+            .join( Item, ThumbnailJob.item_id == Item.id ) \
+            .join( Folder, Item.folder_id == Folder.id ) \
+            .join( Library, Folder.library_id == Library.id ) \
+            .filter( ThumbnailJob.note == token ) \
+            .all()
+
+        if len( rows ) < claimed:
+            orphans = db.session.query( ThumbnailJob ) \
+                .filter( ThumbnailJob.note == token ) \
+                .filter( ~ThumbnailJob.id.in_( [r[0].id for r in rows] ) ) \
+                .delete( synchronize_session=False )
+            db.session.commit()
+            self.logger.warning(
+                'removed %d thumbnail jobs for missing items', orphans )
+
+        return claimed, rows
+
+    def run( self, pool ):
+
+        ''' Process claimed batches until the queue is empty. '''
+
+        self._reset_stale()
+
+        claimed, rows = self._claim()
+        while claimed:
+            futures = []
+            written = []
+            for job, item_hash, lib_path, folder_path, name in rows:
+                targets = [(size, self.store.path( item_hash, size ))
+                    for size in self.sizes]
+                targets = [t for t in targets if not os.path.exists( t[1] )]
+                written += [t[1] for t in targets]
+                futures.append( (job, pool.submit( render_thumbnails,
+                    os.path.join( lib_path, folder_path, name ), targets )) )
+
+            for job, future in futures:
+                error = future.result()
+                job.status = \
+                    JobStatusEnum.failed if error else JobStatusEnum.done
+                job.timestamp = int( time.time() )
+                job.note = error
+                if error:
+                    self.failed += 1
+                    self.logger.warning(
+                        'thumbnails failed for item %d: %s', job.item_id, error )
+                else:
+                    self.done += 1
+            db.session.commit()
+
+            self.store.record( written )
+
+            claimed, rows = self._claim()
+
+        return self.done, self.failed
+
+    def process( self ):
+
+        ''' Drain the queue once with a private process pool. '''
+
+        with ProcessPoolExecutor( max_workers=self.workers ) as pool:
+            return self.run( pool )
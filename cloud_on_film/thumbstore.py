@@ -0,0 +1,202 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+INDEX_NAME = 'index.sqlite3'
+
+# Eviction frees space down to this fraction of the budget, so it does not
+# run again on the very next write.
+EVICT_LOW_WATER = 0.9
+
+class ThumbnailStore( object ):
+
+    ''' Content-addressed thumbnail files under root, sharded by the first
+    two pairs of hash digits (root/ab/cd/abcd..._160x120.jpg) so no single
+    directory grows too large to search.
+
+    A small SQLite index beside the shards tracks the size and last use of
+    each file, so the least recently used ones can be evicted once the
+    store grows past max_bytes. Uses are buffered in memory and written at
+    most every touch_interval seconds. '''
+
+    def __init__( self, root, max_bytes=None, touch_interval=60 ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.logger = logging.getLogger( 'thumbnails.store' )
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._touched = {}
+        self._last_flush = time.time()
+
+    def prepare( self ):
+
+        ''' Create the root, the top level of shards and the index. Call
+        once at startup; nothing checks for them afterwards. '''
+
+        for shard in range( 256 ):
+            os.makedirs( os.path.join( self.root, '{:02x}'.format( shard ) ),
+                exist_ok=True )
+        with self._lock:
+            self._db()
+
+    def _db( self ):
+
+        # Connections may not cross a fork, so each process opens its own.
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(
+                os.path.join( self.root, INDEX_NAME ),
+                timeout=30, check_same_thread=False, isolation_level=None )
+            self._conn.execute( 'PRAGMA journal_mode=WAL' )
+            self._conn.execute( 'CREATE TABLE IF NOT EXISTS thumbnails ( ' \
+                'name TEXT PRIMARY KEY, size INTEGER NOT NULL, ' \
+                'atime INTEGER NOT NULL )' )
+            self._conn.execute( 'CREATE INDEX IF NOT EXISTS ' \
+                'ix_thumbnails_atime ON thumbnails ( atime )' )
+            self._conn.execute( 'CREATE TABLE IF NOT EXISTS totals ( ' \
+                'id INTEGER PRIMARY KEY, size INTEGER NOT NULL )' )
+            self._conn.execute(
+                'INSERT OR IGNORE INTO totals ( id, size ) VALUES ( 1, 0 )' )
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def name( item_hash, size ):
+        return '{}_{}x{}.jpg'.format( item_hash, size[0], size[1] )
+
+    def path_for( self, name ):
+        return os.path.join( self.root, name[0:2], name[2:4], name )
+
+    def path( self, item_hash, size ):
+        return self.path_for( ThumbnailStore.name( item_hash, size ) )
+
+    def total( self ):
+        with self._lock:
+            return self._db().execute(
+                'SELECT size FROM totals WHERE id = 1' ).fetchone()[0]
+
+    def __len__( self ):
+        with self._lock:
+            return self._db().execute(
+                'SELECT COUNT(*) FROM thumbnails' ).fetchone()[0]
+
+    def record( self, paths ):
+
+        ''' Add newly written thumbnails to the index, then evict if the
+        store is over budget. '''
+
+        now = int( time.time() )
+        rows = []
+        for thumb_path in paths:
+            try:
+                rows.append(
+                    (os.path.basename( thumb_path ),
+                    os.stat( thumb_path ).st_size) )
+            except FileNotFoundError:
+                continue
+
+        if rows:
+            with self._lock:
+                conn = self._db()
+                # The connection commits, or rolls back on error.
+                conn.execute( 'BEGIN IMMEDIATE' )
+                with conn:
+                    for name, size in rows:
+                        old = conn.execute(
+                            'SELECT size FROM thumbnails WHERE name = ?',
+                            (name,) ).fetchone()
+                        conn.execute( 'INSERT OR REPLACE INTO thumbnails ' \
+                            '( name, size, atime ) VALUES ( ?, ?, ? )',
+                            (name, size, now) )
+                        conn.execute(
+                            'UPDATE totals SET size = size + ? WHERE id = 1',
+                            (size - (old[0] if old else 0),) )
+
+        self.evict()
+
+    def touch( self, thumb_path ):
+
+        ''' Note that a thumbnail was served. '''
+
+        now = time.time()
+        with self._lock:
+            self._touched[os.path.basename( thumb_path )] = int( now )
+            if now - self._last_flush >= self.touch_interval:
+                self._flush_touched()
+
+    def _flush_touched( self ):
+
+        # Call with the lock held.
+        touched = self._touched
+        self._touched = {}
+        self._last_flush = time.time()
+        self._db().executemany(
+            'UPDATE thumbnails SET atime = ? WHERE name = ?',
+            [(t, n) for n, t in touched.items()] )
+
+    def evict( self ):
+
+        ''' Delete least recently used thumbnails until the store is back
+        under EVICT_LOW_WATER of its budget. Return the bytes freed. '''
+
+        if not self.max_bytes or self.total() <= self.max_bytes:
+            return 0
+
+        target = self.total() - int( self.max_bytes * EVICT_LOW_WATER )
+        freed = 0
+        with self._lock:
+            # Recent uses must count before choosing what to drop.
+            self._flush_touched()
+            conn = self._db()
+            while freed < target:
+                rows = conn.execute( 'SELECT name, size FROM thumbnails ' \
+                    'ORDER BY atime LIMIT 100' ).fetchall()
+                if not rows:
+                    break
+
+                evicted = []
+                for name, size in rows:
+                    if freed >= target:
+                        break
+                    try:
+                        os.unlink( self.path_for( name ) )
+                    except FileNotFoundError:
+                        pass
+                    freed += size
+                    evicted.append( (name, size) )
+                    self._touched.pop( name, None )
+
+                conn.execute( 'BEGIN IMMEDIATE' )
+                with conn:
+                    conn.executemany( 'DELETE FROM thumbnails WHERE name = ?',
+                        [(e[0],) for e in evicted] )
+                    conn.execute(
+                        'UPDATE totals SET size = size - ? WHERE id = 1',
+                        (sum( e[1] for e in evicted ),) )
+
+        self.logger.info( 'evicted %d bytes of thumbnails', freed )
+        return freed
+
+    def reindex( self ):
+
+        ''' Rebuild the index from the files on disk. Return their count. '''
+
+        names = []
+        for dir_path, dir_names, file_names in os.walk( self.root ):
+            if dir_path != self.root:
+                names += [os.path.join( dir_path, f ) for f in file_names
+                    if f.endswith( '.jpg' )]
+
+        with self._lock:
+            conn = self._db()
+            conn.execute( 'BEGIN IMMEDIATE' )
+            with conn:
+                conn.execute( 'DELETE FROM thumbnails' )
+                conn.execute( 'UPDATE totals SET size = 0 WHERE id = 1' )
+            self._touched = {}
+
+        self.record( names )
+        return len( names )
@@ -42,7 +42,8 @@ class TestAJAX( TestCase ):
 
         item_data = json.loads( res.data )
 
-        self.assertEqual( 2, len( item_data['_meta'] ) )
+        # width, height and phash.
+        self.assertEqual( 3, len( item_data['_meta'] ) )
         self.assertEqual( 0, item_data['rating'] )
 
     def test_ajax_get_item_location( self ):
@@ -91,7 +92,35 @@ class TestAJAX( TestCase ):
             r'?query=%26%28%28rating%3D1%29%28nsfw%3D1%29%29' )
 
         items = json.loads( res.data )
-        self.assertEqual( 1, len( items ) )
+        self.assertEqual( 1, len( items['items'] ) )
+        self.assertIsNone( items['next'] )
+
+    def test_ajax_html_items_pages( self ):
+
+        from cloud_on_film.models import Item
+
+        folder_id = db.session.query( Item ) \
+            .filter( Item.name == 'random640x400.png' ).one().folder_id
+
+        self.app.config['ITEMS_PER_PAGE'] = 1
+        pages = []
+        url = '/ajax/html/items/{}'.format( folder_id )
+        while url:
+            res = self.client.get( url )
+            self.assertStatus( res, 200 )
+            page = json.loads( res.data )
+            self.assertEqual( 1, len( page['items'] ) )
+            pages.append( page['items'][0] )
+            url = '/ajax/html/items/{}?after={}'.format(
+                folder_id, page['next'] ) if page['next'] else None
+
+        self.assertEqual( 2, len( pages ) )
+        self.assertIn( 'random640x400.png', pages[0] )
+        self.assertIn( 'random640x480.png', pages[1] )
+
+        res = self.client.get(
+            '/ajax/html/items/{}?after=garbage'.format( folder_id ) )
+        self.assertStatus( res, 400 )
 
     def test_list_ajax_tags_show_empty( self ):
 
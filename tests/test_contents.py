@@ -82,4 +82,71 @@ class TestContents( TestCase ):
 
         self.assertEqual( 100, image.width )
         self.assertEqual( 100, image.height )
-        
\ No newline at end of file
+
+    def test_contents_fullsize_range( self ):
+
+        res = self.client.get( '/contents/fullsize/2',
+            headers={'Range': 'bytes=0-99'} )
+
+        self.assertStatus( res, 206 )
+        self.assertEqual( 100, len( res.data ) )
+        self.assertEqual( b'\x89PNG', res.data[:4] )
+        self.assertTrue( res.headers['Content-Range'].startswith( 'bytes 0-99/' ) )
+
+    def test_contents_fullsize_accel( self ):
+
+        self.app.config['SENDFILE'] = 'x-accel-redirect'
+
+        res = self.client.get( '/contents/fullsize/2' )
+
+        self.assertStatus( res, 200 )
+        self.assertEqual( b'', res.data )
+        self.assertTrue( res.headers['X-Accel-Redirect'].startswith(
+            '/_accel' + self.lib_path ) )
+
+    def test_contents_preview_not_modified( self ):
+
+        res = self.client.get( '/contents/preview/2?width=320&height=240' )
+        self.assertStatus( res, 200 )
+        self.assertIn( 'no-cache', res.headers['Cache-Control'] )
+        etag = res.headers['ETag']
+        last_modified = res.headers['Last-Modified']
+
+        res = self.client.get( '/contents/preview/2?width=320&height=240',
+            headers={'If-None-Match': etag} )
+        self.assertStatus( res, 304 )
+        self.assertEqual( b'', res.data )
+
+        res = self.client.get( '/contents/preview/2?width=320&height=240',
+            headers={'If-Modified-Since': last_modified} )
+        self.assertStatus( res, 304 )
+
+        # A different size is a different representation.
+        self.app.config['ALLOWED_PREVIEWS'] = ['320, 240', '160, 120']
+        res = self.client.get( '/contents/preview/2?width=160&height=120',
+            headers={'If-None-Match': etag} )
+        self.assertStatus( res, 200 )
+
+    def test_contents_preview_immutable( self ):
+
+        from cloud_on_film.models import Item
+        item_hash = db.session.query( Item ).get( 2 ).hash
+
+        res = self.client.get(
+            '/contents/preview/2?width=320&height=240&v={}'.format( item_hash ) )
+        self.assertStatus( res, 200 )
+        self.assertIn( 'immutable', res.headers['Cache-Control'] )
+        self.assertIn( 'max-age=31536000', res.headers['Cache-Control'] )
+
+        # A stale hash must not be cached forever.
+        res = self.client.get( '/contents/preview/2?width=320&height=240&v=0' )
+        self.assertNotIn( 'immutable', res.headers['Cache-Control'] )
+
+    def test_contents_fullsize_not_modified( self ):
+
+        res = self.client.get( '/contents/fullsize/2' )
+        self.assertStatus( res, 200 )
+
+        res = self.client.get( '/contents/fullsize/2',
+            headers={'If-None-Match': res.headers['ETag']} )
+        self.assertStatus( res, 304 )
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+from flask_testing import TestCase
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
+from cloud_on_film import create_app, db
+from cloud_on_film.models import Library, Item, HashEnum
+from cloud_on_film.scanner import Scanner
+from cloud_on_film.duplicates import DuplicateFinder
+from tests.data_helper import DataHelper
+
+class TestDuplicates( TestCase ):
+
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    TESTING = True
+    ITEMS_PER_PAGE = 20
+
+    def create_app( self ):
+        return create_app( self )
+
+    def setUp( self ):
+        db.create_all()
+
+        from cloud_on_film.files.picture import register_plugin
+        register_plugin()
+
+        self.user_id = 0
+        DataHelper.create_folders( self )
+
+        temp_path = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, temp_path )
+        self.root_path = os.path.join( temp_path, 'library1' )
+        shutil.copytree( self.lib_path, self.root_path )
+        self.dup_path = os.path.join(
+            self.root_path, 'subfolder1', 'random100x100.png' )
+        shutil.copy( self.dup_path, os.path.join(
+            self.root_path, 'subfolder2', 'copy100x100.png' ) )
+
+        self.lib = Library(
+            display_name='Scratch Library',
+            machine_name='scratch_library',
+            absolute_path=self.root_path,
+            nsfw=False )
+        db.session.add( self.lib )
+        db.session.commit()
+
+        Scanner( self.lib ).run()
+
+    def tearDown( self ):
+        db.session.remove()
+        db.drop_all()
+
+    def _names( self, groups ):
+        names = []
+        for group in groups:
+            names.append( sorted( db.session.query( Item ).get( i ).name
+                for i in group ) )
+        return names
+
+    def test_duplicates_stored( self ):
+
+        groups = DuplicateFinder( self.user_id ).find()
+
+        self.assertEqual( [['copy100x100.png', 'random100x100.png']],
+            self._names( groups ) )
+
+    def test_duplicates_mixed_algos( self ):
+
+        # Items hashed with another algorithm are compared on disk.
+        shutil.copy( self.dup_path, os.path.join(
+            self.root_path, 'subfolder2', 'subfolder3', 'other100x100.png' ) )
+        Scanner( self.lib, hash_algo=HashEnum.sha256 ).run()
+
+        groups = DuplicateFinder( self.user_id ).find()
+
+        self.assertEqual(
+            [['copy100x100.png', 'other100x100.png', 'random100x100.png']],
+            self._names( groups ) )
+
+    def test_ajax_list_duplicates( self ):
+
+        # Groups are only listed once the duplicates command has run.
+        dup_data = json.loads( self.client.get( '/ajax/list/duplicates' ).data )
+        self.assertEqual( (0, None, True),
+            (dup_data['total'], dup_data['updated'], dup_data['stale']) )
+
+        DuplicateFinder.refresh()
+
+        res = self.client.get( '/ajax/list/duplicates' )
+
+        dup_data = json.loads( res.data )
+
+        self.assertEqual( 1, dup_data['total'] )
+        self.assertFalse( dup_data['stale'] )
+        self.assertEqual( os.path.getsize( self.dup_path ),
+            dup_data['groups'][0]['size'] )
+        self.assertEqual( [
+            'scratch_library/subfolder1/random100x100.png',
+            'scratch_library/subfolder2/copy100x100.png'],
+            sorted( i['path'] for i in dup_data['groups'][0]['items'] ) )
+
+        # A group left with one item is no longer a duplicate.
+        db.session.delete( db.session.query( Item ) \
+            .filter( Item.name == 'copy100x100.png' ).one() )
+        db.session.commit()
+        dup_data = json.loads( self.client.get( '/ajax/list/duplicates' ).data )
+        self.assertEqual( (0, True), (dup_data['total'], dup_data['stale']) )
+
+if '__main__' == __name__:
+    unittest.main()
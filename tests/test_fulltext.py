@@ -0,0 +1,110 @@
+
+import os
+import sys
+from flask_testing import TestCase
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
+from tests.data_helper import DataHelper
+from cloud_on_film import create_app, db
+from cloud_on_film.models import Item, Tag
+from cloud_on_film.search import Searcher, SearchExecuteException
+
+class TestFullText( TestCase ):
+
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    TESTING = True
+
+    def create_app( self ):
+        return create_app( self )
+
+    def setUp( self ):
+        db.create_all()
+
+        self.user_id = 0
+        DataHelper.create_folders( self )
+        DataHelper.create_libraries( self, db )
+        DataHelper.create_data_folders( self, db )
+        DataHelper.create_data_items( self, db )
+
+    def tearDown( self ):
+        db.session.remove()
+        db.drop_all()
+
+    def search( self, query_str ):
+        search_test = Searcher( query_str )
+        search_test.lexer.lex()
+        return sorted( r.name for r in search_test.search( self.user_id ) )
+
+    def test_fulltext_search( self ):
+
+        self.assertEqual( 5, len( self.search( 'name~png' ) ) )
+        self.assertEqual( ['random100x100.png'],
+            self.search( 'name~"random100*"' ) )
+
+        # Tags are indexed by their whole path.
+        self.assertEqual( ['random100x100.png'], self.search( 'tags~ifdy' ) )
+        self.assertEqual( ['random100x100.png'],
+            self.search( 'text~"sub test tag"' ) )
+        self.assertEqual( [], self.search( 'name~ifdy' ) )
+
+        item = db.session.query( Item ) \
+            .filter( Item.name == 'random640x480.png' ).one()
+        item.meta['comment'] = 'Sunset over the bay'
+        db.session.commit()
+
+        self.assertEqual( ['random640x480.png'],
+            self.search( 'comment~"bay sunset"' ) )
+        self.assertEqual( ['random640x480.png'],
+            self.search( 'text~sunset & width=640' ) )
+        self.assertEqual( [], self.search( 'comment~"sunset dawn"' ) )
+
+        del item.meta['comment']
+        db.session.commit()
+        self.assertEqual( [], self.search( 'text~sunset' ) )
+
+        for query_str in ['rating~1', 'text~"!!"']:
+            with self.assertRaises( SearchExecuteException ):
+                self.search( query_str )
+
+    def test_fulltext_updates( self ):
+
+        # Renaming a tag reindexes items tagged with it or under it.
+        tag = db.session.query( Tag ).filter( Tag.name == 'IFDY' ).one()
+        tag.name = 'Holidays'
+        db.session.commit()
+        self.assertEqual( ['random100x100.png'], self.search( 'tags~holidays' ) )
+        self.assertEqual( [], self.search( 'tags~ifdy' ) )
+
+        # So does deleting one.
+        tag = db.session.query( Tag ) \
+            .filter( Tag.name == 'Sub Test Tag 3' ).one()
+        db.session.delete( tag )
+        db.session.commit()
+        self.assertEqual( [], self.search( 'tags~holidays' ) )
+        self.assertEqual( [], self.search( 'tags~sub' ) )
+
+        item = db.session.query( Item ) \
+            .filter( Item.name == 'random100x100.png' ).one()
+        db.session.delete( item )
+        db.session.commit()
+        self.assertEqual( [], self.search( 'name~random100x100' ) )
+
+        # The writes cloud_item_ajax_save makes.
+        item = db.session.query( Item ) \
+            .filter( Item.name == 'random320x240.png' ).one()
+        item.tags = [Tag.from_path( t ) for t in ['Holidays/Test Tag 2', 'Beach']]
+        item.meta['comment'] = 'Sand castle'
+        db.session.commit()
+        self.assertEqual( ['random320x240.png'],
+            self.search( 'tags~beach & comment~castle' ) )
+
+        from cloud_on_film.fulltext import index_for
+        index = index_for( db.engine )
+        self.assertEqual( 4, index.rebuild( db.session.connection() ) )
+        db.session.commit()
+        self.assertEqual( ['random320x240.png'],
+            self.search( 'text~"holidays sand"' ) )
+
+        matches = db.session.execute( index.ranked( 'random640*' ) ).fetchall()
+        self.assertEqual( 2, len( matches ) )
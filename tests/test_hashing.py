@@ -0,0 +1,47 @@
+import os
+import sys
+import hashlib
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
+from tests.data_helper import DataHelper
+from cloud_on_film.hashing import HashEnum, BulkHasher, hash_file
+
+class TestHashing( unittest.TestCase ):
+
+    def setUp( self ):
+        DataHelper.create_folders( self )
+        self.paths = [
+            os.path.join( self.lib_path, 'subfolder1', 'random100x100.png' ),
+            os.path.join( self.nsfw_lib_path, 'subfolder1',
+                'random500x500.png' ),
+            os.path.join( self.lib_path, 'subfolder2', 'subfolder3',
+                'random320x240.png' )]
+
+    def _reference( self, path, algo ):
+        with open( path, 'rb' ) as file_f:
+            return hashlib.new( algo, file_f.read() ).hexdigest()
+
+    def test_hash_algos( self ):
+
+        self.assertEqual( self._reference( self.paths[0], 'md5' ),
+            hash_file( self.paths[0] ) )
+        self.assertEqual( self._reference( self.paths[0], 'sha256' ),
+            hash_file( self.paths[0], HashEnum.sha256 ) )
+        self.assertEqual( self._reference( self.paths[0], 'blake2b' ),
+            hash_file( self.paths[0], HashEnum.blake2b.value ) )
+
+    def test_bulk_hash_order( self ):
+
+        paths = self.paths + ['/nonexistent/file.png'] + self.paths
+
+        with BulkHasher( HashEnum.blake2b, workers=2, chunksize=1 ) as hasher:
+            hashes = hasher.hash( paths )
+
+        self.assertEqual( [self._reference( p, 'blake2b' ) for p in self.paths],
+            hashes[:3] )
+        self.assertIsNone( hashes[3] )
+        self.assertEqual( hashes[:3], hashes[4:] )
+
+if '__main__' == __name__:
+    unittest.main()
@@ -75,6 +75,31 @@ class TestLibraries( TestCase ):
             stanza = re.escape( stanza )
             self.assertRegex( res.data.decode( 'utf-8' ), stanza )
 
+    def test_libraries_file( self ):
+
+        res = self.client.get(
+            '/libraries/testing_library/subfolder1/random100x100.png' )
+        self.assertStatus( res, 200 )
+        self.assertIn( 'src="/contents/fullsize/', res.data.decode( 'utf-8' ) )
+
+        self.assert404( self.client.get(
+            '/libraries/testing_library/subfolder1/nosuch.png' ) )
+
+    def test_libraries_search_invalid( self ):
+
+        res = self.client.get( '/search', query_string=dict( query='rating$1' ) )
+        self.assertStatus( res, 200 )
+        self.assertIn( 'Invalid search: unexpected &#34;$&#34;',
+            res.data.decode( 'utf-8' ) )
+
+        search = SavedSearch( display_name='Broken', query='nosuch=1' )
+        db.session.add( search )
+        db.session.commit()
+
+        res = self.client.get( '/search/saved/{}'.format( search.id ) )
+        self.assertStatus( res, 200 )
+        self.assertIn( 'Invalid search:', res.data.decode( 'utf-8' ) )
+
     def test_libraries_save_search( self ):
 
         res = self.client.post(
@@ -3,6 +3,7 @@ import os
 import sys
 import unittest
 import json
+from concurrent.futures import ProcessPoolExecutor
 
 from flask import current_app
 from flask_testing import TestCase
@@ -11,8 +12,13 @@ sys.path.insert( 0, os.path.dirname( __file__) )
 
 from tests.data_helper import DataHelper
 from cloud_on_film import create_app, db
-from cloud_on_film.models import Library, Folder, Item, Tag
-from cloud_on_film.importing import picture
+from cloud_on_film.models import \
+    Library, Folder, Item, Tag, Plugin, InvalidFolderException, \
+    ImportJob, JobStatusEnum, WorkerSemaphore, folder_path_cache, \
+    plugin_registry, tag_path_cache
+from cloud_on_film.importing import \
+    ItemImporter, ItemImportException, ImportWorker, JSONRecordReader, \
+    LibraryPrefixMap, requeue_import_job, start_import_job
 from tests.fake_library import FakeLibrary
 
 class TestModels( TestCase ):
@@ -70,6 +76,87 @@ class TestModels( TestCase ):
             folder_test.path, 'subfolder2/subfolder3' )
         self.assertEqual( folder_test.name, 'subfolder3' )
 
+    def test_folder_path_materialized( self ):
+
+        subfolder2 = Folder.from_path( self.lib.id, 'subfolder2', self.user_id )
+        subfolder4 = Folder(
+            parent_id=subfolder2.id, library_id=self.lib.id, name='subfolder4' )
+        db.session.add( subfolder4 )
+        db.session.commit()
+
+        self.assertEqual( 'subfolder2/subfolder4', subfolder4.path )
+
+        descendants = Folder.descendants_query(
+            self.lib.id, 'subfolder2', self.user_id ) \
+            .order_by( Folder.path ) \
+            .all()
+        self.assertEqual(
+            ['subfolder2/subfolder3', 'subfolder2/subfolder4'],
+            [f.path for f in descendants] )
+
+    def test_folder_path_move( self ):
+
+        subfolder1 = Folder.from_path( self.lib.id, 'subfolder1', self.user_id )
+        subfolder2 = Folder.from_path( self.lib.id, 'subfolder2', self.user_id )
+        subfolder2.parent_id = subfolder1.id
+        subfolder2.name = 'moved'
+        db.session.commit()
+
+        subfolder3 = db.session.query( Folder ) \
+            .filter( Folder.name == 'subfolder3' ) \
+            .first()
+        self.assertEqual( 'subfolder1/moved', subfolder2.path )
+        self.assertEqual( 'subfolder1/moved/subfolder3', subfolder3.path )
+
+        Folder.rebuild_paths()
+        self.assertEqual( 'subfolder1/moved/subfolder3', subfolder3.path )
+
+    def test_folder_from_path_cache( self ):
+
+        folder_path_cache.clear()
+
+        folder_test = Folder.from_path(
+            self.lib.id, 'subfolder2/subfolder3', self.user_id )
+        hits = folder_path_cache.hits
+        folder_cached = Folder.from_path(
+            self.lib.id, 'subfolder2/subfolder3', self.user_id )
+        self.assertEqual( hits + 1, folder_path_cache.hits )
+        self.assertEqual( folder_test.id, folder_cached.id )
+
+        # Moving the parent must invalidate the cached subpath.
+        subfolder2 = Folder.from_path( self.lib.id, 'subfolder2', self.user_id )
+        subfolder2.name = 'moved'
+        db.session.commit()
+        self.assertNotIn(
+            (self.lib.id, 'subfolder2/subfolder3'), folder_path_cache )
+        self.assertEqual( folder_test.id, Folder.from_path(
+            self.lib.id, 'moved/subfolder3', self.user_id ).id )
+
+        with self.assertRaises( InvalidFolderException ) as cm:
+            Folder.from_path( self.lib.id, 'moved/xxx', self.user_id )
+        self.assertEqual( 'xxx', cm.exception.name )
+        self.assertEqual( subfolder2.id, cm.exception.parent_id )
+
+    def test_plugin_registry( self ):
+
+        from cloud_on_film.files.picture import register_plugin, Picture
+        plugin = register_plugin()
+
+        poly = Plugin.polymorph()
+        hits = plugin_registry.hits
+        self.assertIs( poly, Plugin.polymorph() )
+        self.assertEqual( hits + 1, plugin_registry.hits )
+        self.assertEqual( 'picture', Plugin.models_by_extension()['png'][0] )
+        self.assertEqual( ['picture'], plugin_registry.stats()['plugins'] )
+
+        # Disabling the plugin must drop its model.
+        misses = plugin_registry.misses
+        plugin.enabled = False
+        db.session.commit()
+        self.assertNotIn( 'png', Plugin.models_by_extension() )
+        self.assertEqual( misses + 1, plugin_registry.misses )
+        self.assertNotIn( Picture, plugin_registry.models().values() )
+
     def test_file_from_path( self ):
 
         from cloud_on_film.files.picture import Picture
@@ -96,6 +183,59 @@ class TestModels( TestCase ):
         self.assertEqual( 1, len( files_test ) )
         self.assertIn( tag, files_test[0].tags )
 
+    def test_tag_resolve_paths( self ):
+
+        DataHelper.create_data_items( self, db )
+        tag_path_cache.clear()
+
+        from sqlalchemy import event
+        statements = []
+        def count_statement( *args ):
+            statements.append( args[2] )
+
+        paths = ['IFDY/Test Tag 2/Test Tag 1', 'Beach', '/Places/Sea//Bay/',
+            'IFDY/Test Tag 2/Test Tag 1', '']
+        event.listen( db.engine, 'before_cursor_execute', count_statement )
+        try:
+            tag_ids = Tag.resolve_paths( paths )
+            # Version, lookup, a level at a time of new tags, commit.
+            lookups = len( statements )
+            Tag.resolve_paths( paths )
+            self.assertEqual( 1, len( statements ) - lookups )
+        finally:
+            event.remove( db.engine, 'before_cursor_execute', count_statement )
+
+        self.assertEqual( set( paths[:4] ), set( tag_ids ) )
+        tag = db.session.query( Tag ).get( tag_ids['/Places/Sea//Bay/'] )
+        self.assertEqual( ('Bay', 'Places/Sea/Bay'), (tag.name, tag.path) )
+        self.assertEqual( 'Places/Sea', tag.parent.path )
+        self.assertIsNone( tag.parent.parent.parent_id )
+        self.assertEqual( tag, Tag.from_path( 'Places/Sea/Bay' ) )
+        self.assertEqual( 'Test Tag 2', Tag.from_path(
+            'IFDY/Test Tag 2/Test Tag 1' ).parent.name )
+
+        tags = Tag.from_paths( ['Beach', 'Places', 'Beach', ''] )
+        self.assertEqual( ['Beach', 'Places'], [t.path for t in tags] )
+
+        # Moving a tag rewrites its descendants' paths and the cache.
+        places = tags[1]
+        places.parent_id = tags[0].id
+        places.name = 'Spots'
+        db.session.commit()
+        self.assertEqual( 'Beach/Spots/Sea/Bay',
+            db.session.query( Tag ).get( tag.id ).path )
+        self.assertEqual( tag.id,
+            Tag.resolve_paths( ['Beach/Spots/Sea/Bay'] )['Beach/Spots/Sea/Bay'] )
+        self.assertNotEqual( tag.id,
+            Tag.resolve_paths( ['Places/Sea/Bay'] )['Places/Sea/Bay'] )
+
+        # Paths are rebuilt for databases that predate them.
+        db.session.query( Tag ).update( {Tag.path: None} )
+        Tag.rebuild_paths( db.session.connection() )
+        db.session.commit()
+        self.assertEqual( 'Beach/Spots/Sea/Bay',
+            db.session.query( Tag ).get( tag.id ).path )
+
     def test_item_machine_path( self ):
 
         DataHelper.create_data_items( self, db )
@@ -128,7 +268,13 @@ class TestModels( TestCase ):
         for pic_json in pics_json:
             pic_json['filename'] = os.path.join(
                 self.nsfw_lib_path, pic_json['filename'] )
-            picture( pic_json )
+        stats = ItemImporter( batch_size=2 ).run( iter( pics_json ) )
+        self.assertEqual( 3, stats['items_added'] )
+
+        # Importing again adds nothing.
+        stats = ItemImporter().run( pics_json )
+        self.assertEqual( 0, stats['items_added'] )
+        self.assertEqual( 3, stats['items_skipped'] )
 
         # Test the results.
         tag_testing_img = Tag.from_path( 'Testing Imports/Testing Image' )
@@ -157,6 +303,215 @@ class TestModels( TestCase ):
         self.assertTrue( file_test.nsfw )
         self.assertEqual( 0, file_test.rating )
 
+    def test_import_invalid( self ):
+
+        with open( 'testdata/test_import.json', 'r' ) as import_file:
+            pics_json = json.loads( import_file.read() )
+        for pic_json in pics_json:
+            pic_json['filename'] = os.path.join(
+                self.nsfw_lib_path, pic_json['filename'] )
+
+        # A batch the database rejects fails as a whole; the rest go on.
+        def on_batch( importer ):
+            if 2 == importer.records_seen:
+                db.session.execute( 'SELECT * FROM no_such_table' )
+
+        stats = ItemImporter( batch_size=2, on_batch=on_batch ).run( pics_json )
+        self.assertEqual( (1, 0, 2), (stats['items_added'],
+            stats['items_skipped'], stats['items_failed']) )
+        self.assertEqual( 1, Item.query.count() )
+
+        # Bad records fail one by one, around the good ones.
+        broken = dict( pics_json[0] )
+        del broken['time_created']
+        records = [broken, pics_json[0], {'rating': 1},
+            dict( pics_json[1], tags=[''] ), pics_json[1], 'x',
+            dict( pics_json[2], tags='Testing Imports' ), pics_json[2]]
+        importer = ItemImporter( batch_size=2 )
+        stats = importer.run( records )
+        self.assertEqual( (2, 1, 5), (stats['items_added'],
+            stats['items_skipped'], stats['items_failed']) )
+        self.assertEqual( 5, len( importer.errors ) )
+        self.assertEqual( 3, Item.query.count() )
+
+    def _spool_import( self, temp_dir ):
+        with open( 'testdata/test_import.json', 'r' ) as import_file:
+            pics_json = json.loads( import_file.read() )
+        path = os.path.join( temp_dir, 'import.jsonl' )
+        with open( path, 'w' ) as spool_file:
+            for pic_json in pics_json:
+                pic_json['filename'] = os.path.join(
+                    self.nsfw_lib_path, pic_json['filename'] )
+                spool_file.write( json.dumps( pic_json ) + '\n' )
+        return path
+
+    def test_import_job( self ):
+
+        import tempfile
+
+        # Leave the job for a worker, rather than a thread of this process.
+        self.app.config['IMPORT_WORKER'] = 'cli'
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = self._spool_import( temp_dir )
+            job_id = start_import_job( path )
+
+            job = db.session.query( ImportJob ).get( job_id )
+            self.assertEqual( JobStatusEnum.pending, job.status )
+            self.assertEqual( 0, job.progress )
+
+            worker = ImportWorker( batch_size=2 )
+            job, semaphore = worker._claim()
+            self.assertEqual( job_id, job.id )
+            self.assertEqual( JobStatusEnum.running, job.status )
+            self.assertEqual( (None, None), worker._claim() )
+
+            with ProcessPoolExecutor( max_workers=2 ) as pool:
+                worker.run_job( job, semaphore, pool )
+
+            self.assertEqual( (1, 0), (worker.done, worker.failed) )
+            self.assertFalse( os.path.exists( path ) )
+
+        job = db.session.query( ImportJob ).get( job_id )
+        self.assertEqual( JobStatusEnum.done, job.status )
+        self.assertEqual( (3, 0, 0),
+            (job.items_added, job.items_skipped, job.items_failed) )
+        self.assertEqual( 100, job.progress )
+        self.assertIsNone(
+            db.session.query( WorkerSemaphore ).get( job.semaphore_id ) )
+
+        # Any web worker can report on the job.
+        response = self.client.get( '/ajax/libraries/upload',
+            query_string={'job_id': job_id} )
+        self.assertEqual( 'done', response.json['status'] )
+        self.assertEqual( 100, response.json['progress'] )
+        self.assert404( self.client.get( '/ajax/libraries/upload',
+            query_string={'job_id': 'x'} ) )
+
+    def test_import_job_resume( self ):
+
+        import tempfile
+        import time
+
+        self.app.config['IMPORT_WORKER'] = 'cli'
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            job_id = start_import_job( self._spool_import( temp_dir ) )
+
+            # A worker that died after checkpointing two records.
+            job = db.session.query( ImportJob ).get( job_id )
+            job.status = JobStatusEnum.running
+            job.items_added = 2
+            db.session.add( WorkerSemaphore( id=job.semaphore_id,
+                timestamp=int( time.time() ) - 3600, progress=50, note='2' ) )
+            db.session.commit()
+            self.assertEqual( 50, job.progress )
+
+            self.assertEqual( (1, 0), ImportWorker().process() )
+
+        job = db.session.query( ImportJob ).get( job_id )
+        self.assertEqual( JobStatusEnum.done, job.status )
+        # Only the record after the checkpoint was read.
+        self.assertEqual( (3, 0), (job.items_added, job.items_skipped) )
+        self.assertEqual( 1, Item.query.count() )
+
+    def test_import_job_requeue( self ):
+
+        import tempfile
+
+        self.app.config['IMPORT_WORKER'] = 'cli'
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = self._spool_import( temp_dir )
+            with open( path, 'r' ) as spool_file:
+                lines = spool_file.readlines()
+            with open( path, 'w' ) as spool_file:
+                spool_file.writelines( lines[:2] + ['{"filename": \n'] )
+            job_id = start_import_job( path )
+
+            # The first batch is committed before the bad record is read.
+            worker = ImportWorker( batch_size=2 )
+            self.assertEqual( (0, 1), worker.process() )
+
+            job = db.session.query( ImportJob ).get( job_id )
+            self.assertEqual( JobStatusEnum.failed, job.status )
+            self.assertIn( 'Invalid JSON', job.note )
+            self.assertEqual( 2, job.items_added )
+            self.assertTrue( os.path.exists( path ) )
+            self.assertEqual( '2', db.session.query( WorkerSemaphore ) \
+                .get( job.semaphore_id ).note )
+
+            # Fix the file and pick up where the job left off.
+            with open( path, 'w' ) as spool_file:
+                spool_file.writelines( lines )
+            self.assertTrue( requeue_import_job( job_id ) )
+            self.assertFalse( requeue_import_job( job_id ) )
+            self.assertEqual( (1, 0), ImportWorker( batch_size=2 ).process() )
+            self.assertFalse( os.path.exists( path ) )
+
+        job = db.session.query( ImportJob ).get( job_id )
+        self.assertEqual( JobStatusEnum.done, job.status )
+        self.assertIsNone( job.note )
+        self.assertEqual( (3, 0, 0),
+            (job.items_added, job.items_skipped, job.items_failed) )
+        self.assertEqual( 3, Item.query.count() )
+        self.assertIsNone(
+            db.session.query( WorkerSemaphore ).get( job.semaphore_id ) )
+
+    def test_import_reader( self ):
+
+        import tempfile
+
+        records = [{'filename': 'a/été {}.jpg'.format( i ), 'tags': ['x', 'y'],
+            'rating': i} for i in range( 20 )]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            def read( text, read_size=7 ):
+                path = os.path.join( temp_dir, 'import.json' )
+                with open( path, 'w', encoding='utf-8' ) as import_file:
+                    import_file.write( text )
+                reader = JSONRecordReader( path, read_size=read_size )
+                return list( reader ), reader.progress
+
+            # Small reads split records and multi-byte characters.
+            self.assertEqual( (records, 100),
+                read( json.dumps( records, indent=3 ) ) )
+            self.assertEqual( (records, 100), read( '\n'.join(
+                json.dumps( r, ensure_ascii=False ) for r in records ) + '\n' ) )
+            self.assertEqual( ([], 100), read( ' [ ] ' ) )
+            self.assertEqual( ([], 100), read( '' ) )
+
+            for text in ['[{"a": 1}, {"a": ', '[1, 2]', '{"a": 1} x']:
+                with self.assertRaises( ItemImportException ):
+                    read( text )
+
+            # A malformed record is given up on without reading the rest.
+            path = os.path.join( temp_dir, 'import.json' )
+            with open( path, 'w', encoding='utf-8' ) as import_file:
+                import_file.write( '\n'.join( [json.dumps( r )
+                    for r in records[:10]] + ['{"a": 1,,}'] +
+                    [json.dumps( r ) for r in records] * 20 ) )
+            reader = JSONRecordReader( path, read_size=16, max_record=256 )
+            with self.assertRaises( ItemImportException ):
+                list( reader )
+            self.assertLess( reader.bytes_read, reader.size / 10 )
+
+    def test_import_library_prefix( self ):
+
+        class Lib( object ):
+            def __init__( self, id, absolute_path ):
+                self.id = id
+                self.absolute_path = absolute_path
+
+        libraries = LibraryPrefixMap( [Lib( 1, '/srv/pics' ),
+            Lib( 2, '/srv/pics/nsfw/' ), Lib( 3, '/srv/pictures' )] )
+        self.assertEqual( (2, 'a/b.jpg'),
+            libraries.find( '/srv/pics/nsfw/a/b.jpg' ) )
+        self.assertEqual( (1, 'nsfw2/b.jpg'),
+            libraries.find( '/srv/pics/nsfw2/b.jpg' ) )
+        self.assertEqual( (3, 'b.jpg'), libraries.find( '/srv/pictures/b.jpg' ) )
+        self.assertEqual( (None, None), libraries.find( '/srv/other/b.jpg' ) )
+
     def test_nsfw( self ):
 
         DataHelper.create_data_items( self, db )
@@ -218,5 +573,144 @@ class TestModels( TestCase ):
         self.assertEqual( 1, files_test[0].rating )
         self.assertEqual( 'random500x500.png', files_test[0].name )
 
+    def test_picture_meta_columns( self ):
+
+        DataHelper.create_data_items( self, db )
+
+        from cloud_on_film.files.picture import Picture
+
+        file_test = Item.secure_query( self.user_id ) \
+            .filter( Picture.width == 100 ) \
+            .first()
+        self.assertEqual( 4, file_test.rating )
+        self.assertIsNone( file_test.comment )
+
+        # Columns follow meta, before and after a commit.
+        file_test.meta['rating'] = 2
+        file_test.meta['comment'] = 'Updated'
+        db.session.flush()
+        self.assertEqual( 2, file_test.rating )
+        db.session.commit()
+        self.assertEqual( 'Updated', file_test.comment )
+        self.assertEqual( file_test.id, Item.secure_query( self.user_id ) \
+            .filter( Picture.comment == 'Updated' ).one().id )
+
+        del file_test.meta['rating']
+        db.session.commit()
+        self.assertEqual( 0, file_test.rating )
+
+    def test_item_meta_number( self ):
+
+        DataHelper.create_data_items( self, db )
+
+        from sqlalchemy.exc import IntegrityError
+        from cloud_on_film.models import ItemMeta
+
+        file_test = db.session.query( Item ) \
+            .filter( Item.name == 'random100x100.png' ).one()
+        file_test.meta['rating'] = 5
+        file_test.meta['comment'] = '12 cats'
+        db.session.commit()
+
+        self.assertEqual( 5.0, file_test._meta['rating'].number )
+        self.assertIsNone( file_test._meta['comment'].number )
+        for value, number in [('-1.5', -1.5), (' 3 ', 3.0), ('nan', None),
+        ('1e3', None), (7, 7.0), (None, None)]:
+            self.assertEqual( number, ItemMeta.number_of( value ) )
+
+        # One value per key and item.
+        db.session.add( ItemMeta( item_id=file_test.id, key='rating', value='1' ) )
+        with self.assertRaises( IntegrityError ):
+            db.session.flush()
+        db.session.rollback()
+
+        connection = db.session.connection()
+        connection.execute( 'UPDATE item_meta SET number = NULL' )
+        self.assertLess( 0, ItemMeta.sync_numbers( connection, batch_size=2 ) )
+        self.assertEqual( 0, ItemMeta.sync_numbers( connection ) )
+        self.assertEqual( 0, ItemMeta.remove_duplicates( connection ) )
+
+    def test_seek( self ):
+
+        DataHelper.create_data_items( self, db )
+
+        from cloud_on_film.paging import seek, decode_cursor, \
+            InvalidCursorException
+
+        # Names only order within a folder; across folders ties go by ID.
+        for item in db.session.query( Item ).all():
+            item.name = 'same.png'
+        db.session.commit()
+        ids = [i.id for i in Item.secure_query( -1 ) \
+            .order_by( Item.id ).all()]
+
+        seen = []
+        after = None
+        while True:
+            items, after = seek( Item.secure_query( -1 ), after, 2 )
+            seen += [i.id for i in items]
+            if not after:
+                break
+            self.assertEqual( ('same.png', items[-1].id), decode_cursor( after ) )
+
+        self.assertEqual( ids, seen )
+
+        for token in ['', 'x', 'WzFd', 'WyJhIiwgImIiXQ']:
+            with self.assertRaises( InvalidCursorException ):
+                decode_cursor( token )
+
+    def test_data_version( self ):
+
+        from cloud_on_film.models import DataVersion
+
+        # Every counter exists from the start, so bumps never insert.
+        self.assertEqual( set( DataVersion.NAMES ), set( r[0] for r in
+            db.session.query( DataVersion.name ) ) )
+
+        version = DataVersion.get( DataVersion.ITEMS )
+        tag = Tag( name='Versioned' )
+        db.session.add( tag )
+        db.session.flush()
+
+        # Nothing is bumped until the write commits...
+        self.assertEqual( version, DataVersion.get( DataVersion.ITEMS ) )
+        db.session.rollback()
+        self.assertEqual( version, DataVersion.get( DataVersion.ITEMS ) )
+
+        # ...and then only once, outside of its transaction.
+        tags_version = DataVersion.get( DataVersion.TAGS )
+        db.session.add( Tag( name='Versioned' ) )
+        db.session.commit()
+        self.assertEqual( version + 1, DataVersion.get( DataVersion.ITEMS ) )
+        self.assertEqual( tags_version, DataVersion.get( DataVersion.TAGS ) )
+
+        # Only renaming, moving or deleting tags changes tag paths.
+        tag = Tag.from_path( 'Versioned' )
+        tag.name = 'Renamed'
+        db.session.commit()
+        self.assertEqual( tags_version + 1,
+            DataVersion.get( DataVersion.TAGS ) )
+
+    def test_add_missing_columns( self ):
+
+        from cloud_on_film.migrations import add_missing_columns
+
+        connection = db.session.connection()
+        connection.execute(
+            'CREATE TABLE migrate_test ( id INTEGER PRIMARY KEY )' )
+        connection.execute( 'INSERT INTO migrate_test ( id ) VALUES ( 1 )' )
+
+        table = db.Table( 'migrate_test', db.MetaData(),
+            db.Column( 'id', db.Integer, primary_key=True ),
+            db.Column( 'width', db.Integer, index=True, nullable=True ),
+            db.Column( 'rating', db.Integer, nullable=False,
+                server_default='0' ) )
+
+        self.assertEqual( ['width', 'rating'],
+            add_missing_columns( connection, table ) )
+        self.assertEqual( (1, None, 0), tuple( connection.execute(
+            'SELECT id, width, rating FROM migrate_test' ).first() ) )
+        self.assertEqual( [], add_missing_columns( connection, table ) )
+
 if '__main__' == __name__:
     unittest.main()
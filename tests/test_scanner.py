@@ -0,0 +1,188 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from flask_testing import TestCase
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
+from tests.data_helper import DataHelper
+from cloud_on_film import create_app, db
+from cloud_on_film.models import \
+    Library, Folder, Item, StatusEnum, WorkerSemaphore
+from cloud_on_film.scanner import Scanner
+
+class TestScanner( TestCase ):
+
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    TESTING = True
+
+    def create_app( self ):
+        return create_app( self )
+
+    def setUp( self ):
+        db.create_all()
+
+        from cloud_on_film.files.picture import register_plugin
+        register_plugin()
+
+        self.user_id = 0
+        DataHelper.create_folders( self )
+        DataHelper.create_libraries( self, db )
+
+    def tearDown( self ):
+        db.session.remove()
+        db.drop_all()
+
+    def test_scan( self ):
+
+        from cloud_on_film.models import DataVersion
+
+        version = DataVersion.get( DataVersion.ITEMS )
+        stats = Scanner( self.lib, workers=2, batch_size=1 ).run()
+        self.assertLess( version, DataVersion.get( DataVersion.ITEMS ) )
+
+        self.assertEqual( 3, stats['folders_added'] )
+        self.assertEqual( 2, stats['items_added'] )
+
+        folder_test = Folder.from_path(
+            self.lib.id, 'subfolder2/subfolder3', self.user_id )
+        self.assertEqual( 'subfolder2/subfolder3', folder_test.path )
+
+        from cloud_on_film.files.picture import Picture
+
+        file_test = Item.secure_query( self.user_id ) \
+            .filter( Picture.width == 320 ) \
+            .first()
+        self.assertEqual( 'random320x240.png', file_test.name )
+        self.assertEqual( 240, file_test.height )
+        self.assertEqual( 461998, file_test.size )
+        self.assertIsInstance( file_test, Picture )
+
+        # Bulk-inserted items are in the full-text index.
+        from cloud_on_film.search import Searcher
+        search_test = Searcher( 'name~random320x240' )
+        search_test.lexer.lex()
+        self.assertEqual( [file_test.id],
+            [i.id for i in search_test.search( self.user_id )] )
+
+        self.assertIsNone( db.session.query( WorkerSemaphore ).get(
+            'scan-{}'.format( self.lib.id ) ) )
+
+        # Scanning again should not add anything.
+        stats = Scanner( self.lib ).run()
+        self.assertEqual( 0, stats['folders_added'] )
+        self.assertEqual( 0, stats['items_added'] )
+
+    def test_scan_resume( self ):
+
+        # Pretend a previous scan was interrupted after subfolder1.
+        db.session.add( WorkerSemaphore(
+            id='scan-{}'.format( self.lib.id ),
+            timestamp=0, progress=1, note='subfolder1' ) )
+        db.session.commit()
+
+        stats = Scanner( self.lib ).run()
+
+        self.assertEqual( 2, stats['files_seen'] )
+        self.assertEqual( 1, stats['items_added'] )
+        self.assertEqual( ['random320x240.png'],
+            [i.name for i in db.session.query( Item )] )
+
+    def test_rescan_incremental( self ):
+
+        # Work on a copy, since the test modifies the library.
+        root_path = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, root_path )
+        lib_path = os.path.join( root_path, 'library1' )
+        shutil.copytree( self.lib_path, lib_path )
+        lib = Library(
+            display_name='Scratch Library',
+            machine_name='scratch_library',
+            absolute_path=lib_path,
+            nsfw=False )
+        db.session.add( lib )
+        db.session.commit()
+
+        Scanner( lib ).run()
+
+        # Nothing changed, so no folder needs to be listed.
+        stats = Scanner( lib ).run()
+        self.assertEqual( 3, stats['dirs_skipped'] )
+        self.assertEqual( 0, stats['files_seen'] )
+
+        # Modifying a file in place is only noticed by a full rescan.
+        with open( os.path.join(
+            lib_path, 'subfolder1', 'random100x100.png' ), 'ab' ) as pic_f:
+            pic_f.write( b'\0' * 16 )
+        stats = Scanner( lib ).run()
+        self.assertEqual( 0, stats['items_updated'] )
+        stats = Scanner( lib, full=True ).run()
+        self.assertEqual( 0, stats['dirs_skipped'] )
+        self.assertEqual( 1, stats['items_updated'] )
+        file_test = db.session.query( Item ) \
+            .filter( Item.name == 'random100x100.png' ) \
+            .first()
+        self.assertEqual( os.path.getsize( os.path.join(
+            lib_path, 'subfolder1', 'random100x100.png' ) ), file_test.size )
+        self.assertEqual( '100', file_test.meta['width'] )
+
+        # Removing a file changes its directory, which is relisted.
+        os.remove( os.path.join(
+            lib_path, 'subfolder2', 'subfolder3', 'random320x240.png' ) )
+        stats = Scanner( lib ).run()
+        self.assertEqual( 2, stats['dirs_skipped'] )
+        self.assertEqual( 1, stats['items_missing'] )
+        file_test = db.session.query( Item ) \
+            .filter( Item.name == 'random320x240.png' ) \
+            .first()
+        self.assertEqual( StatusEnum.missing, file_test.status )
+
+    def test_rescan_failed( self ):
+
+        from cloud_on_film.scanner import scan_directory
+
+        root_path = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, root_path )
+        lib_path = os.path.join( root_path, 'library1' )
+        shutil.copytree( self.lib_path, lib_path )
+        lib = Library(
+            display_name='Scratch Library',
+            machine_name='scratch_library',
+            absolute_path=lib_path,
+            nsfw=False )
+        db.session.add( lib )
+        db.session.commit()
+
+        # A listing that fails is not recorded as complete.
+        listing = scan_directory( os.path.join(
+            lib_path, 'subfolder1', 'random100x100.png' ) )
+        self.assertIsNone( listing.mtime )
+
+        # A picture that cannot be read leaves its folder to be relisted.
+        pic_path = os.path.join( lib_path, 'subfolder1', 'random100x100.png' )
+        with open( pic_path, 'rb' ) as pic_f:
+            pic_data = pic_f.read()
+        with open( pic_path, 'wb' ) as pic_f:
+            pic_f.write( b'not a picture' )
+        stats = Scanner( lib ).run()
+        self.assertEqual( 0, db.session.query( Item ) \
+            .filter( Item.name == 'random100x100.png' ).count() )
+        folder = db.session.query( Folder ) \
+            .filter( Folder.name == 'subfolder1' ) \
+            .filter( Folder.library_id == lib.id ).one()
+        self.assertIsNone( folder.dir_mtime )
+
+        # Rewriting the file does not change the folder's mtime, but the
+        # next incremental scan still picks it up.
+        with open( pic_path, 'wb' ) as pic_f:
+            pic_f.write( pic_data )
+        stats = Scanner( lib ).run()
+        self.assertEqual( 1, stats['items_added'] )
+        self.assertEqual( 1, db.session.query( Item ) \
+            .filter( Item.name == 'random100x100.png' ).count() )
+
+if '__main__' == __name__:
+    unittest.main()
@@ -6,7 +6,8 @@ from flask_testing import TestCase
 sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
 from tests.data_helper import DataHelper
 from cloud_on_film import create_app, db
-from cloud_on_film.search import Searcher
+from cloud_on_film.models import Item
+from cloud_on_film.search import Searcher, SearchExecuteException
 
 class TestSearch( TestCase ):
 
@@ -121,6 +122,217 @@ class TestSearch( TestCase ):
         for item in res:
             self.assertNotEqual( 500, item.width )
 
+    def test_search_meta( self ):
+
+        for name, iso in [('random100x100.png', 100), ('random500x500.png', 800)]:
+            item = db.session.query( Item ).filter( Item.name == name ).one()
+            item.meta['iso'] = iso
+            item.meta['camera'] = 'Camera {}'.format( iso )
+        db.session.commit()
+
+        search_test = Searcher( 'iso>=400' )
+        search_test.lexer.lex()
+        res = search_test.search( self.user_id ).all()
+        self.assertEqual( ['random500x500.png'], [r.name for r in res] )
+
+        search_test = Searcher( 'camera="Camera 100"' )
+        search_test.lexer.lex()
+        res = search_test.search( self.user_id ).all()
+        self.assertEqual( ['random100x100.png'], [r.name for r in res] )
+
+        search_test = Searcher( 'lens=50' )
+        search_test.lexer.lex()
+        with self.assertRaises( SearchExecuteException ):
+            search_test.search( self.user_id )
+
+    def test_search_cache( self ):
+
+        from cloud_on_film.search import SearchLexerParser, search_filter_cache
+
+        self.assertEqual( '&((rating>=1)(name="a b"))',
+            SearchLexerParser.normalize( ' & ((rating >= 1) (name="a b"))' ) )
+
+        search_filter_cache.clear()
+        first = Searcher.compile( 'rating>=1' )
+        self.assertIs( first, Searcher.compile( ' rating >= 1 ' ) )
+        self.assertEqual( 1, len( search_filter_cache ) )
+
+        with self.assertRaises( SearchExecuteException ):
+            Searcher.compile( 'lens=50' )
+        self.assertEqual( 1, len( search_filter_cache ) )
+
+        # Pages from the cached statement match a fresh search.
+        expected = [i.id for i in Searcher.query( 'rating>=0', self.user_id ) \
+            .order_by( Item.name, Item.id ).all()]
+        self.assertLess( 2, len( expected ) )
+        for i in range( 2 ):
+            after = None
+            seen = []
+            while True:
+                items, after = Searcher.page( 'rating>=0', self.user_id, after, 2 )
+                seen += [i.id for i in items]
+                if not after:
+                    break
+            self.assertEqual( expected, seen )
+
+    def test_search_snapshot( self ):
+
+        from cloud_on_film.models import DataVersion
+        from cloud_on_film.search import search_snapshot_cache
+
+        def pages():
+            seen = []
+            after = None
+            while True:
+                items, after = Searcher.page_snapshot(
+                    'rating>=1', self.user_id, after, 1 )
+                seen += [i.name for i in items]
+                if not after:
+                    return seen
+
+        search_snapshot_cache.clear()
+        self.assertEqual( ['random100x100.png', 'random500x500.png'], pages() )
+        self.assertEqual( 1, len( search_snapshot_cache ) )
+        hits = search_snapshot_cache.hits
+        pages()
+        self.assertLess( hits, search_snapshot_cache.hits )
+
+        # Any write to items moves to a new snapshot.
+        version = DataVersion.get( DataVersion.ITEMS )
+        item = db.session.query( Item ) \
+            .filter( Item.name == 'random640x400.png' ).one()
+        item.meta['rating'] = 3
+        db.session.commit()
+        self.assertLess( version, DataVersion.get( DataVersion.ITEMS ) )
+
+        self.assertEqual( ['random100x100.png', 'random500x500.png',
+            'random640x400.png'], pages() )
+        self.assertEqual( 1, len( search_snapshot_cache ) )
+
+        # Pages past a partial snapshot come from the database.
+        from cloud_on_film import search
+        max_ids = search.SEARCH_SNAPSHOT_MAX_IDS
+        search.SEARCH_SNAPSHOT_MAX_IDS = 1
+        try:
+            search_snapshot_cache.clear()
+            self.assertEqual( ['random100x100.png', 'random500x500.png',
+                'random640x400.png'], pages() )
+        finally:
+            search.SEARCH_SNAPSHOT_MAX_IDS = max_ids
+
+    def test_search_parse( self ):
+
+        from cloud_on_film.search import SearchLexerParser, \
+            SearchSyntaxException
+
+        def tree( query_str ):
+            lexer = SearchLexerParser( query_str )
+            lexer.lex()
+            return shape( lexer.root.children[0] )
+
+        def shape( node ):
+            if isinstance( node, SearchLexerParser.Compare ):
+                return (node.children[0], node.op.name, node.children[1])
+            return (str( node ), [shape( c ) for c in node.children])
+
+        # Prefix and infix forms, with ! before & before |.
+        self.assertEqual( ('OR', [('width', 'eq', 100), ('width', 'eq', 500)]),
+            tree( '|((width=100)(width=500))' ) )
+        self.assertEqual( ('OR', [('a', 'eq', 1), ('AND', [('b', 'eq', 2),
+            ('NOT', [('c', 'eq', 3)])])]), tree( 'a=1 | b=2 & !c=3' ) )
+        self.assertEqual( ('AND', [('a', 'eq', 1), ('b', 'gte', 2.5)]),
+            tree( '(a=1) (b >= 2.5)' ) )
+        self.assertEqual( ('NOT', [('AND', [('a', 'eq', 1), ('b', 'eq', 2)])]),
+            tree( '!((a=1)(b=2))' ) )
+
+        self.assertEqual( ('rating', 'neq', 3), tree( 'rating!=3' ) )
+        self.assertEqual( ('NOT', [('name', 'like', '%x%')]),
+            tree( 'name!=%x%' ) )
+        self.assertEqual( ('name', 'like', '%100'), tree( 'name=%100' ) )
+        self.assertEqual( ('name', 'eq', '640x480'), tree( 'name=640x480' ) )
+        self.assertEqual( ('Sub Tag', 'in_', 'tags'), tree( '"Sub Tag"@tags' ) )
+        self.assertEqual( ('titre', 'eq', 'été'), tree( 'titre=été' ) )
+        self.assertEqual( ('owner_id', 'eq', 0), tree( 'owner_id=0' ) )
+        self.assertEqual( ('name', 'like', '%IMG_2019.jpg%'),
+            tree( 'name=%IMG_2019.jpg%' ) )
+        self.assertEqual( ('name', 'like', '%foo-bar%'),
+            tree( 'name=%foo-bar%' ) )
+        self.assertEqual( ('name', 'eq', '2019-05-01'), tree( 'name=2019-05-01' ) )
+        self.assertEqual( ('rating', 'gt', -1), tree( 'rating>-1' ) )
+        self.assertEqual( ('AND', [('rating', 'eq', 2.5), ('a', 'eq', 1)]),
+            tree( '(rating=2.5)(a=1)' ) )
+
+        for query_str in ['rating=', '(rating=1', 'rating=1)', '=1', '1=1',
+        'rating=1.2.3', 'name="open', 'rating$1', '|((a=1)|(b=2))', '()']:
+            with self.assertRaises( SearchSyntaxException ):
+                SearchLexerParser( query_str ).lex()
+
+        search_test = Searcher( 'rating!=4' )
+        search_test.lexer.lex()
+        res = search_test.search( self.user_id ).all()
+        self.assertEqual( 4, len( res ) )
+        for item in res:
+            self.assertNotEqual( 4, item.rating )
+
+    def test_search_plan( self ):
+
+        from cloud_on_film.models import Tag
+        from cloud_on_film.search import SearchLexerParser, SearchPlanner
+
+        def plan( query_str ):
+            lexer = SearchLexerParser( query_str )
+            lexer.lex()
+            return shape( SearchPlanner.plan( lexer.root ) )
+
+        def shape( node ):
+            if isinstance( node, SearchLexerParser.Compare ):
+                return (node.children[0], node.op.name, node.children[1])
+            return (str( node ), [shape( c ) for c in node.children])
+
+        self.assertEqual( ('width', 'one_of', (100, 500, 640)),
+            plan( '|((width=100)(width=500)(width=100)(width=640))' ) )
+        self.assertEqual( ('AND', [('a', 'eq', 1), ('aspect', 'eq', 10),
+            ('rating', 'gte', 1), ('NOT', [('nsfw', 'eq', 1)])]),
+            plan( '&((rating>=1)(&((a=1)!!(aspect=10)))!(nsfw=1))' ) )
+        self.assertEqual( ('OR', [('name', 'like', '%a%'),
+            ('width', 'one_of', (1, 2)), ('width', 'one_of', ('x', 'y'))]),
+            plan( 'width=1 | width=x | name=%a% | width=y | width=2' ) )
+        self.assertEqual( ('AND', [('tags', 'all_of', ('A', 'B', 'C')),
+            ('OR', [('rating', 'gt', 1), ('tags', 'one_of', ('D', 'E'))])]),
+            plan( '"A"@tags "B"@tags & ("D"@tags | "E"@tags | rating>1) & ' \
+                '"C"@tags "A"@tags' ) )
+
+        for name, tag_names in [
+            ('random100x100.png', ['Test Tag 1']),
+            ('random500x500.png', ['Test Tag 1', 'Test Tag 2'])
+        ]:
+            item = db.session.query( Item ).filter( Item.name == name ).one()
+            for tag_name in tag_names:
+                item.tags.append( db.session.query( Tag ) \
+                    .filter( Tag.name == tag_name ).first() )
+        db.session.commit()
+
+        # The planned and the literal translation find the same items.
+        for query_str, expected in [
+            ('"Test Tag 1"@tags "Sub Test Tag 3"@tags', ['random100x100.png']),
+            ('"Test Tag 1"@tags & "Test Tag 2"@tags', ['random500x500.png']),
+            ('"Sub Test Tag 3"@tags | "Test Tag 2"@tags',
+                ['random100x100.png', 'random500x500.png']),
+            ('!("Test Tag 1"@tags) & width=640',
+                ['random640x400.png', 'random640x480.png']),
+            ('|((width=100)(width=500)(height=240))',
+                ['random100x100.png', 'random320x240.png',
+                'random500x500.png'])
+        ]:
+            search_test = Searcher( query_str )
+            search_test.lexer.lex()
+            for search_filter in [search_test.filter(),
+            search_test.filter( search_test.lexer.root )]:
+                res = Item.secure_query( self.user_id ) \
+                    .filter( search_filter ) \
+                    .order_by( Item.name ).all()
+                self.assertEqual( expected, [r.name for r in res] )
+
     def test_search_in( self ):
 
         search_test = Searcher( '("Sub Test Tag 3"@tags)' )
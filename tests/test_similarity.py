@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import random
+import unittest
+
+from PIL import Image
+from flask_testing import TestCase
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
+from tests.data_helper import DataHelper
+from cloud_on_film import create_app, db
+from cloud_on_film.models import Item
+from cloud_on_film.similarity import \
+    BKTree, SimilarityIndex, perceptual_hash, hamming
+
+class TestSimilarity( TestCase ):
+
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    TESTING = True
+
+    def create_app( self ):
+        return create_app( self )
+
+    def setUp( self ):
+        db.create_all()
+
+        self.user_id = 0
+        DataHelper.create_folders( self )
+        DataHelper.create_libraries( self, db )
+        DataHelper.create_data_folders( self, db )
+        DataHelper.create_data_items( self, db )
+
+    def tearDown( self ):
+        db.session.remove()
+        db.drop_all()
+
+    def test_perceptual_hash( self ):
+
+        # A smooth gradient survives resizing, unlike the random test data.
+        gradient = Image.linear_gradient( 'L' ).rotate( 30 ).convert( 'RGB' )
+        resized = gradient.resize( (100, 100) )
+        flipped = gradient.transpose( Image.FLIP_LEFT_RIGHT )
+
+        hash_orig = int( perceptual_hash( gradient ), 16 )
+        self.assertLessEqual(
+            hamming( hash_orig, int( perceptual_hash( resized ), 16 ) ), 4 )
+        self.assertGreater(
+            hamming( hash_orig, int( perceptual_hash( flipped ), 16 ) ), 16 )
+
+    def test_bktree( self ):
+
+        rand = random.Random( 1 )
+        hashes = [rand.getrandbits( 64 ) for i in range( 500 )]
+        tree = BKTree()
+        for i, hash_int in enumerate( hashes ):
+            tree.add( hash_int, i )
+
+        for distance in [0, 12, 24]:
+            expected = sorted( i for i, h in enumerate( hashes )
+                if hamming( hashes[7], h ) <= distance )
+            self.assertEqual( expected,
+                sorted( i for i, d in tree.search( hashes[7], distance ) ) )
+
+    def test_similar( self ):
+
+        items = db.session.query( Item ).order_by( Item.id ).all()
+        base = int( items[0].meta['phash'], 16 )
+        items[1].meta['phash'] = '{:016x}'.format( base ^ 0b101 )
+        db.session.commit()
+
+        similar = SimilarityIndex.similar( items[0].id, self.user_id, 2 )
+        self.assertEqual( [(items[1].id, 2)], [(i.id, d) for i, d in similar] )
+
+        self.assertIn( sorted( [items[0].id, items[1].id] ),
+            SimilarityIndex.clusters( 2 ) )
+
+        res = self.client.get(
+            '/ajax/list/similar/{}?distance=2'.format( items[0].id ) )
+        self.assertEqual(
+            [{'id': items[1].id, 'name': items[1].name, 'distance': 2}],
+            json.loads( res.data ) )
+
+        # The tree is only rebuilt once a hash has been written.
+        tree = SimilarityIndex.load()[0]
+        items[2].meta['rating'] = 5
+        db.session.commit()
+        self.assertIs( tree, SimilarityIndex.load()[0] )
+        items[2].meta['phash'] = '{:016x}'.format( base ^ 0b1 )
+        db.session.commit()
+        self.assertIsNot( tree, SimilarityIndex.load()[0] )
+        self.assertEqual( [items[2].id, items[1].id], [i.id for i, d in
+            SimilarityIndex.similar( items[0].id, self.user_id, 2 )] )
+
+if '__main__' == __name__:
+    unittest.main()
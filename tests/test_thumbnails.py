@@ -0,0 +1,246 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from flask_testing import TestCase
+from PIL import Image
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
+from tests.data_helper import DataHelper
+from cloud_on_film import create_app, db
+from cloud_on_film.models import Item, ThumbnailJob, JobStatusEnum
+from cloud_on_film.scanner import Scanner
+from cloud_on_film.thumbnails import \
+    ThumbnailWorker, enqueue, thumbnail_file, render_thumbnails
+from cloud_on_film.thumbstore import ThumbnailStore
+from cloud_on_film.benchmarks import synthetic_jpeg
+
+class TestThumbnails( TestCase ):
+
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    TESTING = True
+    ALLOWED_PREVIEWS = [
+        '160, 120',
+        '320, 240'
+    ]
+
+    def create_app( self ):
+        self.THUMBNAIL_PATH = tempfile.mkdtemp()
+        return create_app( self )
+
+    def setUp( self ):
+        db.create_all()
+
+        from cloud_on_film.files.picture import register_plugin
+        register_plugin()
+
+        self.user_id = 0
+        DataHelper.create_folders( self )
+        DataHelper.create_libraries( self, db )
+
+    def tearDown( self ):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree( self.THUMBNAIL_PATH )
+
+    def test_scan_enqueues( self ):
+
+        Scanner( self.lib, workers=2 ).run()
+
+        jobs = db.session.query( ThumbnailJob ).all()
+        self.assertEqual( 2, len( jobs ) )
+        for job in jobs:
+            self.assertEqual( JobStatusEnum.pending, job.status )
+
+        # Queueing again leaves pending jobs alone.
+        enqueue( [j.item_id for j in jobs] )
+        db.session.commit()
+        self.assertEqual( 2, db.session.query( ThumbnailJob ).count() )
+
+    def test_process( self ):
+
+        Scanner( self.lib, workers=2 ).run()
+
+        done, failed = ThumbnailWorker( workers=2, batch_size=1 ).process()
+
+        self.assertEqual( 2, done )
+        self.assertEqual( 0, failed )
+
+        for item in db.session.query( Item ).all():
+            for size in [(160, 120), (320, 240)]:
+                with Image.open( thumbnail_file( item.hash, size ) ) as im:
+                    self.assertEqual( size, im.size )
+
+        self.assertEqual( 2, db.session.query( ThumbnailJob ) \
+            .filter( ThumbnailJob.status == JobStatusEnum.done ) \
+            .count() )
+
+        # Finished jobs can be queued again.
+        item = db.session.query( Item ).first()
+        enqueue( [item.id] )
+        db.session.commit()
+        self.assertEqual( JobStatusEnum.pending,
+            db.session.query( ThumbnailJob ) \
+                .filter( ThumbnailJob.item_id == item.id ).one().status )
+
+    def test_process_missing( self ):
+
+        Scanner( self.lib, workers=2 ).run()
+
+        # Point the item at a file that is not there.
+        item = db.session.query( Item ).first()
+        item.name = 'missing.png'
+        db.session.commit()
+
+        done, failed = ThumbnailWorker( workers=1 ).process()
+
+        self.assertEqual( 1, done )
+        self.assertEqual( 1, failed )
+
+        job = db.session.query( ThumbnailJob ) \
+            .filter( ThumbnailJob.item_id == item.id ).one()
+        self.assertEqual( JobStatusEnum.failed, job.status )
+        self.assertIsNotNone( job.note )
+
+        # Viewing it serves the placeholder without queueing it again.
+        self.app.config['THUMBNAIL_WAIT'] = 30
+        res = self.client.get(
+            '/contents/preview/{}?width=160&height=120'.format( item.id ) )
+        self.assertStatus( res, 200 )
+        self.assertEqual( 'no-store', res.headers['Cache-Control'] )
+        db.session.refresh( job )
+        self.assertEqual( JobStatusEnum.failed, job.status )
+
+    def test_process_orphans( self ):
+
+        Scanner( self.lib, workers=2 ).run()
+        items = db.session.query( Item ).order_by( Item.id ).all()
+
+        # Deleting an item deletes its job.
+        db.session.delete( items[1] )
+        db.session.commit()
+        self.assertEqual( 1, db.session.query( ThumbnailJob ).count() )
+
+        # Jobs left behind by items deleted in SQL are dropped rather than
+        # holding up the queue, even when they fill a whole batch.
+        db.session.query( ThumbnailJob ).delete()
+        for item_id in [items[1].id, items[1].id + 100]:
+            db.session.add( ThumbnailJob( item_id=item_id,
+                status=JobStatusEnum.pending, timestamp=0 ) )
+        db.session.commit()
+        enqueue( [items[0].id] )
+        db.session.commit()
+
+        done, failed = ThumbnailWorker( workers=1, batch_size=2 ).process()
+
+        self.assertEqual( (1, 0), (done, failed) )
+        self.assertEqual( [(items[0].id, JobStatusEnum.done)],
+            db.session.query( ThumbnailJob.item_id, ThumbnailJob.status ) \
+                .all() )
+
+    def test_render_jpeg( self ):
+
+        source_path = os.path.join( self.THUMBNAIL_PATH, 'source.jpg' )
+        synthetic_jpeg( source_path, (1600, 800) )
+
+        targets = [(size, os.path.join( self.THUMBNAIL_PATH,
+            '{}x{}.jpg'.format( *size ) ))
+            for size in [(160, 120), (360, 270), (2000, 2000)]]
+        self.assertIsNone( render_thumbnails( source_path, targets ) )
+
+        # Scaled to fit and centered, but never enlarged.
+        for size, fit in zip( [t[0] for t in targets],
+        [(160, 80), (360, 180), (1600, 800)] ):
+            with Image.open( os.path.join( self.THUMBNAIL_PATH,
+            '{}x{}.jpg'.format( *size ) ) ) as im:
+                self.assertEqual( size, im.size )
+                if fit[1] < size[1]:
+                    # Letterboxed in black.
+                    self.assertGreater( 30, sum( im.getpixel( (0, 0) ) ) )
+                self.assertLess( 30, sum( im.getpixel(
+                    (size[0] // 2, size[1] // 2) ) ) )
+
+        self.assertIsNotNone( render_thumbnails(
+            os.path.join( self.THUMBNAIL_PATH, 'missing.jpg' ), targets ) )
+
+    def test_preview_placeholder( self ):
+
+        Scanner( self.lib, workers=2 ).run()
+        item = db.session.query( Item ).first()
+
+        self.app.config['THUMBNAIL_WAIT'] = 0.1
+        res = self.client.get(
+            '/contents/preview/{}?width=160&height=120'.format( item.id ) )
+
+        self.assertStatus( res, 200 )
+        self.assertEqual( 'no-store', res.headers['Cache-Control'] )
+        with Image.open( BytesIO( res.data ) ) as im:
+            self.assertEqual( (160, 120), im.size )
+        self.assertFalse(
+            os.path.exists( thumbnail_file( item.hash, (160, 120) ) ) )
+
+        ThumbnailWorker( workers=1 ).process()
+
+        res = self.client.get(
+            '/contents/preview/{}?width=160&height=120'.format( item.id ) )
+        self.assertStatus( res, 200 )
+        self.assertNotIn( 'no-store', res.headers.get( 'Cache-Control', '' ) )
+
+class TestThumbnailStore( unittest.TestCase ):
+
+    def setUp( self ):
+        self.root = tempfile.mkdtemp()
+        self.store = ThumbnailStore( self.root, max_bytes=1000 )
+        self.store.prepare()
+
+    def tearDown( self ):
+        shutil.rmtree( self.root )
+
+    def _write( self, item_hash, length=300 ):
+        thumb_path = self.store.path( item_hash, (160, 120) )
+        os.makedirs( os.path.dirname( thumb_path ), exist_ok=True )
+        with open( thumb_path, 'wb' ) as thumb_f:
+            thumb_f.write( b'x' * length )
+        return thumb_path
+
+    def test_path( self ):
+
+        self.assertEqual(
+            os.path.join( self.root, 'ab', 'cd', 'abcdef_160x120.jpg' ),
+            self.store.path( 'abcdef', (160, 120) ) )
+        self.assertTrue( os.path.isdir( os.path.join( self.root, 'ff' ) ) )
+
+    def test_evict( self ):
+
+        paths = [self._write( h ) for h in ['aaaa', 'bbbb', 'cccc']]
+        self.store.record( paths )
+        self.assertEqual( 900, self.store.total() )
+
+        # Use the first so the second is least recently used.
+        self.store.touch_interval = 0
+        db = self.store._db()
+        db.execute( 'UPDATE thumbnails SET atime = 0' )
+        self.store.touch( paths[0] )
+
+        self.store.record( [self._write( 'dddd' )] )
+
+        self.assertFalse( os.path.exists( paths[1] ) )
+        for thumb_path in [paths[0], paths[2]]:
+            self.assertTrue( os.path.exists( thumb_path ) )
+        self.assertEqual( 900, self.store.total() )
+        self.assertEqual( 3, len( self.store ) )
+
+    def test_reindex( self ):
+
+        for item_hash in ['aaaa', 'bbbb']:
+            self._write( item_hash, 100 )
+
+        self.assertEqual( 2, self.store.reindex() )
+        self.assertEqual( 200, self.store.total() )
+
+if '__main__' == __name__:
+    unittest.main()